@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Compare memory held by arcs carrying extra properties when building adjacency lists from full arc entities against
+projection queries reading only neighbor key and creation, as done by DestinationsSearch, OriginsSearch and
+AdjacencySearch. Datastore stub applies projections after loading whole entities, so its latency is not measured.
+
+Usage: GAE_SDK=<path to google_appengine> python benchmarks/arc_projection.py
+"""
+from __future__ import absolute_import, unicode_literals, print_function
+
+from util import set_up_path, activate_testbed, deep_sizeof
+
+set_up_path()
+
+from google.appengine.ext import ndb
+from gaegraph.model import Node, Arc, adjacency_projection
+
+ORIGINS = 50
+ARCS_PER_ORIGIN = 40
+PAYLOAD = 'x' * 500
+
+
+class RichArc(Arc):
+    label = ndb.StringProperty(indexed=False)
+    note = ndb.TextProperty()
+    tags = ndb.StringProperty(repeated=True, indexed=False)
+    weight = ndb.FloatProperty(indexed=False)
+
+
+def build_graph():
+    origins = ndb.put_multi([Node() for _ in xrange(ORIGINS)])
+    destinations = ndb.put_multi([Node() for _ in xrange(ARCS_PER_ORIGIN)])
+    ndb.put_multi([RichArc(o, d, label='label %s' % i, note=PAYLOAD, tags=['a', 'b', 'c'], weight=float(i))
+                   for o in origins for i, d in enumerate(destinations)])
+    ndb.get_context().clear_cache()
+    return origins
+
+
+def adjacency(origins, projection):
+    futures = [RichArc.find_destinations(o).fetch_async(projection=projection) for o in origins]
+    arcs = [f.get_result() for f in futures]
+    lists = [[arc.destination for arc in origin_arcs] for origin_arcs in arcs]
+    return sum(len(l) for l in lists), deep_sizeof(arcs)
+
+
+def main():
+    bed = activate_testbed()
+    origins = build_graph()
+    full = adjacency(origins, None)
+    projected = adjacency(origins, adjacency_projection(RichArc, 'destination'))
+    print('Adjacency lists of %s origins with %s arcs each' % (ORIGINS, ARCS_PER_ORIGIN))
+    for label, (count, size) in [('full arcs', full), ('projection', projected)]:
+        print('%-12s %6s arcs %10.1f KB %8.1f%%' % (label, count, size / 1024.0, 100.0 * size / full[1]))
+    bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Count datastore queries done by DestinationsSearch reads on a leaf heavy graph, where most nodes have no arcs, with
+empty adjacency lists cached as EMPTY_ADJACENCY and without it, when they are dropped from cache after every round as
+before negative caching.
+
+Usage: GAE_SDK=<path to google_appengine> python benchmarks/leaf_queries.py
+"""
+from __future__ import absolute_import, unicode_literals, print_function
+import random
+
+from util import set_up_path, activate_testbed
+
+set_up_path()
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from gaegraph.business_base import DestinationsSearch, EMPTY_ADJACENCY
+from gaegraph.model import Node, Arc, destinations_cache_key
+
+NODES = 300
+NODES_WITH_ARCS = 0.1
+ARCS_PER_NODE = 5
+ROUNDS = 3
+
+
+class LeafArc(Arc):
+    pass
+
+
+class LeafSearch(DestinationsSearch):
+    arc_class = LeafArc
+
+
+class QueryCounter(object):
+    def __init__(self):
+        self.count = 0
+        self._fetch_async = ndb.Query.fetch_async
+
+    def __enter__(self):
+        counter = self
+
+        def fetch_async(query, *args, **kwargs):
+            counter.count += 1
+            return counter._fetch_async(query, *args, **kwargs)
+
+        ndb.Query.fetch_async = fetch_async
+        return self
+
+    def __exit__(self, *exc_info):
+        ndb.Query.fetch_async = self._fetch_async
+
+
+def build_graph():
+    keys = ndb.put_multi([Node() for _ in xrange(NODES)])
+    rnd = random.Random(0)
+    arcs = []
+    for origin in rnd.sample(keys, int(NODES * NODES_WITH_ARCS)):
+        arcs.extend(LeafArc(origin, destination) for destination in rnd.sample(keys, ARCS_PER_NODE))
+    ndb.put_multi(arcs)
+    return keys
+
+
+def read_rounds(keys, negative_caching):
+    memcache.flush_all()
+    with QueryCounter() as counter:
+        for _ in xrange(ROUNDS):
+            for key in keys:
+                LeafSearch(key)()
+            ndb.get_context().clear_cache()
+            if not negative_caching:
+                cache_keys = [destinations_cache_key(LeafArc, key) for key in keys]
+                memcache.delete_multi([k for k, v in memcache.get_multi(cache_keys).iteritems()
+                                       if v == EMPTY_ADJACENCY])
+    return counter.count
+
+
+def main():
+    bed = activate_testbed()
+    keys = build_graph()
+    without = read_rounds(keys, False)
+    with_negative = read_rounds(keys, True)
+    print('%s nodes, %d%% with %s arcs, %s read rounds' % (NODES, NODES_WITH_ARCS * 100, ARCS_PER_NODE, ROUNDS))
+    for label, queries in [('empty lists not cached', without), ('empty lists cached', with_negative)]:
+        print('%-25s %8s queries %8.1f%%' % (label, queries, 100.0 * queries / without))
+    bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
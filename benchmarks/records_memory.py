@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Compare memory held by 10k nodes read as ndb entities against the same nodes read as compact records.
+
+Usage: GAE_SDK=<path to google_appengine> python benchmarks/records_memory.py
+"""
+from __future__ import absolute_import, unicode_literals, print_function
+from util import set_up_path, activate_testbed, deep_sizeof
+
+set_up_path()
+
+from google.appengine.ext import ndb
+from gaegraph.model import Node
+from gaegraph.records import get_records
+
+NODES = 10000
+
+
+class BenchmarkNode(Node):
+    name = ndb.StringProperty()
+    email = ndb.StringProperty()
+    score = ndb.IntegerProperty()
+
+
+def main():
+    bed = activate_testbed()
+    keys = ndb.put_multi([BenchmarkNode(name='user %s' % i, email='user%s@example.com' % i, score=i)
+                          for i in xrange(NODES)])
+    ndb.get_context().clear_cache()
+
+    entities = ndb.get_multi(keys, use_cache=False, use_memcache=False)
+    entities_size = deep_sizeof(entities)
+    all_records = get_records(keys)
+    all_records_size = deep_sizeof(all_records)
+    selected_records = get_records(keys, ['name'])
+    selected_records_size = deep_sizeof(selected_records)
+
+    print('Memory for %s nodes' % NODES)
+    for label, size in [('ndb entities', entities_size),
+                        ('records, all properties', all_records_size),
+                        ('records, name only', selected_records_size)]:
+        print('%-25s %10.1f KB %8.1f%%' % (label, size / 1024.0, 100.0 * size / entities_size))
+    bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import gc
+import os
+import sys
+import types
+
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def set_up_path():
+    """
+    Make gaegraph and App Engine SDK importable. SDK path must be informed on GAE_SDK environment variable
+    """
+    if 'GAE_SDK' in os.environ:
+        sys.path.insert(0, os.environ['GAE_SDK'])
+        import dev_appserver
+
+        dev_appserver.fix_sys_path()
+    sys.path.insert(0, PROJECT_PATH)
+
+
+def activate_testbed():
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.setup_env(app_id='_')
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub()
+    return bed
+
+
+_SHARED_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType)
+
+
+def deep_sizeof(obj):
+    """
+    Approximate number of bytes reachable from obj, ignoring classes, modules and functions shared by all instances
+    """
+    seen = set()
+    stack = [obj]
+    size = 0
+    while stack:
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, _SHARED_TYPES):
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        stack.extend(gc.get_referents(o))
+    return size
@@ -1,15 +1,31 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
+from datetime import datetime
 from itertools import chain, izip
+from operator import itemgetter
+import logging
+import random
+import time
 
-from google.appengine.api import memcache
-from google.appengine.ext import ndb
+from google.appengine.ext import ndb, deferred
+from google.appengine.ext.ndb.query import Cursor
 
 from gaebusiness.business import Command, CommandSequential, CommandExecutionException, CommandParallel
 from gaebusiness.gaeutil import UpdateCommand, DeleteCommand, ModelSearchCommand
-from gaegraph.model import destinations_cache_key, origins_cache_key, to_node_key, Node
+from gaegraph import cache
+from gaegraph.model import destinations_cache_key, origins_cache_key, to_node_key, Node, \
+    destinations_generation_key, origins_generation_key, filtered_cache_key, \
+    pending_arcs_cache_key, origins_shard_cache_key, origins_sharded_key, origin_shard, order_value, \
+    destinations_fence_key, origins_fence_key, write_fences, invalidate_cache_keys, arc_cache_keys, creation_bucket, \
+    bucket_datetime, destinations_bucket_cache_key, origins_bucket_cache_key, admission_counter_key, \
+    adjacency_projection, deletion_projection, projected_arcs, dangling_cleanup_key, fetch_projection_async
+from gaegraph.records import NodeRecord, get_records_async, get_records
+from gaegraph.write_behind import apply_pending, CREATE
 
 LONG_ERROR = "LONG_ERROR"
+DESTINATIONS = 'destinations'
+ORIGINS = 'origins'
+EMPTY_ADJACENCY = 'empty'  # cached in place of empty adjacency lists, so nodes without arcs are not queried again
 
 
 class _NodeSearch(Command):
@@ -19,77 +35,439 @@ class _NodeSearch(Command):
     _model_class = None  # attribute to enforce node class
 
 
-    def __init__(self, node_or_key_or_id):
+    def __init__(self, node_or_key_or_id, compact=False, properties=None):
         super(_NodeSearch, self).__init__()
         self.node_key = to_node_key(node_or_key_or_id)
         self._future = None
+        self._compact = compact
+        self._properties = properties
 
 
     def set_up(self):
-        self._future = self.node_key.get_async()
+        if self._compact:
+            self._future = get_records_async([self.node_key], self._properties)
+        else:
+            self._future = self.node_key.get_async()
 
 
     def do_business(self):
         self.result = self._future.get_result()
+        if self._compact:
+            self.result = self.result[0]
         node = self.result
-        if self._model_class is not None and node and not isinstance(node, self._model_class):
+        if self._model_class is not None and node and not self._is_model_instance(node):
             self.add_error('node_error', '%s should be %s instance' % (node.key, self._model_class.__name__))
 
+    def _is_model_instance(self, node):
+        if isinstance(node, NodeRecord):
+            return issubclass(node.model_class(), self._model_class)
+        return isinstance(node, self._model_class)
+
+
+class _LazyRelationBatch(object):
+    """
+    Relation commands of sibling nodes, all executed in parallel when any of them is first accessed
+    """
+
+    def __init__(self):
+        self._commands = []
+        self._executed = False
+
+    def add(self, cmd):
+        self._commands.append(cmd)
+        return lambda: self.result(cmd)
+
+    def result(self, cmd):
+        if not self._executed:
+            self._executed = True
+            batch = CommandParallel(*self._commands)
+            batch.set_up()
+            batch.do_business()
+        return cmd.result
+
+
+class Relation(object):
+    """
+    Declarative relation, used as a _relations value instead of a command factory: neighbors of a node through
+    arc_class on direction, or only the first one, or None, if single is True. relations maps names to Relation specs
+    of neighbors, requested with dotted names, e.g. 'author.avatar'.
+    Declared relations are filled for all nodes of a search at once, with bulk reads per level of nesting
+    """
+
+    def __init__(self, arc_class, direction=DESTINATIONS, single=False, relations=None):
+        self.arc_class = arc_class
+        self.direction = direction
+        self.single = single
+        self.relations = relations or {}
+
+    def value(self, neighbors):
+        if self.single:
+            return neighbors[0] if neighbors else None
+        return neighbors
+
+
+def _split_relations(names):
+    """
+    Return a dict mapping first level names to lists of their nested names, e.g. ['a.b', 'a.c', 'd'] becomes
+    {'a': ['b', 'c'], 'd': []}
+    """
+    split = {}
+    for name in names:
+        first, _, nested = name.partition('.')
+        nested_names = split.setdefault(first, [])
+        if nested:
+            nested_names.append(nested)
+    return split
+
+
+def _planned_relations(relation_factory, names):
+    return [name for name in names or () if isinstance(relation_factory[name.partition('.')[0]], Relation)]
+
+
+def _with_relations(obj, values):
+    if isinstance(obj, NodeRecord):
+        return obj.with_values(**values)
+    for name, value in values.iteritems():
+        setattr(obj, name, value)
+    return obj
+
+
+class RelationsPlan(Command):
+    """
+    Command filling Relation specs of many nodes level by level: each level of nesting is read with one
+    AdjacencySearch and one deduplicated get_multi, no matter the number of nodes and relations.
+    Nodes are then filled with fill, or lazily with lazy_value, which executes the plan on first access
+    """
+
+    def __init__(self, nodes_or_keys, relation_specs, relations, compact=False):
+        super(RelationsPlan, self).__init__()
+        self.node_keys = [to_node_key(n) for n in nodes_or_keys]
+        self._level = [([(k, None) for k in self.node_keys], relation_specs, _split_relations(relations))]
+        self._compact = compact
+        self._adjacency_search = None
+        self._values = {}
+        self._executed = False
+
+    @classmethod
+    def _adjacency_specs(cls, level):
+        return [(specs[name].arc_class, specs[name].direction, key)
+                for parents, specs, split in level for name in split for key, _ in parents]
+
+    def set_up(self):
+        self._adjacency_search = AdjacencySearch(*self._adjacency_specs(self._level))
+        self._adjacency_search.set_up()
+
+    def do_business(self):
+        self._executed = True
+        level = self._level
+        adjacency_search = self._adjacency_search
+        records_values = {}  # records are immutable, so they are filled bottom up once all levels are read
+        while level:
+            if adjacency_search is None:
+                adjacency_search = AdjacencySearch(*self._adjacency_specs(level))
+                adjacency_search.set_up()
+            adjacency_search.do_business()
+            adjacency = adjacency_search.result
+            adjacency_search = None
+            keys = list(set(k for neighbors in adjacency.itervalues() for k in neighbors))
+            nodes = get_records(keys) if self._compact else ndb.get_multi(keys)
+            fetched = dict(izip(keys, nodes))
+            next_level = []
+            for parents, specs, split in level:
+                for name, nested in split.iteritems():
+                    relation = specs[name]
+                    children = []
+                    for key, obj in parents:
+                        neighbors = [fetched[k] for k in adjacency[(relation.arc_class, relation.direction, key)]
+                                     if fetched[k]]
+                        if relation.single:
+                            neighbors = neighbors[:1]
+                        children.extend(neighbors)
+                        if obj is None:
+                            self._values.setdefault(key, {})[name] = (relation, neighbors)
+                        elif isinstance(obj, NodeRecord):
+                            records_values.setdefault(id(obj), {})[name] = (relation, neighbors)
+                        else:
+                            setattr(obj, name, relation.value(neighbors))
+                    if nested:
+                        next_level.append(([(c.key, c) for c in children], relation.relations,
+                                           _split_relations(nested)))
+            level = next_level
+        resolved = {}
+
+        def resolve(obj):
+            if not isinstance(obj, NodeRecord) or id(obj) not in records_values:
+                return obj
+            if id(obj) not in resolved:
+                resolved[id(obj)] = obj.with_values(**{name: relation.value([resolve(n) for n in neighbors])
+                                                       for name, (relation, neighbors)
+                                                       in records_values[id(obj)].iteritems()})
+            return resolved[id(obj)]
+
+        self._values = {key: {name: relation.value([resolve(n) for n in neighbors])
+                              for name, (relation, neighbors) in values.iteritems()}
+                        for key, values in self._values.iteritems()}
+
+    def _execute(self):
+        if not self._executed:
+            self.set_up()
+            self.do_business()
+
+    def fill(self, obj):
+        """
+        Fill obj with planned relations and return it. A new record is returned for records
+        """
+        return _with_relations(obj, self._values.get(obj.key, {}))
+
+    def lazy_value(self, node_key, name):
+        def loader():
+            self._execute()
+            return self._values.get(node_key, {}).get(name)
+
+        return loader
+
 
 class RelationFiller(CommandParallel):
-    def __init__(self, node_or_key_or_id, relation_factory, relations):
+    """
+    Command executing relation commands for a node.
+    If lazy_batches dict is informed, commands are not executed. Instead fill installs lazy relations on node,
+    sharing a batch per relation name with all fillers using the same dict.
+    Declarative Relation specs are filled by plan, a RelationsPlan shared with sibling fillers. If it is not informed,
+    the filler executes a plan of its own
+    """
+
+    def __init__(self, node_or_key_or_id, relation_factory, relations, lazy_batches=None, plan=None, compact=False):
         node_key = to_node_key(node_or_key_or_id)
         relations = relations or []
+        planned = _planned_relations(relation_factory, relations)
+        self._node_key = node_key
         self._relations_commands = {k: relation_factory[k](node_key)
-                                    for k in relations}
-
-        super(RelationFiller, self).__init__(*self._relations_commands.itervalues())
+                                    for k in relations if k not in planned}
+        self._lazy_batches = lazy_batches
+        self._planned_names = _split_relations(planned).keys()
+        commands = []
+        if planned and plan is None:
+            plan = RelationsPlan([node_key], relation_factory, planned, compact)
+            commands.append(plan)
+        self._plan = plan
+        if lazy_batches is None:
+            super(RelationFiller, self).__init__(*(self._relations_commands.values() + commands))
+        else:
+            super(RelationFiller, self).__init__()
 
     def fill(self, obj):
+        """
+        Fill obj with relations and return it.
+        Records are immutable, so a new record having relations as extra fields is returned for them
+        """
+        if self._plan is not None and self._lazy_batches is None:
+            obj = self._plan.fill(obj)
+        if isinstance(obj, NodeRecord):
+            return obj.with_values(**{k: cmd.result for k, cmd in self._relations_commands.iteritems()})
         for k, cmd in self._relations_commands.iteritems():
-            setattr(obj, k, cmd.result)
+            if self._lazy_batches is None:
+                setattr(obj, k, cmd.result)
+            else:
+                batch = self._lazy_batches.setdefault(k, _LazyRelationBatch())
+                obj.set_lazy_relation(k, batch.add(cmd))
+        if self._lazy_batches is not None:
+            for name in self._planned_names:
+                obj.set_lazy_relation(name, self._plan.lazy_value(self._node_key, name))
+        return obj
+
+
+def _node_searches():
+    """
+    Return the dict memoizing NodeSearch results of current request, kept on ndb context, which is created per request
+    """
+    ctx = ndb.get_context()
+    memo = getattr(ctx, '_gaegraph_node_searches', None)
+    if memo is None:
+        memo = ctx._gaegraph_node_searches = {}
+    return memo
+
+
+def forget_node_searches(node_keys):
+    """
+    Discard NodeSearch results of node_keys memoized on current request
+    """
+    node_keys = set(to_node_key(k) for k in node_keys)
+    memo = _node_searches()
+    for memo_key in [k for k in memo if k[1] in node_keys]:
+        del memo[memo_key]
+
+
+class _MemoizedSearch(object):
+    """
+    Result and errors of a NodeSearch, computed by the first search set up and shared by equal searches
+    """
+
+    def __init__(self, cmd):
+        self._cmd = cmd
+        self._value = None
+
+    def get_result(self):
+        if self._value is None:
+            self._value = self._cmd._search()
+            self._cmd = None
+        return self._value
 
 
 class NodeSearch(CommandParallel):
+    """
+    Command searching a node with its relations. Searches of same class, node and arguments executed on a request share
+    the same datastore call and result, until the node is changed by UpdateNode or DeleteNode or its arcs are created
+    by CreateArc or deleted by DeleteArcs
+    """
     _model_class = None  # attribute to enforce node class
     _relations = {}
 
-    def __init__(self, node_or_key_or_id, relations=None):
-        node_search = _NodeSearch(node_or_key_or_id)
+    def __init__(self, node_or_key_or_id, relations=None, lazy_relations=False, compact=False, properties=None):
+        node_search = _NodeSearch(node_or_key_or_id, compact, properties)
+        self._memo_key = (self.__class__, node_search.node_key, tuple(relations or ()), lazy_relations, compact,
+                          tuple(properties) if properties is not None else None)
+        self._memoized = None
         node_search._model_class = self._model_class
         if relations:
-            self._relation_filler = RelationFiller(node_or_key_or_id, self._relations, relations)
+            lazy_batches = {} if lazy_relations and not compact else None
+            self._relation_filler = RelationFiller(node_or_key_or_id, self._relations, relations, lazy_batches,
+                                                   compact=compact)
             super(NodeSearch, self).__init__(self._relation_filler, node_search)
         else:
             self._relation_filler = None
             super(NodeSearch, self).__init__(node_search)
 
+    def set_up(self):
+        memo = _node_searches()
+        if self._memoized is not None:
+            memo.pop(self._memo_key, None)  # executing a command again searches node again
+        self._memoized = memo.get(self._memo_key)
+        if self._memoized is None:
+            self._memoized = memo[self._memo_key] = _MemoizedSearch(self)
+            super(NodeSearch, self).set_up()
+
     def do_business(self):
-        super(NodeSearch, self).do_business()
-        if self._relation_filler:
-            self._relation_filler.fill(self.result)
+        self.result, errors = self._memoized.get_result()
+        self.update_errors(**errors)
+        self.raise_exception_if_errors()
+
+    def _search(self):
+        try:
+            super(NodeSearch, self).do_business()
+        except CommandExecutionException:
+            return None, dict(self.errors)
+        if self._relation_filler is not None and self.result:
+            self.result = self._relation_filler.fill(self.result)
+        return self.result, {}
+
+
+class _RelationsPlanner(object):
+    """
+    Relations of many nodes, started from their keys, so relation queries run while nodes themselves are fetched.
+    Nodes are filled once they are available. Lazy relations are only installed by fill
+    """
+
+    def __init__(self, node_keys, relation_factory, relations, lazy_relations=False, compact=False):
+        planned = _planned_relations(relation_factory, relations)
+        self._plan = RelationsPlan(node_keys, relation_factory, planned, compact) if planned else None
+        self._relation_factory = relation_factory
+        self._relations = relations
+        self._lazy = lazy_relations and not compact
+        self._fillers = None
+        if not self._lazy:
+            self._fillers = [RelationFiller(k, relation_factory, relations, plan=self._plan) for k in node_keys]
+            self._command = CommandParallel(*(self._fillers + [self._plan] if self._plan else self._fillers))
+            self._command.set_up()
+
+    def fill(self, nodes):
+        """
+        Return nodes, on the same order of keys, filled with relations. Missing nodes are kept as None
+        """
+        if self._lazy:
+            lazy_batches = {}
+            for node in nodes:
+                if node is not None:
+                    RelationFiller(node, self._relation_factory, self._relations, lazy_batches, self._plan).fill(node)
+            return nodes
+        self._command.do_business()
+        return [node if node is None else filler.fill(node) for node, filler in izip(nodes, self._fillers)]
 
 
 def _fill_relations_helper(cmd):
-    if cmd._required_relations and cmd.result:
-        cmds = CommandParallel(*(RelationFiller(r, cmd._relations, cmd._required_relations) for r in cmd.result))
-        cmds()
-        for r, filler in izip(cmd.result, cmds):
-            filler.fill(r)
+    if not (cmd._required_relations and cmd.result):
+        return
+    planner = _RelationsPlanner([r.key for r in cmd.result], cmd._relations, cmd._required_relations,
+                                cmd._lazy_relations, cmd._compact)
+    cmd.result = planner.fill(cmd.result)
 
 
 class ModelSearchWithRelations(ModelSearchCommand):
+    """
+    Command searching a page of nodes with relations. Page keys are read from cache or with a keys only query, and as
+    soon as they are known, nodes are fetched while relations are resolved from keys, so both phases overlap. Page keys
+    cached on set_up start both phases there.
+    timings maps each phase, 'page_keys', 'nodes' and 'relations', to seconds elapsed from set_up until it was done
+    """
     _relations = {}
 
     def __init__(self, query, page_size=100, start_cursor=None, offset=0, use_cache=True, cache_begin=True,
-                 relations=None, **kwargs):
+                 relations=None, lazy_relations=False, compact=False, properties=None, **kwargs):
         super(ModelSearchWithRelations, self).__init__(query, page_size, start_cursor, offset, use_cache, cache_begin,
                                                        **kwargs)
         self._required_relations = relations
+        self._lazy_relations = lazy_relations
+        self._compact = compact
+        self._properties = properties
+        self._page_keys = None
+        self._page_future = None
+        self._nodes_future = None
+        self._planner = None
+        self._start = None
+        self.timings = {}
+
+    def _elapsed(self):
+        return time.time() - self._start
+
+    def set_up(self):
+        self._start = time.time()
+        self.timings = {}
+        self._page_keys = self._page_future = self._nodes_future = self._planner = None
+        if self._should_cache():
+            cached_tuple = cache.get(self._cache_key())
+            if cached_tuple:
+                self._page_keys, self.cursor, self.more = cached_tuple[0], cached_tuple[1], True
+        if self._page_keys:
+            self._start_page()
+        else:
+            self._page_future = self.query.fetch_page_async(self.page_size, start_cursor=self.start_cursor,
+                                                            offset=self.offset, keys_only=True)
+
+    def _start_page(self):
+        self.timings['page_keys'] = self._elapsed()
+        keys = self._page_keys
+        if self._compact:
+            self._nodes_future = get_records_async(keys, self._properties)
+        else:
+            self._nodes_future = ndb.get_multi_async(keys)
+        if self._required_relations and keys:
+            self._planner = _RelationsPlanner(keys, self._relations, self._required_relations, self._lazy_relations,
+                                              self._compact)
 
     def do_business(self, stop_on_error=True):
-        super(ModelSearchWithRelations, self).do_business(stop_on_error)
-        _fill_relations_helper(self)
+        if self._nodes_future is None:
+            self._page_keys, self.cursor, self.more = self._page_future.get_result()
+            self._start_page()
+            if self._should_cache() and len(self._page_keys) == self.page_size:
+                cache.set_value(self._cache_key(), (self._page_keys, self.cursor))
+        if self._compact:
+            self.result = self._nodes_future.get_result()
+        else:
+            self.result = [f.get_result() for f in self._nodes_future]
+        self.timings['nodes'] = self._elapsed()
+        if self._planner is not None:
+            self.result = self._planner.fill(self.result)
+            self.timings['relations'] = self._elapsed()
+        logging.debug('%s timings: %s', self.__class__.__name__, self.timings)
 
 
 class CreateArc(CommandSequential):
@@ -129,6 +507,11 @@ class CreateArc(CommandSequential):
             self._to_commit = self.arc_class(self.origin, self.destination)
             self.result = self._to_commit
 
+    def commit(self):
+        to_commit = super(CreateArc, self).commit()
+        if not self.errors and self._to_commit is not None:
+            forget_node_searches([self.origin, self.destination])  # their memoized relations may include this arc
+        return to_commit
 
     def _validate(self):
         pass
@@ -305,11 +688,13 @@ class PaginatedArcSearch(ModelSearchCommand):
 class ArcSearch(Command):
     arc_class = None
 
-    def __init__(self, origin=None, destination=None, keys_only=True):
+    def __init__(self, origin=None, destination=None, keys_only=True, order=None, filters=None):
         super(ArcSearch, self).__init__()
         self.destination = destination
         self.origin = origin
         self._keys_only = keys_only
+        self._order = order
+        self._filters = filters
         self._query = None
         self._future = None
 
@@ -319,16 +704,20 @@ class ArcSearch(Command):
         if not (origin or destination):
             raise Exception('at least one of origin and destination must be not None')
         if origin and destination:
-            self._query = self.arc_class.query_by_origin_and_destination(origin, destination)
+            self._query = self.arc_class.query_by_origin_and_destination(origin, destination, self._order,
+                                                                         self._filters)
         elif origin:
-            self._query = self.arc_class.find_destinations(origin)
+            self._query = self.arc_class.find_destinations(origin, self._order, self._filters)
         else:
-            self._query = self.arc_class.find_origins(destination)
+            self._query = self.arc_class.find_origins(destination, self._order, self._filters)
         self._future = None
 
+    def _fetch_options(self):
+        return {'keys_only': self._keys_only}
+
     def set_up(self):
         self._validate()
-        self._future = self._query.fetch_async(keys_only=self._keys_only)
+        self._future = fetch_projection_async(self._query, **self._fetch_options())
 
     def do_business(self):
         self.result = self._future.get_result()
@@ -381,75 +770,706 @@ class _DestinationHasOriginRaiseError(HasArcCommand):
         self.destination = command.result
 
 
+class _ShardedOrigins(object):
+    """
+    Origins of a sharded destination. Each shard is cached as a list of (order value, origin key) tuples, so shards
+    are merged keeping ordering. Only missing shards are queried, concurrently. Shards and the sharded flag follow
+    arc_class cache_ttl and max_cached_length, and the flag is cleared once destination has less than
+    sharding_threshold origins. Shards are queried by origin_shard, so arcs stored before it existed must be written
+    again with backfill_origin_shards
+    """
+
+    def __init__(self, arc_class, destination, order=None, cache=True):
+        self.arc_class = arc_class
+        self.destination = to_node_key(destination)
+        self.order = order
+        self.cache = cache
+        self._cache_keys = [origins_shard_cache_key(arc_class, self.destination, shard, order)
+                            for shard in xrange(arc_class.origin_shards)]
+        self._cached = {}
+        self._futures = {}
+
+    def set_up(self):
+        self._cached = cache.get_multi(self._cache_keys)
+        arc_class = self.arc_class
+        for shard, cache_key in enumerate(self._cache_keys):
+            if cache_key not in self._cached:
+                query = arc_class.find_origins(self.destination, self.order, [arc_class.origin_shard == shard])
+                projection = adjacency_projection(arc_class, 'origin', self.order)
+                self._futures[cache_key] = fetch_projection_async(query, projection)
+
+    def get_result(self):
+        arc_class = self.arc_class
+        prop, descending = order_value(arc_class, self.order)
+        queried = {cache_key: [(prop._get_value(arc), arc.origin) for arc in future.get_result()]
+                   for cache_key, future in self._futures.iteritems()}
+        shards = [self._cached.get(k) if k in self._cached else queried[k] for k in self._cache_keys]
+        entries = sorted(chain(*shards), key=itemgetter(0), reverse=descending)
+        if self.cache:
+            if len(entries) < arc_class.sharding_threshold:
+                cache.delete_multi([origins_sharded_key(arc_class, self.destination)])
+            elif queried:
+                self._cache_shards(arc_class, queried)  # empty shards are cached too
+        return [origin for _, origin in entries]
+
+    @staticmethod
+    def _cache_shards(arc_class, shards, flag_key=None):
+        max_length = arc_class.max_cached_length
+        to_cache = {k: entries for k, entries in shards.iteritems() if max_length is None or len(entries) <= max_length}
+        if flag_key:
+            to_cache[flag_key] = True
+        cache.set_multi(to_cache, time=arc_class.cache_ttl)
+
+    @classmethod
+    def promote(cls, arc_class, destination, order, arcs):
+        """
+        Flag destination as sharded, caching origins of arcs, sorted by order, on their shards
+        """
+        prop, _ = order_value(arc_class, order)
+        to_cache = {origins_shard_cache_key(arc_class, destination, shard, order): []
+                    for shard in xrange(arc_class.origin_shards)}
+        for arc in arcs:
+            shard_key = origins_shard_cache_key(arc_class, destination, origin_shard(arc_class, arc.origin), order)
+            to_cache[shard_key].append((prop._get_value(arc), arc.origin))
+        # If it fails, destination is promoted again on next search
+        cls._cache_shards(arc_class, to_cache, origins_sharded_key(arc_class, destination))
+
+
+class _CreationWindow(object):
+    """
+    Neighbors of node connected by arcs created on [since, until) window, sorted by creation. Closed creation buckets
+    inside window are cached on their own entries for arc_class.creation_bucket_ttl seconds, so rolling windows reuse
+    them. Only window edges and missing buckets are queried, concurrently, with creation range filters: one query for
+    each run of consecutive missing buckets. Filtered windows are not cached
+    """
+
+    def __init__(self, arc_class, node, arc_property, since, until=None, order=None, filters=None, fence_key=None):
+        prop, self.descending = order_value(arc_class, order)
+        if prop is not arc_class.creation:
+            raise Exception('time windows are only available for creation orderings')
+        self.arc_class = arc_class
+        self.node = to_node_key(node)
+        self.arc_property = arc_property
+        self.since = since
+        self.until = until
+        self.filters = filters
+        self._fence_key = fence_key
+        self._bucket_key = destinations_bucket_cache_key if arc_property == 'destination' else origins_bucket_cache_key
+        self._segments = []
+        self._cache = True
+
+    def _buckets(self):
+        size = self.arc_class.creation_bucket_seconds
+        now = datetime.utcnow()
+        first = creation_bucket(self.arc_class, self.since)
+        if bucket_datetime(first) < self.since:
+            first += size
+        last = creation_bucket(self.arc_class, min(self.until, now) if self.until else now)
+        return range(first, last, size)
+
+    def _query(self, start, end):
+        arc_class = self.arc_class
+        filters = [arc_class.creation >= start]
+        if end is not None:
+            filters.append(arc_class.creation < end)
+        filters.extend(self.filters or ())
+        options = {} if self.filters else {'projection': adjacency_projection(arc_class, self.arc_property, 'creation')}
+        if self.arc_property == 'destination':
+            return fetch_projection_async(arc_class.find_destinations(self.node, 'creation', filters), **options)
+        return fetch_projection_async(arc_class.find_origins(self.node, 'creation', filters), **options)
+
+    def set_up(self):
+        buckets = [] if self.filters else self._buckets()
+        if not buckets:
+            self._segments = [(None, self._query(self.since, self.until))]
+            return
+        cache_keys = [self._bucket_key(self.arc_class, self.node, b) for b in buckets]
+        cached = cache.get_multi(cache_keys + ([self._fence_key] if self._fence_key else []))
+        self._cache = self._fence_key not in cached
+        size = self.arc_class.creation_bucket_seconds
+        if self.since < bucket_datetime(buckets[0]):
+            self._segments.append((None, self._query(self.since, bucket_datetime(buckets[0]))))
+        run = []
+        for bucket, cache_key in izip(buckets, cache_keys):
+            if cache_key in cached:
+                self._add_run(run)
+                run = []
+                self._segments.append((None, cached[cache_key]))
+            else:
+                run.append(bucket)
+        self._add_run(run)
+        end = bucket_datetime(buckets[-1] + size)
+        if self.until is None or end < self.until:
+            self._segments.append((None, self._query(end, self.until)))
+
+    def _add_run(self, run):
+        if run:
+            size = self.arc_class.creation_bucket_seconds
+            self._segments.append((run, self._query(bucket_datetime(run[0]), bucket_datetime(run[-1] + size))))
+
+    def get_result(self):
+        keys = []
+        to_cache = {}
+        for run, result in self._segments:
+            if isinstance(result, list):
+                keys.extend(result)
+                continue
+            arcs = result.get_result()
+            keys.extend(getattr(arc, self.arc_property) for arc in arcs)
+            if run:
+                by_bucket = {self._bucket_key(self.arc_class, self.node, b): [] for b in run}
+                for arc in arcs:
+                    bucket_key = self._bucket_key(self.arc_class, self.node, creation_bucket(self.arc_class,
+                                                                                            arc.creation))
+                    by_bucket[bucket_key].append(getattr(arc, self.arc_property))
+                to_cache.update(by_bucket)
+        if to_cache and self._cache:
+            cache.set_multi(to_cache, time=self.arc_class.creation_bucket_ttl)  # empty buckets are cached too
+        if self.descending:
+            keys.reverse()
+        return keys
+
+
 class ArcNodeSearchBase(ArcSearch):
     arc_class = None
     _relations = {}
 
-    def __init__(self, origin=None, destination=None, relations=None):
-        super(ArcNodeSearchBase, self).__init__(origin, destination, False)
+    def __init__(self, origin=None, destination=None, relations=None, order=None, limit=None, offset=0,
+                 filters=None, lazy_relations=False, compact=False, properties=None, with_pending=False, since=None,
+                 until=None):
+        super(ArcNodeSearchBase, self).__init__(origin, destination, False, order, filters)
         if origin and destination:
             raise Exception('only one of origin or destination can be not None')
         elif origin:
-            self._cache_key = destinations_cache_key(self.arc_class, self.origin)
+            self._cache_key = destinations_cache_key(self.arc_class, self.origin, order)
+            self._generation_key = destinations_generation_key(self.arc_class, self.origin)
             self._arc_property = 'destination'
+            self._fence_key = destinations_fence_key(self.arc_class, origin)
         else:
             self._arc_property = 'origin'
-            self._cache_key = origins_cache_key(self.arc_class, destination)
+            self._cache_key = origins_cache_key(self.arc_class, destination, order)
+            self._generation_key = origins_generation_key(self.arc_class, destination)
+            self._fence_key = origins_fence_key(self.arc_class, destination)
+        if not self.arc_class.stale_window or (origin and self.arc_class.consistent_destinations):
+            self._fence_key = None  # destinations ancestor queries are strongly consistent
         self._node_cached_keys = None
+        self._fenced = False
+        # write behind operations are only visible for origins on unfiltered searches
+        self._pending_key = None
+        if with_pending and origin and not filters:
+            self._pending_key = pending_arcs_cache_key(self.arc_class, origin)
+        self._pending = None
+        self._order_values = None
+        # supernodes origins are sharded on unfiltered searches
+        self._sharded_key = None
+        if destination and not filters and self.arc_class.sharding_threshold is not None:
+            self._sharded_key = origins_sharded_key(self.arc_class, destination)
+        self._sharded_origins = None
+        # searches on a creation time window don't use the full adjacency list cache
+        self._window = None
+        if since is not None:
+            self._window = _CreationWindow(self.arc_class, origin or destination, self._arc_property, since, until,
+                                           order, filters, self._fence_key)
         self._required_relations = relations
+        self._lazy_relations = lazy_relations
+        self._compact = compact
+        self._properties = properties
+        self.limit = limit
+        self.offset = offset
+        self.more = None
 
     def set_up(self):
-        try:
-            self._node_cached_keys = memcache.get(self._cache_key)
-        except:
-            pass  # If memcache fails, do nothing
-        if not self._node_cached_keys:
+        if self._window:
+            return self._window.set_up()
+        if self._filters:
+            self._cache_key = self._filtered_cache_key()
+        cached = cache.get_multi([k for k in (self._cache_key, self._pending_key, self._sharded_key,
+                                              self._fence_key) if k])
+        self._node_cached_keys = _cached_adjacency(cached.get(self._cache_key))
+        self._pending = cached.get(self._pending_key)
+        if self._pending_placed_by_values():
+            self._node_cached_keys = None  # cached lists lack the order values needed to place pending creations
+        self._fenced = self._fence_key in cached
+        if cached.get(self._sharded_key):
+            self._sharded_origins = _ShardedOrigins(self.arc_class, self.destination, self._order, not self._fenced)
+        if self._sharded_origins:
+            self._sharded_origins.set_up()
+        elif self._node_cached_keys is None:
             super(ArcNodeSearchBase, self).set_up()
 
+    def _fetch_options(self):
+        if self._filters:
+            return super(ArcNodeSearchBase, self)._fetch_options()  # filters may have equalities on neighbor property
+        return {'projection': adjacency_projection(self.arc_class, self._arc_property, self._order)}
+
+    def _filtered_cache_key(self):
+        generation = cache.get(self._generation_key)
+        if generation is None:
+            generation = random.getrandbits(32)
+            if not cache.add(self._generation_key, generation):
+                generation = cache.get(self._generation_key)
+        if generation is None:
+            return None  # filtered results can not be cached without knowing its generation
+        return filtered_cache_key(self._cache_key, generation, self._filters)
+
     def do_business(self):
         cached_keys = self._node_cached_keys
-        if not cached_keys:
+        self.result = []
+        if self._window:
+            cached_keys = self._window.get_result()
+        elif self._sharded_origins:
+            cached_keys = self._sharded_origins.get_result()
+        elif cached_keys is None:
             super(ArcNodeSearchBase, self).do_business()
             cached_keys = [getattr(arc, self._arc_property) for arc in self.result]
+            if self._pending_placed_by_values():
+                prop, _ = order_value(self.arc_class, self._order)
+                self._order_values = {getattr(arc, self._arc_property): getattr(arc, prop._code_name)
+                                      for arc in self.result}
+            if self._fenced:
+                pass  # query may not contain arcs written on last stale_window seconds, so it is not cached
+            elif self._sharded_key and len(cached_keys) >= self.arc_class.sharding_threshold:
+                _ShardedOrigins.promote(self.arc_class, self.destination, self._order, self.result)
+            elif self._cache_key:
+                _cache_adjacency_lists([(self.arc_class, self._cache_key, cached_keys)])
             self.result = []
-            if cached_keys:
-                try:
-                    memcache.set(self._cache_key, cached_keys)
-                except:
-                    pass  # If memcache fails, do nothing
+        adjacency = cached_keys
+        if self._pending:
+            position = self._creation_position() if self._has_pending_creations() else None
+            cached_keys = apply_pending(cached_keys, self._pending, position)
         if cached_keys:
-            self.result = ndb.get_multi(cached_keys)
-        self.result = [e for e in self.result if e]
+            self.result, missing = self._fetch_page(cached_keys)
+            if missing:
+                self._repair(adjacency, missing)
         _fill_relations_helper(self)
 
+    def _has_pending_creations(self):
+        return bool(self._pending) and any(operation == CREATE for _, operation, _ in self._pending)
+
+    def _pending_placed_by_values(self):
+        """
+        Tell if pending creations are placed by an ordering property other than creation
+        """
+        return self._has_pending_creations() and order_value(self.arc_class, self._order)[0]._code_name != 'creation'
+
+    def _creation_position(self):
+        """
+        Return function giving the index of a pending creation on node keys sorted by search ordering. Created arcs are
+        the newest ones and have default values for other properties, so they follow arcs with equal values
+        """
+        prop, descending = order_value(self.arc_class, self._order)
+        if prop._code_name == 'creation':
+            return (lambda node_keys, destination: 0) if descending else None
+        value = getattr(self.arc_class(), prop._code_name)
+        order_values = self._order_values or {}
+
+        def position(node_keys, destination):
+            for i, key in enumerate(node_keys):
+                other = order_values.get(key, value)
+                if (other < value) if descending else (other > value):
+                    return i
+            return len(node_keys)
+
+        return position
+
+    def _repair(self, adjacency, missing):
+        """
+        Rewrite cached adjacency list without missing nodes, and schedule the deletion of arcs pointing to them
+        """
+        arc_class = self.arc_class
+        if self._node_cached_keys is not None and not self._window and not self._sharded_origins:
+            missing_set = set(missing)
+            repaired = [k for k in adjacency if k not in missing_set] or EMPTY_ADJACENCY
+            # entry is left as it is if it was invalidated or rewritten since it was read
+            cache.cas_update(self._cache_key, lambda current: repaired if current == adjacency else None,
+                             time=arc_class.cache_ttl)
+        if arc_class.dangling_cleanup_queue:
+            node_key = to_node_key(self.origin or self.destination)
+            guards = {k: dangling_cleanup_key(arc_class, *((node_key, k) if self._arc_property == 'destination'
+                                                           else (k, node_key)))
+                      for k in missing}
+            scheduled = cache.incr_multi(guards.values(), time=arc_class.dangling_cleanup_guard)
+            missing = [k for k in missing if scheduled.get(guards[k], 1) == 1]  # all of them if memcache fails
+            if missing:
+                deferred.defer(_delete_dangling_arcs, arc_class.__name__, self._arc_property, node_key, missing,
+                               _queue=arc_class.dangling_cleanup_queue)
+
+    def _fetch_page(self, keys):
+        """
+        Return existing nodes on page of keys and the missing keys found. Missing nodes are replaced by the following
+        keys, so pages keep limit nodes while there are keys left
+        """
+        start = self.offset
+        end = None if self.limit is None else self.offset + self.limit
+        nodes = []
+        missing = []
+        while True:
+            page = keys[start:end]
+            fetched = get_records(page, self._properties) if self._compact else ndb.get_multi(page)
+            for key, node in izip(page, fetched):
+                if node is None:
+                    missing.append(key)
+                else:
+                    nodes.append(node)
+            if end is None or len(nodes) >= self.limit or end >= len(keys):
+                break
+            start, end = end, end + self.limit - len(nodes)
+        self.more = end is not None and len(keys) > end
+        return nodes, missing
+
 
 class DestinationsSearch(ArcNodeSearchBase):
-    def __init__(self, origin, relations=None):
-        super(DestinationsSearch, self).__init__(origin, relations=relations)
+    def __init__(self, origin, relations=None, order=None, limit=None, offset=0, filters=None, lazy_relations=False,
+                 compact=False, properties=None, with_pending=False, since=None, until=None):
+        super(DestinationsSearch, self).__init__(origin, relations=relations, order=order, limit=limit, offset=offset,
+                                                 filters=filters, lazy_relations=lazy_relations, compact=compact,
+                                                 properties=properties, with_pending=with_pending, since=since,
+                                                 until=until)
 
 
 class SingleDestinationSearch(DestinationsSearch):
+    def __init__(self, origin, relations=None, order=None, filters=None, lazy_relations=False, compact=False,
+                 properties=None):
+        super(SingleDestinationSearch, self).__init__(origin, relations, order, limit=1, filters=filters,
+                                                      lazy_relations=lazy_relations, compact=compact,
+                                                      properties=properties)
+
     def do_business(self):
         DestinationsSearch.do_business(self)
         self.result = self.result[0] if self.result else None
 
 
 class OriginsSearch(ArcNodeSearchBase):
-    def __init__(self, destination, relations=None):
-        super(OriginsSearch, self).__init__(destination=destination, relations=relations)
+    def __init__(self, destination, relations=None, order=None, limit=None, offset=0, filters=None,
+                 lazy_relations=False, compact=False, properties=None, since=None, until=None):
+        super(OriginsSearch, self).__init__(destination=destination, relations=relations, order=order, limit=limit,
+                                            offset=offset, filters=filters, lazy_relations=lazy_relations,
+                                            compact=compact, properties=properties, since=since, until=until)
 
 
 class SingleOriginSearch(OriginsSearch):
+    def __init__(self, destination, relations=None, order=None, filters=None, lazy_relations=False, compact=False,
+                 properties=None):
+        super(SingleOriginSearch, self).__init__(destination, relations, order, limit=1, filters=filters,
+                                                 lazy_relations=lazy_relations, compact=compact,
+                                                 properties=properties)
+
     def do_business(self):
         OriginsSearch.do_business(self)
         self.result = self.result[0] if self.result else None
 
 
+def _cache_adjacency_lists(entries, admission=True):
+    """
+    Cache (arc_class, cache key, node keys) entries following their arc_class cache policy: lists longer than
+    max_cached_length are skipped and, if admission is True, lists are only cached once their miss counter reaches
+    cache_admission_misses. Lists are cached for cache_ttl seconds, empty ones as EMPTY_ADJACENCY
+    """
+    counted = {}
+    by_ttl = {}
+    for arc_class, cache_key, node_keys in entries:
+        if arc_class.max_cached_length is not None and len(node_keys) > arc_class.max_cached_length:
+            continue
+        if admission and arc_class.cache_admission_misses > 1:
+            counted.setdefault(arc_class.cache_admission_window, []).append((arc_class, cache_key, node_keys))
+        else:
+            by_ttl.setdefault(arc_class.cache_ttl, {})[cache_key] = node_keys or EMPTY_ADJACENCY
+    for window, window_entries in counted.iteritems():
+        misses = cache.incr_multi([admission_counter_key(k) for _, k, _ in window_entries], time=window)
+        for arc_class, cache_key, node_keys in window_entries:
+            if misses.get(admission_counter_key(cache_key), 0) >= arc_class.cache_admission_misses:
+                by_ttl.setdefault(arc_class.cache_ttl, {})[cache_key] = node_keys or EMPTY_ADJACENCY
+    for ttl, mapping in by_ttl.iteritems():
+        cache.set_multi(mapping, time=ttl)
+
+
+def _cached_adjacency(value):
+    """
+    Return cached adjacency list, None meaning cache miss
+    """
+    return [] if value == EMPTY_ADJACENCY else value
+
+
+def _adjacency_cache_key(arc_class, direction, node_key):
+    if direction == DESTINATIONS:
+        return destinations_cache_key(arc_class, node_key)
+    return origins_cache_key(arc_class, node_key)
+
+
+def _adjacency_fence_key(arc_class, direction, node_key):
+    if not arc_class.stale_window:
+        return None
+    if direction == DESTINATIONS:
+        return None if arc_class.consistent_destinations else destinations_fence_key(arc_class, node_key)
+    return origins_fence_key(arc_class, node_key)
+
+
+def _adjacency_sharded_key(arc_class, direction, node_key):
+    if direction == ORIGINS and arc_class.sharding_threshold is not None:
+        return origins_sharded_key(arc_class, node_key)
+    return None
+
+
+def _adjacency_query(arc_class, direction, node_key):
+    if direction == DESTINATIONS:
+        return arc_class.find_destinations(node_key)
+    return arc_class.find_origins(node_key)
+
+
+class AdjacencySearch(Command):
+    """
+    Command searching neighbor keys of many (arc_class, direction, node) specs at once, direction being DESTINATIONS
+    or ORIGINS. It uses the same cache entries of DestinationsSearch and OriginsSearch with default ordering: one
+    memcache.get_multi for all specs, concurrent projection queries for misses and one memcache.set_multi for them,
+    following arc classes cache policy. Origins of sharded destinations are read from their shards, and destinations
+    reaching sharding_threshold origins are promoted, as done by OriginsSearch.
+    Result is a dict mapping (arc_class, direction, node key) to the list of neighbor keys
+    """
+
+    def __init__(self, *specs):
+        super(AdjacencySearch, self).__init__()
+        self.specs = [(arc_class, direction, to_node_key(node)) for arc_class, direction, node in specs]
+        self._cache_keys = [_adjacency_cache_key(*spec) for spec in self.specs]
+        self._fence_keys = [_adjacency_fence_key(*spec) for spec in self.specs]
+        self._sharded_keys = [_adjacency_sharded_key(*spec) for spec in self.specs]
+        self._cached = {}
+        self._futures = {}
+        self._sharded = {}
+
+    def set_up(self):
+        optional_keys = filter(None, self._fence_keys + self._sharded_keys)
+        self._cached = cache.get_multi(list(set(self._cache_keys + optional_keys)))
+        for spec, cache_key, fence_key, sharded_key in izip(self.specs, self._cache_keys, self._fence_keys,
+                                                            self._sharded_keys):
+            if cache_key in self._futures or cache_key in self._sharded:
+                continue
+            fenced = fence_key in self._cached
+            if sharded_key and self._cached.get(sharded_key):
+                arc_class, _, node_key = spec
+                self._sharded[cache_key] = _ShardedOrigins(arc_class, node_key, cache=not fenced)
+                self._sharded[cache_key].set_up()
+            elif cache_key not in self._cached:
+                self._futures[cache_key] = (spec, fenced, self._fetch_async(spec))
+
+    _admission = True
+
+    def _fetch_async(self, spec):
+        arc_class, direction, _ = spec
+        arc_property = 'destination' if direction == DESTINATIONS else 'origin'
+        return fetch_projection_async(_adjacency_query(*spec), adjacency_projection(arc_class, arc_property))
+
+    def _query_count(self):
+        """
+        Return the number of queries started by set_up
+        """
+        return len(self._futures) + sum(len(sharded._futures) for sharded in self._sharded.itervalues())
+
+    def do_business(self):
+        found = {k: _cached_adjacency(v) for k, v in self._cached.iteritems()}
+        for cache_key, sharded in self._sharded.iteritems():
+            found[cache_key] = sharded.get_result()
+        to_cache = []
+        for cache_key, ((arc_class, direction, node_key), fenced, future) in self._futures.iteritems():
+            arc_property = 'destination' if direction == DESTINATIONS else 'origin'
+            arcs = future.get_result()
+            node_keys = [getattr(arc, arc_property) for arc in arcs]
+            found[cache_key] = node_keys
+            if fenced:
+                continue
+            if _adjacency_sharded_key(arc_class, direction, node_key) and \
+                    len(node_keys) >= arc_class.sharding_threshold:
+                _ShardedOrigins.promote(arc_class, node_key, None, arcs)
+            else:
+                to_cache.append((arc_class, cache_key, node_keys))
+        if to_cache:
+            _cache_adjacency_lists(to_cache, self._admission)
+        self.result = {spec: found.get(cache_key) or [] for spec, cache_key in izip(self.specs, self._cache_keys)}
+
+
+class FanOutSearch(Command):
+    """
+    Command searching neighbors of a node through many arc classes at once. arc_specs items are arc classes, searched
+    on DESTINATIONS direction, or (arc_class, direction) tuples. Adjacency lists are read with a single
+    AdjacencySearch and neighbor nodes with one deduplicated get_multi.
+    Result is a dict mapping each arc class to its list of neighbor nodes. Arc classes informed on both directions,
+    e.g. [(Follow, DESTINATIONS), (Follow, ORIGINS)] for following and followers, are mapped by (arc_class, direction)
+    """
+
+    def __init__(self, node_or_key_or_id, arc_specs, compact=False, properties=None):
+        super(FanOutSearch, self).__init__()
+        self.node_key = to_node_key(node_or_key_or_id)
+        self.specs = []
+        for spec in arc_specs:
+            arc_class, direction = spec if isinstance(spec, tuple) else (spec, DESTINATIONS)
+            if (arc_class, direction, self.node_key) not in self.specs:
+                self.specs.append((arc_class, direction, self.node_key))
+        arc_classes = [arc_class for arc_class, _, _ in self.specs]
+        self._result_keys = {spec: spec[:2] if arc_classes.count(spec[0]) > 1 else spec[0] for spec in self.specs}
+        self._adjacency_search = AdjacencySearch(*self.specs)
+        self._compact = compact
+        self._properties = properties
+
+    def set_up(self):
+        self._adjacency_search.set_up()
+
+    def do_business(self):
+        self._adjacency_search.do_business()
+        adjacency = self._adjacency_search.result
+        keys = []
+        seen = set()
+        for spec in self.specs:
+            for key in adjacency[spec]:
+                if key not in seen:
+                    seen.add(key)
+                    keys.append(key)
+        nodes = get_records(keys, self._properties) if self._compact else ndb.get_multi(keys)
+        by_key = dict(izip(keys, nodes))
+        self.result = {self._result_keys[spec]: [by_key[k] for k in adjacency[spec] if by_key[k]]
+                       for spec in self.specs}
+
+
+class PathSearch(Command):
+    """
+    Command searching the shortest path connecting origin to destination through arcs of arc_class.
+    It runs a bidirectional breadth first search: destinations are expanded from origin side and origins from
+    destination side, always expanding the smallest frontier with a single AdjacencySearch, and stopping on first meet.
+    Result is the list of node keys from origin to destination, or None if they are not connected in up to max_hops
+    arcs or if more than max_visited nodes were visited
+    """
+    arc_class = None
+
+    def __init__(self, origin, destination, max_hops=4, max_visited=10000):
+        super(PathSearch, self).__init__()
+        self.origin = to_node_key(origin)
+        self.destination = to_node_key(destination)
+        self.max_hops = max_hops
+        self.max_visited = max_visited
+        self.visited = 0
+
+    def do_business(self):
+        if self.origin == self.destination:
+            self.result = [self.origin]
+            return
+        forward_parents = {self.origin: None}
+        backward_children = {self.destination: None}
+        forward_frontier = [self.origin]
+        backward_frontier = [self.destination]
+        hops = 0
+        while forward_frontier and backward_frontier and hops < self.max_hops:
+            hops += 1
+            if len(forward_frontier) <= len(backward_frontier):
+                forward_frontier, meet = self._expand(forward_frontier, DESTINATIONS, forward_parents,
+                                                      backward_children)
+            else:
+                backward_frontier, meet = self._expand(backward_frontier, ORIGINS, backward_children,
+                                                       forward_parents)
+            self.visited = len(forward_parents) + len(backward_children)
+            if meet is not None:
+                self.result = self._path(meet, forward_parents, backward_children)
+                return
+            if self.visited > self.max_visited:
+                return
+
+    def _expand(self, frontier, direction, parents, other_side):
+        cmd = AdjacencySearch(*[(self.arc_class, direction, node) for node in frontier])
+        adjacency = cmd()
+        next_frontier = []
+        for node in frontier:
+            for neighbor in adjacency[(self.arc_class, direction, node)]:
+                if neighbor not in parents:
+                    parents[neighbor] = node
+                    if neighbor in other_side:
+                        return next_frontier, neighbor
+                    next_frontier.append(neighbor)
+        return next_frontier, None
+
+    def _path(self, meet, forward_parents, backward_children):
+        path = []
+        node = meet
+        while node is not None:
+            path.append(node)
+            node = forward_parents[node]
+        path.reverse()
+        node = backward_children[meet]
+        while node is not None:
+            path.append(node)
+            node = backward_children[node]
+        return path
+
+
 class UpdateNode(UpdateCommand):
     def __init__(self, model_key, **form_parameters):
         model_or_key = model_key if isinstance(model_key, ndb.Model) else to_node_key(model_key)
         super(UpdateNode, self).__init__(model_or_key, **form_parameters)
 
+    def commit(self):
+        to_commit = super(UpdateNode, self).commit()
+        if to_commit is not None:
+            forget_node_searches([to_commit.key])
+        return to_commit
+
+
+class UpdateNodes(Command):
+    """
+    Command updating many nodes with _model_form_class. updates is a list of nodes, keys or ids, all updated with
+    form_parameters, or a dict mapping each one to its own form parameters.
+    Nodes are read with one get_multi and valid ones are written with put_multi_async calls of up to put_batch_size
+    nodes. Invalid or missing nodes don't abort the batch: their errors are kept on node_errors dict, keyed by node key.
+    Result is the list of updated nodes
+    """
+    _model_form_class = None
+    put_batch_size = 500
+
+    def __init__(self, updates, **form_parameters):
+        if self._model_form_class is None:
+            raise Exception('Must define _model_form_class, the class inheriting from ModelForm')
+        super(UpdateNodes, self).__init__()
+        if isinstance(updates, dict):
+            updates = updates.iteritems()
+        else:
+            updates = ((node, form_parameters) for node in updates)
+        self.updates = {}
+        self._models = {}
+        for node, parameters in updates:
+            node_key = to_node_key(node)
+            self.updates[node_key] = parameters
+            if isinstance(node, ndb.Model):
+                self._models[node_key] = node
+        self.node_errors = {}
+        self._keys_to_get = [k for k in self.updates if k not in self._models]
+        self._futures = None
+
+    def set_up(self):
+        self._futures = ndb.get_multi_async(self._keys_to_get)
+
+    def do_business(self):
+        self._models.update(izip(self._keys_to_get, [f.get_result() for f in self._futures]))
+        forms = {}
+        self.result = []
+        for node_key, parameters in self.updates.iteritems():
+            model = self._models[node_key]
+            if model is None:
+                self.node_errors[node_key] = {'model': 'Model with key %s does not exist' % node_key}
+                continue
+            # nodes sharing the same parameters are validated once
+            form_key = id(parameters)
+            if form_key not in forms:
+                form = self._model_form_class(**parameters)
+                forms[form_key] = (form, form.validate())
+            form, errors = forms[form_key]
+            if errors:
+                self.node_errors[node_key] = errors
+            else:
+                form.fill_model(model)
+                self.result.append(model)
+
+    def commit(self):
+        models = self.result or []
+        size = self.put_batch_size
+        futures = [f for i in xrange(0, len(models), size) for f in ndb.put_multi_async(models[i:i + size])]
+        [f.get_result() for f in futures]
+        forget_node_searches([m.key for m in models])
+
 
 class DeleteNode(CommandParallel):
     _model_class = None
@@ -467,6 +1487,7 @@ class DeleteNode(CommandParallel):
 
     def commit(self):
         ndb.delete_multi(self.model_keys)
+        forget_node_searches(self.model_keys)
 
 
 class DeleteArcs(ArcSearch):
@@ -476,29 +1497,105 @@ class DeleteArcs(ArcSearch):
         self.__origin = origin
         self._arc_delete_future = None
 
+    def _fetch_options(self):
+        return {'projection': deletion_projection(self.arc_class, self.origin, self.destination)}
+
     def do_business(self):
         super(DeleteArcs, self).do_business()
-
+        self.result = projected_arcs(self.arc_class, self.result, self.origin and to_node_key(self.origin),
+                                     self.destination and to_node_key(self.destination))
         if self.result:
-            futures = ndb.delete_multi_async([arc.key for arc in self.result])
-            cache_keys = []
-            if self.__origin:
-                cache_keys.append(destinations_cache_key(self.arc_class, self.__origin))
-            else:
-                for arc in self.result:
-                    cache_keys.append(destinations_cache_key(self.arc_class, arc.origin))
+            _delete_arcs(self.arc_class, self.result)
 
-            if self.__destination:
-                cache_keys.append(origins_cache_key(self.arc_class, self.__destination))
-            else:
-                for arc in self.result:
-                    cache_keys.append(origins_cache_key(self.arc_class, arc.destination))
-            memcache.delete_multi(cache_keys)
-            [f.get_result() for f in futures]
 
+def _delete_arcs(arc_class, arcs, batch_size=None):
+    """
+    Delete arcs with delete_multi_async calls of up to batch_size keys, invalidating their cache keys once, discarding
+    NodeSearch results memoized for their nodes and notifying arc_class listeners
+    """
+    keys = [arc.key for arc in arcs]
+    batch_size = batch_size or len(keys)
+    futures = [f for i in xrange(0, len(keys), batch_size) for f in ndb.delete_multi_async(keys[i:i + batch_size])]
+    cache_keys = set()
+    fence_keys = {}
+    for arc in arcs:
+        cache_keys.update(arc_cache_keys(arc))
+        fence_keys.update(write_fences(arc_class, arc.origin, arc.destination))
+    invalidate_cache_keys(list(cache_keys), fence_keys)
+    forget_node_searches(set(chain(*[(arc.origin, arc.destination) for arc in arcs])))
+    [f.get_result() for f in futures]
+    for listener in arc_class._listeners:
+        listener.arcs_deleted(arc_class, arcs)
+
+
+def _pair_arcs_async(arc_class, origin, destination):
+    """
+    Start a projection query for arcs from origin to destination, reading only their keys and creation
+    """
+    query = arc_class.query_by_origin_and_destination(origin, destination)
+    return fetch_projection_async(query, deletion_projection(arc_class, origin, destination))
+
+
+class DeleteArcPairs(Command):
+    """
+    Command deleting arc_class arcs of many (origin, destination) pairs. Queries of all pairs are started concurrently,
+    reading only arc keys and creation, and arcs are deleted with delete_multi_async calls of up to delete_batch_size
+    keys. Cache keys of all arcs are invalidated with a single cache.delete_multi.
+    Result is the list of deleted arcs, having only key, origin, destination and creation
+    """
+    arc_class = None
+    delete_batch_size = 500
+
+    def __init__(self, pairs):
+        super(DeleteArcPairs, self).__init__()
+        self.pairs = []
+        seen = set()
+        for origin, destination in pairs:
+            pair = (to_node_key(origin), to_node_key(destination))
+            if pair not in seen:
+                seen.add(pair)
+                self.pairs.append(pair)
+        self._futures = None
+
+    def set_up(self):
+        self._futures = [_pair_arcs_async(self.arc_class, o, d) for o, d in self.pairs]
 
+    def do_business(self):
+        self.result = []
+        for (origin, destination), future in izip(self.pairs, self._futures):
+            self.result.extend(projected_arcs(self.arc_class, future.get_result(), origin, destination))
+        if self.result:
+            _delete_arcs(self.arc_class, self.result, self.delete_batch_size)
 
 
+def _delete_dangling_arcs(arc_class_name, arc_property, node_key, missing_keys):
+    """
+    Delete arc_class_name arcs connecting node_key to missing_keys, arc_property being the side of missing nodes.
+    Nodes created again since the read are kept
+    """
+    arc_class = ndb.Model._kind_map[arc_class_name]
+    missing_keys = [k for k, node in izip(missing_keys, ndb.get_multi(missing_keys)) if node is None]
+    pairs = [(node_key, k) if arc_property == 'destination' else (k, node_key) for k in missing_keys]
+    futures = [_pair_arcs_async(arc_class, o, d) for o, d in pairs]
+    arcs = [arc for (o, d), f in izip(pairs, futures) for arc in projected_arcs(arc_class, f.get_result(), o, d)]
+    if arcs:
+        _delete_arcs(arc_class, arcs)
+
 
+def backfill_origin_shards(arc_class, batch_size=500, queue='default'):
+    """
+    Write again arc_class arcs, batch_size arcs per deferred task, so arcs stored before origin_shard property existed
+    are found by sharded origins queries. Arcs are written without hooks, since their cached lists don't change.
+    Arc classes having arcs stored before origin_shard should only set sharding_threshold after it finishes
+    """
+    deferred.defer(_backfill_origin_shards_task, arc_class.__name__, batch_size, queue, _queue=queue)
 
 
+def _backfill_origin_shards_task(arc_class_name, batch_size, queue, cursor=None):
+    arc_class = ndb.Model._kind_map[arc_class_name]
+    cursor = Cursor(urlsafe=cursor) if cursor else None
+    arcs, cursor, more = arc_class.query().fetch_page(batch_size, start_cursor=cursor)
+    if more and cursor:
+        deferred.defer(_backfill_origin_shards_task, arc_class_name, batch_size, queue, cursor.urlsafe(), _queue=queue)
+    ctx = ndb.get_context()
+    ndb.Future.wait_all([ctx.put(arc) for arc in arcs])
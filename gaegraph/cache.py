@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+"""
+Memcache access for gaegraph, guarded by a circuit breaker.
+
+After failure_threshold consecutive failed or slow calls the breaker opens, and memcache is bypassed for cool_down
+seconds: reads miss and writes are skipped, so requests don't keep paying memcache timeouts during brownouts. Then a
+single call is tried: if it succeeds the breaker closes, otherwise it opens again. Besides exceptions, writes and
+deletions failing through their return values, as memcache client mostly reports errors, are counted as failures.
+Invalidations not done meanwhile are queued and replayed when the breaker closes. If more than max_queued_invalidations
+are queued, the global generation is bumped instead, changing the prefix of every gaegraph cache key. Write fences not
+set meanwhile are queued too, and set for their remaining seconds when the breaker closes.
+Breaker state is kept per instance, and metrics returns its counters.
+"""
+from __future__ import absolute_import, unicode_literals
+from itertools import izip
+import logging
+import math
+import threading
+import time
+
+from google.appengine.api import memcache
+
+GENERATION_KEY = 'gaegraph|generation'
+GENERATION_REFRESH = 10  # seconds an instance keeps using the generation it has read
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker(object):
+    def __init__(self, failure_threshold=5, slow_call_seconds=0.25, cool_down=30, max_queued_invalidations=1000):
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.cool_down = cool_down
+        self.max_queued_invalidations = max_queued_invalidations
+        self._lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._consecutive_failures = 0
+            self._opened_at = None
+            self._trying = False
+            self._queued = set()
+            self._overflowed = False
+            self._queued_fences = {}  # fence key: expiration timestamp
+            self._generation = None
+            self._generation_read_at = None
+            self._counters = {'failures': 0, 'slow_calls': 0, 'trips': 0, 'bypassed_calls': 0,
+                              'degraded_seconds': 0.0, 'replayed_invalidations': 0, 'replayed_fences': 0,
+                              'generation_bumps': 0}
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return CLOSED
+        if self._trying or time.time() - self._opened_at >= self.cool_down:
+            return HALF_OPEN
+        return OPEN
+
+    def _allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if not self._trying and time.time() - self._opened_at >= self.cool_down:
+                self._trying = True  # only one call tries memcache when cool down is over
+                return True
+            self._counters['bypassed_calls'] += 1
+            return False
+
+    def _record(self, success, elapsed):
+        replay = False
+        with self._lock:
+            slow = elapsed > self.slow_call_seconds
+            if slow:
+                self._counters['slow_calls'] += 1
+            if not success:
+                self._counters['failures'] += 1
+            if success and not slow:
+                if self._opened_at is not None:
+                    self._counters['degraded_seconds'] += time.time() - self._opened_at
+                    self._opened_at = None
+                    logging.info('gaegraph cache circuit closed')
+                self._consecutive_failures = 0
+                replay = bool(self._queued or self._overflowed or self._queued_fences)
+            else:
+                self._consecutive_failures += 1
+                if self._opened_at is not None:
+                    self._opened_at = time.time()  # trial call failed, so cool down again
+                elif self._consecutive_failures >= self.failure_threshold:
+                    self._opened_at = time.time()
+                    self._counters['trips'] += 1
+                    logging.warning('gaegraph cache circuit opened after %s failures', self._consecutive_failures)
+            self._trying = False
+        if replay:
+            self._replay()
+
+    def call(self, method, *args, **kwargs):
+        """
+        Call memcache method if breaker allows it. Returns (called successfully, result)
+        """
+        return self.checked_call(method, None, *args, **kwargs)
+
+    def checked_call(self, method, failed, *args, **kwargs):
+        """
+        Same as call, failed being a function telling if method result reports a failure, or None if only exceptions do
+        """
+        if not self._allow():
+            return False, None
+        start = time.time()
+        try:
+            result = method(*args, **kwargs)
+        except Exception as e:
+            self._record(False, time.time() - start)
+            logging.warning('gaegraph cache call failed: %s', e)
+            return False, None
+        if failed is not None and failed(result):
+            self._record(False, time.time() - start)
+            logging.warning('gaegraph cache call %s failed returning %r', getattr(method, '__name__', method), result)
+            return False, result
+        self._record(True, time.time() - start)
+        return True, result
+
+    def queue_invalidations(self, keys):
+        with self._lock:
+            if not self._overflowed:
+                self._queued.update(keys)
+                if len(self._queued) > self.max_queued_invalidations:
+                    self._overflowed = True
+                    self._queued = set()
+
+    def queue_fences(self, fence_keys):
+        """
+        Queue fences not set, fence_keys mapping them to their expiration seconds. Expired fences are dropped
+        """
+        now = time.time()
+        with self._lock:
+            self._queued_fences = {k: expires for k, expires in self._queued_fences.iteritems() if expires > now}
+            for key, seconds in fence_keys.iteritems():
+                self._queued_fences[key] = max(self._queued_fences.get(key, 0), now + seconds)
+
+    def _replay(self):
+        with self._lock:
+            keys, overflowed, fences = list(self._queued), self._overflowed, self._queued_fences
+            self._queued = set()
+            self._overflowed = False
+            self._queued_fences = {}
+        if overflowed:
+            self._bump_generation()
+        elif keys:
+            self._counters['replayed_invalidations'] += len(keys)
+            delete_multi(keys)
+        now = time.time()
+        remaining = {k: int(math.ceil(expires - now)) for k, expires in fences.iteritems() if expires > now}
+        if remaining:
+            self._counters['replayed_fences'] += len(remaining)
+            set_fences(remaining)
+
+    def _bump_generation(self):
+        ok, generation = self.checked_call(memcache.incr, _missing, GENERATION_KEY, initial_value=0)
+        if ok and generation is not None:
+            with self._lock:
+                self._generation = generation
+                self._generation_read_at = time.time()
+                self._counters['generation_bumps'] += 1
+        else:
+            with self._lock:
+                self._overflowed = True  # try again on next recovery
+
+    def generation(self):
+        now = time.time()
+        if self._generation_read_at is None or now - self._generation_read_at >= GENERATION_REFRESH:
+            ok, generation = self.call(memcache.get, GENERATION_KEY)
+            if ok:
+                with self._lock:
+                    self._generation = generation or 0
+                    self._generation_read_at = now
+        return self._generation or 0
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._counters)
+            if self._opened_at is not None:
+                metrics['degraded_seconds'] += time.time() - self._opened_at
+            metrics['state'] = self.state
+            metrics['queued_invalidations'] = len(self._queued)
+            metrics['queued_fences'] = len(self._queued_fences)
+            metrics['consecutive_failures'] = self._consecutive_failures
+        return metrics
+
+
+def _not_done(result):
+    return not result
+
+
+def _missing(result):
+    return result is None
+
+
+def _has_failed_keys(failed_keys):
+    return bool(failed_keys)
+
+
+breaker = CircuitBreaker()
+
+
+def metrics():
+    return breaker.metrics()
+
+
+def _key(key):
+    generation = breaker.generation()
+    return '%s|%s' % (generation, key) if generation else key
+
+
+def _keys(keys):
+    generation = breaker.generation()
+    return ['%s|%s' % (generation, k) for k in keys] if generation else list(keys)
+
+
+def get(key):
+    ok, value = breaker.call(memcache.get, _key(key))
+    return value if ok else None
+
+
+def get_multi(keys):
+    """
+    Return a dict mapping found keys to their values. Nothing is found while breaker is open
+    """
+    prefixed = dict(izip(_keys(keys), keys))
+    ok, found = breaker.call(memcache.get_multi, prefixed.keys())
+    if not ok:
+        return {}
+    return {prefixed[k]: v for k, v in found.iteritems()}
+
+
+def set_value(key, value, time=0):
+    ok, result = breaker.checked_call(memcache.set, _not_done, _key(key), value, time=time)
+    return ok and result
+
+
+def set_multi(mapping, time=0):
+    """
+    Set all keys of mapping. Return True if all of them were set
+    """
+    ok, _ = breaker.checked_call(memcache.set_multi, _has_failed_keys,
+                                 dict(izip(_keys(mapping.iterkeys()), mapping.itervalues())), time=time)
+    return ok
+
+
+def set_fences(fence_keys):
+    """
+    Set write fences, fence_keys mapping them to their expiration seconds. Fences not set, because memcache fails or
+    breaker is open, are queued and set for their remaining seconds once memcache recovers
+    """
+    by_seconds = {}
+    for fence_key, seconds in fence_keys.iteritems():
+        by_seconds.setdefault(seconds, {})[fence_key] = True
+    for seconds, mapping in by_seconds.iteritems():
+        if not set_multi(mapping, time=seconds):
+            breaker.queue_fences(dict.fromkeys(mapping, seconds))
+
+
+def add(key, value, time=0):
+    ok, result = breaker.call(memcache.add, _key(key), value, time=time)
+    return ok and result
+
+
+def incr(key, initial_value=0):
+    """
+    Increment counter of key, created with initial_value if missing. Return its new value, None if memcache fails or
+    breaker is open
+    """
+    ok, counter = breaker.checked_call(memcache.incr, _missing, _key(key), initial_value=initial_value)
+    return counter if ok else None
+
+
+def incr_multi(keys, time=0):
+    """
+    Increment counters of keys, created with 0 and expiring after time seconds if missing. Return a dict mapping keys
+    to their new counters, empty if memcache fails or breaker is open
+    """
+    prefixed = dict(izip(_keys(keys), keys))
+    ok, _ = breaker.call(memcache.add_multi, dict.fromkeys(prefixed, 0), time=time)
+    if not ok:
+        return {}
+    ok, counters = breaker.call(memcache.offset_multi, dict.fromkeys(prefixed, 1))
+    if not ok:
+        return {}
+    return {prefixed[k]: v for k, v in counters.iteritems() if v is not None}
+
+
+def delete_multi(keys):
+    """
+    Delete keys, queuing them to be deleted once memcache recovers if it fails or breaker is open
+    """
+    if not keys:
+        return
+    ok, result = breaker.checked_call(memcache.delete_multi, _not_done, _keys(keys))
+    if not (ok and result):
+        breaker.queue_invalidations(keys)
+
+
+def cas_update(key, update, time=0, retries=10):
+    """
+    Update key value with compare and set, so concurrent updates are not lost. update is called with the current value,
+    None if it is missing, and returns the new one, or None to leave key as it is. Returns True if value was updated
+    """
+    key = _key(key)
+    client = memcache.Client()
+    for _ in xrange(retries):
+        ok, value = breaker.call(client.gets, key)
+        if not ok:
+            return False
+        new_value = update(value)
+        if new_value is None:
+            return False
+        if value is None:
+            ok, stored = breaker.call(client.add, key, new_value, time=time)
+        else:
+            ok, stored = breaker.call(client.cas, key, new_value, time=time)
+        if not ok:
+            return False
+        if stored:
+            return True
+    return False
@@ -1,8 +1,18 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
-from google.appengine.api import memcache
+import calendar
+from contextlib import contextmanager
+from datetime import datetime
+import hashlib
+import logging
+import threading
+import zlib
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import PropertyOrder
 from google.appengine.ext import ndb
 from google.appengine.ext.ndb.polymodel import PolyModel
+from gaegraph import cache
+from gaegraph.records import NodeRecord
 
 
 class Node(PolyModel):
@@ -17,70 +27,510 @@ class Node(PolyModel):
         return cls.query().order(-cls.creation)
 
     def to_dict(self, include=None, exclude=None):
-        if include is None or 'class_' not in include:
-            exclude = exclude or []
-            exclude.append('class_')
-
-        dct = super(Node, self).to_dict(include=include, exclude=exclude)
-        if include:
-            if 'id' in include and self.key:
-                dct['id'] = str(self.key.id())
-        elif (exclude is None or 'id' not in exclude) and self.key:
-            dct['id'] = str(self.key.id())
+        return dict_plan(self.__class__, include, exclude).to_dict(self)
+
+    def set_lazy_relation(self, name, loader):
+        """
+        Set a relation resolved only on first access of attribute name, when loader is called with no arguments
+        """
+        self.__dict__.setdefault('_pending_relations', {})[name] = loader
+        self.__dict__.pop(name, None)
+
+    def __getattr__(self, name):
+        pending_relations = self.__dict__.get('_pending_relations')
+        if pending_relations and name in pending_relations:
+            value = pending_relations.pop(name)()
+            setattr(self, name, value)
+            return value
+        raise AttributeError("'%s' object has no attribute '%s'" % (self.__class__.__name__, name))
+
+
+class DictPlan(object):
+    """
+    Properties to be serialized for a Node class and an include/exclude spec.
+    'class_' is only serialized if included. 'id' is serialized as string if included or not excluded.
+    Get plans with dict_plan, so they are computed only once per class and spec.
+    """
+
+    def __init__(self, model_class, include=None, exclude=None):
+        self.properties = []
+        for prop in model_class._properties.itervalues():
+            name = prop._code_name
+            if include is not None and name not in include:
+                continue
+            if exclude is not None and name in exclude:
+                continue
+            if name == 'class_' and (include is None or name not in include):
+                continue
+            self.properties.append((name, prop))
+        self.with_id = 'id' in include if include else (exclude is None or 'id' not in exclude)
+
+    def to_dict(self, node):
+        if node._projection:
+            dct = {}
+            for name, prop in self.properties:
+                try:
+                    dct[name] = prop._get_for_dict(node)
+                except ndb.UnprojectedPropertyError:
+                    pass
+        else:
+            dct = {name: prop._get_for_dict(node) for name, prop in self.properties}
+        if self.with_id and node.key:
+            dct['id'] = str(node.key.id())
         return dct
 
 
+_dict_plans = {}
+
+
+def _spec(names):
+    return None if names is None else frozenset(names)
+
+
+def dict_plan(model_class, include=None, exclude=None):
+    plan_key = (model_class, _spec(include), _spec(exclude))
+    plan = _dict_plans.get(plan_key)
+    if plan is None:
+        plan = DictPlan(model_class, include, exclude)
+        _dict_plans[plan_key] = plan
+    return plan
+
+
 def to_node_key(arg):
     if isinstance(arg, ndb.Key):
         return arg
-    elif isinstance(arg, ndb.Model):
+    elif isinstance(arg, (ndb.Model, NodeRecord)):
         return arg.key
     return ndb.Key(Node, long(arg))
 
 
+class ArcListener(object):
+    """
+    Base class for objects notified when arcs are created or deleted. Register instances on Arc subclasses
+    _listeners attribute. Creations are notified after each put, or once for all arcs created inside a
+    batch_invalidation block, and deletions by DeleteArcs commands. Puts of already stored arcs are not notified
+    """
+
+    def arcs_created(self, arc_class, arcs):
+        pass
+
+    def arcs_deleted(self, arc_class, arcs):
+        pass
+
+
 class Arc(PolyModel):
+    _listeners = ()
+    # Origins of a destination with at least sharding_threshold arcs are cached on origin_shards entries. Each write
+    # invalidates only the entry of its origin shard, so reads of supernodes keep hitting cache on the others.
+    # Sharding is disabled by default: arcs stored before origin_shard existed must be written again with
+    # backfill_origin_shards before setting it, e.g. to 1000
+    origin_shards = 16
+    sharding_threshold = None
+    # If True, arcs are stored on origin's entity group, so destinations are read with strongly consistent ancestor
+    # queries. Writes of arcs from the same origin are then limited to the entity group rate, about one per second.
+    # Arcs stored before enabling it are not found by ancestor queries, so they must be written again
+    consistent_destinations = False
+    # Seconds after an arc write during which eventually consistent adjacency query results are not cached, since they
+    # may not contain it yet. None disables the guard
+    stale_window = None
+    # Searches on creation time windows cache closed buckets of creation_bucket_seconds for creation_bucket_ttl seconds
+    creation_bucket_seconds = 3600
+    creation_bucket_ttl = 86400
+    # Full adjacency lists are cached for cache_ttl seconds, 0 meaning no expiration, and lists longer than
+    # max_cached_length are not cached. A list is only cached after cache_admission_misses misses on the last
+    # cache_admission_window seconds, so rarely read nodes don't evict hot ones
+    cache_ttl = 0
+    max_cached_length = None
+    cache_admission_misses = 1
+    cache_admission_window = 300
+    # Searches finding deleted nodes defer the deletion of arcs pointing to them on this queue. None disables it.
+    # Deletion is deferred once every dangling_cleanup_guard seconds for the same arcs
+    dangling_cleanup_queue = 'default'
+    dangling_cleanup_guard = 600
+
     def __init__(self, origin=None, destination=None, **kwargs):
         if origin:
             origin = to_node_key(origin)
         if destination:
             destination = to_node_key(destination)
+        if origin and self.consistent_destinations and not ('key' in kwargs or 'parent' in kwargs or 'id' in kwargs):
+            kwargs['parent'] = origin
         PolyModel.__init__(self, origin=origin, destination=destination, **kwargs)
 
     creation = ndb.DateTimeProperty(auto_now_add=True)
     origin = ndb.KeyProperty(Node, required=True)
     destination = ndb.KeyProperty(Node, required=True)
+    origin_shard = ndb.ComputedProperty(lambda self: origin_shard(self.__class__, self.origin))
 
     @classmethod
     def default_order(cls):
         return cls.creation
 
     @classmethod
-    def find_destinations(cls, node):
+    def orderings(cls):
+        """
+        Named orderings available for adjacency queries. Each one has its own query and cache entry.
+        Override it on subclasses to add custom rankings, e.g.: {'weight': -cls.weight}
+        """
+        return {'creation': cls.creation, 'creation_desc': -cls.creation}
+
+    @classmethod
+    def order_for(cls, order=None):
+        if order is None:
+            return cls.default_order()
+        orderings = cls.orderings()
+        if order not in orderings:
+            raise Exception('%s has no ordering named %s' % (cls.__name__, order))
+        return orderings[order]
+
+    @classmethod
+    def find_destinations(cls, node, order=None, filters=None):
         node = to_node_key(node)
-        return cls.query(cls.origin == node).order(cls.default_order())
+        if cls.consistent_destinations:
+            return cls.query(*(filters or ()), ancestor=node).order(cls.order_for(order))
+        return cls.query(cls.origin == node, *(filters or ())).order(cls.order_for(order))
 
     @classmethod
-    def query_by_origin_and_destination(cls, origin, destination):
+    def query_by_origin_and_destination(cls, origin, destination, order=None, filters=None):
         origin = to_node_key(origin)
         destination = to_node_key(destination)
-        return cls.query(cls.origin == origin, cls.destination == destination).order(cls.default_order())
+        if cls.consistent_destinations:
+            return cls.query(cls.destination == destination, *(filters or ()), ancestor=origin).order(
+                cls.order_for(order))
+        return cls.query(cls.origin == origin, cls.destination == destination, *(filters or ())).order(
+            cls.order_for(order))
 
     @classmethod
-    def find_origins(cls, node):
+    def find_origins(cls, node, order=None, filters=None):
         node = to_node_key(node)
-        return cls.query(cls.destination == node).order(cls.default_order())
+        return cls.query(cls.destination == node, *(filters or ())).order(cls.order_for(order))
 
     def _pre_put_hook(self):
         if hasattr(self, 'key'):
-            origins_key = origins_cache_key(self.__class__, self.destination)
-            destinations_key = destinations_cache_key(self.__class__, self.origin)
-            memcache.delete_multi([origins_key, destinations_key])
+            invalidate_cache_keys(arc_cache_keys(self), write_fences(self.__class__, self.origin, self.destination))
+
+    def _prepare_for_put(self):
+        self._created = self.creation is None  # creation is set on first put, so later puts are updates
+        super(Arc, self)._prepare_for_put()
+
+    def _post_put_hook(self, future):
+        if self._listeners and self._created and future.get_exception() is None:
+            _notify_created(self.__class__, [self])
+
+
+_local = threading.local()
+
+
+def invalidate_cache_keys(cache_keys, fence_keys=None):
+    """
+    Delete adjacency cache keys and set write fences, or collect them if running inside a batch_invalidation block.
+    fence_keys is a dict mapping fence keys to its expiration seconds, as returned by write_fences
+    """
+    collected = getattr(_local, 'invalidated_keys', None)
+    if collected is None:
+        cache.delete_multi(cache_keys)
+        if fence_keys:
+            cache.set_fences(fence_keys)
+    else:
+        collected.update(cache_keys)
+        if fence_keys:
+            _local.fences.update(fence_keys)
+
+
+def _notify_created(arc_class, arcs):
+    """
+    Notify arc_class listeners of created arcs, or collect them if running inside a batch_invalidation block
+    """
+    collected = getattr(_local, 'created_arcs', None)
+    if collected is None:
+        for listener in arc_class._listeners:
+            listener.arcs_created(arc_class, arcs)
+    else:
+        collected.setdefault(arc_class, []).extend(arcs)
+
+
+@contextmanager
+def batch_invalidation():
+    """
+    Context manager for bulk writes: cache keys invalidated by arcs written inside the block are deleted with a
+    single cache.delete_multi when it exits, and their write fences are set once. Arcs created inside the block are
+    notified to listeners once per arc class, if it exits without errors
+    """
+    previous = getattr(_local, 'invalidated_keys', None)
+    previous_fences = getattr(_local, 'fences', None)
+    previous_created = getattr(_local, 'created_arcs', None)
+    collected = set()
+    fences = {}
+    created = {}
+    _local.invalidated_keys = collected
+    _local.fences = fences
+    _local.created_arcs = created
+    succeeded = False
+    try:
+        yield collected
+        succeeded = True
+    finally:
+        _local.invalidated_keys = previous
+        _local.fences = previous_fences
+        _local.created_arcs = previous_created
+        if previous is not None:
+            previous.update(collected)
+            previous_fences.update(fences)
+            if succeeded:
+                for arc_class, arcs in created.iteritems():
+                    previous_created.setdefault(arc_class, []).extend(arcs)
+        else:
+            if collected:
+                cache.delete_multi(list(collected))
+            if fences:
+                cache.set_fences(fences)
+            if succeeded:
+                for arc_class, arcs in created.iteritems():
+                    _notify_created(arc_class, arcs)
+
+
+def destinations_cache_key(arc_cls, origin, order=None):
+    key = arc_cls.__name__ + str(to_node_key(origin).id())
+    return key if order is None else '%s:%s' % (key, order)
+
+
+def origins_cache_key(arc_cls, destination, order=None):
+    return 'o' + destinations_cache_key(arc_cls, destination, order)
+
+
+def _order_names(arc_cls):
+    return [None] + sorted(arc_cls.orderings().iterkeys())
+
+
+def destinations_cache_keys(arc_cls, origin):
+    """
+    Return origin's destinations cache keys to be invalidated: one per arc_cls ordering plus filters generation
+    """
+    keys = [destinations_cache_key(arc_cls, origin, order) for order in _order_names(arc_cls)]
+    keys.append(destinations_generation_key(arc_cls, origin))
+    return keys
+
+
+def origins_cache_keys(arc_cls, destination, origin=None):
+    """
+    Return destination's origins cache keys to be invalidated: one per arc_cls ordering plus filters generation.
+    If origin is informed, keys of its shard are included, for the case destination is sharded
+    """
+    order_names = _order_names(arc_cls)
+    keys = [origins_cache_key(arc_cls, destination, order) for order in order_names]
+    keys.append(origins_generation_key(arc_cls, destination))
+    if origin is not None:
+        shard = origin_shard(arc_cls, origin)
+        keys.extend(origins_shard_cache_key(arc_cls, destination, shard, order) for order in order_names)
+    return keys
+
+
+def arc_cache_keys(arc):
+    """
+    Return all cache keys to be invalidated when arc is written or deleted
+    """
+    arc_cls = arc.__class__
+    keys = origins_cache_keys(arc_cls, arc.destination, arc.origin)
+    keys.extend(destinations_cache_keys(arc_cls, arc.origin))
+    if arc.creation:  # new arcs are created on current bucket, which is not cached
+        bucket = creation_bucket(arc_cls, arc.creation)
+        keys.append(destinations_bucket_cache_key(arc_cls, arc.origin, bucket))
+        keys.append(origins_bucket_cache_key(arc_cls, arc.destination, bucket))
+    return keys
+
+
+def to_timestamp(dt):
+    return calendar.timegm(dt.utctimetuple())
+
+
+def creation_bucket(arc_cls, creation):
+    """
+    Return the timestamp where the creation bucket containing creation starts
+    """
+    size = arc_cls.creation_bucket_seconds
+    return to_timestamp(creation) // size * size
+
+
+def bucket_datetime(timestamp):
+    return datetime.utcfromtimestamp(timestamp)
+
+
+def destinations_bucket_cache_key(arc_cls, origin, bucket):
+    return '%s|t%d:%d' % (destinations_cache_key(arc_cls, origin), arc_cls.creation_bucket_seconds, bucket)
+
+
+def origins_bucket_cache_key(arc_cls, destination, bucket):
+    return 'o' + destinations_bucket_cache_key(arc_cls, destination, bucket)
+
+
+def admission_counter_key(cache_key):
+    return cache_key + '|m'
+
+
+def dangling_cleanup_key(arc_cls, origin, destination):
+    """
+    Return the key counting deferred deletions of arcs from origin to destination, one of them being missing
+    """
+    return '%s|d%s' % (destinations_cache_key(arc_cls, origin), to_node_key(destination).id())
+
+
+def origin_shard(arc_cls, origin):
+    """
+    Return the shard of destination's origins where origin is kept, from 0 to arc_cls.origin_shards - 1
+    """
+    origin_id = unicode(to_node_key(origin).id()).encode('utf-8')
+    return (zlib.crc32(origin_id) & 0xffffffff) % arc_cls.origin_shards
+
+
+def origins_shard_cache_key(arc_cls, destination, shard, order=None):
+    return '%s|s%d' % (origins_cache_key(arc_cls, destination, order), shard)
+
+
+def origins_sharded_key(arc_cls, destination):
+    """
+    Return the key flagging destination's origins as sharded. It is not invalidated by writes
+    """
+    return origins_cache_key(arc_cls, destination) + '|sharded'
+
+
+def order_value(arc_cls, order=None):
+    """
+    Return (property, descending) for arc_cls ordering named order, used to merge sorted origin shards
+    """
+    order = arc_cls.order_for(order)
+    if isinstance(order, ndb.Property):
+        return order, False
+    if isinstance(order, PropertyOrder):
+        return arc_cls._properties[order.prop], order.direction == PropertyOrder.DESCENDING
+    raise Exception('%s ordering %s has more than one property' % (arc_cls.__name__, order))
+
+
+def arc_projection(arc_cls, *names):
+    """
+    Return arc_cls properties named names, without repetitions, to be read by projection queries, so arc entities are
+    not fetched entirely. Projected properties can not have equality filters on the query.
+    Queries are validated against Arc, so None, meaning full entities, is returned for properties of subclasses
+    """
+    properties = []
+    for name in names:
+        if name not in Arc._properties:
+            return None
+        if name not in properties:
+            properties.append(name)
+    return [arc_cls._properties[name] for name in properties]
+
+
+def adjacency_projection(arc_cls, arc_property, order=None):
+    """
+    Return projection of adjacency queries: neighbor property and ordering property, needed to merge sorted shards
+    """
+    prop, _ = order_value(arc_cls, order)
+    return arc_projection(arc_cls, arc_property, prop._name)
+
+
+def deletion_projection(arc_cls, origin=None, destination=None):
+    """
+    Return projection of queries for arcs to be deleted: unknown endpoints and creation, needed to invalidate buckets
+    """
+    names = [name for name, known in (('origin', origin), ('destination', destination)) if known is None]
+    return arc_projection(arc_cls, *(names + ['creation']))
+
+
+class _ProjectionFuture(object):
+    def __init__(self, query, projection, options):
+        self._query = query
+        self._options = options
+        self._future = query.fetch_async(projection=projection, **options)
+
+    def get_result(self):
+        try:
+            return self._future.get_result()
+        except datastore_errors.NeedIndexError as e:
+            logging.warning('projection index missing, fetching full entities: %s', e)
+            return self._query.fetch(**self._options)
+
+
+def fetch_projection_async(query, projection=None, **options):
+    """
+    Start fetching query with projection, falling back to full entities while its composite index is missing or still
+    being built. Required indexes are listed on index.yaml
+    """
+    if not projection:
+        return query.fetch_async(**options)
+    return _ProjectionFuture(query, projection, options)
+
+
+def projected_arcs(arc_cls, projected, origin=None, destination=None):
+    """
+    Build arcs to be deleted from deletion_projection query results, informing known endpoints
+    """
+    return [arc_cls(origin or arc.origin, destination or arc.destination, key=arc.key, creation=arc.creation)
+            for arc in projected]
+
+
+def destinations_fence_key(arc_cls, origin):
+    """
+    Return the key present while origin's destinations may be stale on eventually consistent queries
+    """
+    return destinations_cache_key(arc_cls, origin) + '|w'
+
+
+def origins_fence_key(arc_cls, destination):
+    return 'o' + destinations_fence_key(arc_cls, destination)
+
+
+def write_fences(arc_cls, origin, destination):
+    """
+    Return fence keys to be set when an arc connecting origin to destination is written or deleted, mapped to
+    arc_cls.stale_window. Destinations are not fenced when read with ancestor queries
+    """
+    if not arc_cls.stale_window:
+        return {}
+    fences = {origins_fence_key(arc_cls, destination): arc_cls.stale_window}
+    if not arc_cls.consistent_destinations:
+        fences[destinations_fence_key(arc_cls, origin)] = arc_cls.stale_window
+    return fences
+
+
+def pending_arcs_cache_key(arc_cls, origin):
+    """
+    Return the key holding origin's arc operations queued on write behind mode and not applied yet
+    """
+    return 'p' + destinations_cache_key(arc_cls, origin)
+
+
+def pending_sequence_key(arc_cls, origin, destination):
+    """
+    Return the key counting write behind operations queued for arcs from origin to destination, ordering them
+    """
+    return '%s|s%s' % (pending_arcs_cache_key(arc_cls, origin), to_node_key(destination).id())
+
+
+def destinations_generation_key(arc_cls, origin):
+    """
+    Return the key holding the generation of origin's filtered destinations cache entries.
+    Deleting it invalidates all of them at once, whatever filters were used
+    """
+    return destinations_cache_key(arc_cls, origin) + ':g'
+
 
+def origins_generation_key(arc_cls, destination):
+    return 'o' + destinations_generation_key(arc_cls, destination)
 
-def destinations_cache_key(arc_cls, origin):
-    return arc_cls.__name__ + str(to_node_key(origin).id())
 
+def filters_signature(filters):
+    """
+    Return a normalized signature for arc property filters, so equivalent filters share the same cache entry
+    no matter the order they were informed
+    """
+    nodes = []
+    for f in filters:
+        if isinstance(f, ndb.query.ConjunctionNode):
+            nodes.extend(f)
+        else:
+            nodes.append(f)
+    return hashlib.md5('|'.join(sorted(repr(n) for n in nodes)).encode('utf-8')).hexdigest()
 
-def origins_cache_key(arc_cls, destination):
-    return 'o' + destinations_cache_key(arc_cls, destination)
 
+def filtered_cache_key(cache_key, generation, filters):
+    return '%s:f%s:%s' % (cache_key, generation, filters_signature(filters))
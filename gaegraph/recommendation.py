@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Precomputed neighbor of neighbor ("people you may know") index.
+
+For each node, the top k nodes reachable in two hops through an Arc subclass, and not already connected to it, are
+stored with their scores on a single TwoHopCandidates entity. Score is the number of distinct intermediate nodes.
+The index is maintained by deferred tasks doing bounded work each: TwoHopIndex listener schedules incremental updates
+when arcs are created or deleted, and rebuild_all recomputes the whole index.
+"""
+from __future__ import absolute_import, unicode_literals
+from collections import defaultdict
+
+from google.appengine.ext import deferred, ndb
+from google.appengine.ext.ndb.query import Cursor
+
+from gaebusiness.business import Command
+from gaegraph.business_base import AdjacencySearch, DESTINATIONS, ORIGINS
+from gaegraph.model import ArcListener, Node, to_node_key
+
+
+class TwoHopCandidates(ndb.Model):
+    candidates = ndb.JsonProperty(indexed=False)  # list of [node id, score], best scores first
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+    @classmethod
+    def key_for(cls, arc_class, node):
+        return ndb.Key(cls, '%s:%s' % (arc_class.__name__, to_node_key(node).id()))
+
+
+def _arc_class(arc_class_name):
+    return ndb.Model._kind_map[arc_class_name]
+
+
+def compute_candidates(arc_class, node_keys, k):
+    """
+    Return a dict mapping each node key to its top k two hops candidates as (node key, score) tuples.
+    Work is done with two AdjacencySearch: one for nodes and one for all their destinations
+    """
+    first_hop = AdjacencySearch(*[(arc_class, DESTINATIONS, n) for n in node_keys])()
+    neighbors = set(key for keys in first_hop.itervalues() for key in keys)
+    second_hop = AdjacencySearch(*[(arc_class, DESTINATIONS, n) for n in neighbors])()
+    result = {}
+    for node_key in node_keys:
+        direct = first_hop[(arc_class, DESTINATIONS, node_key)]
+        excluded = set(direct)
+        excluded.add(node_key)
+        scores = defaultdict(int)
+        for neighbor in set(direct):
+            for candidate in set(second_hop[(arc_class, DESTINATIONS, neighbor)]):
+                if candidate not in excluded:
+                    scores[candidate] += 1
+        ranking = sorted(scores.iteritems(), key=lambda item: (-item[1], item[0].id()))
+        result[node_key] = ranking[:k]
+    return result
+
+
+def update_index(arc_class, node_keys, k):
+    candidates = compute_candidates(arc_class, node_keys, k)
+    ndb.put_multi([TwoHopCandidates(key=TwoHopCandidates.key_for(arc_class, node_key),
+                                    candidates=[[c.id(), score] for c, score in node_candidates])
+                   for node_key, node_candidates in candidates.iteritems()])
+
+
+def _update_nodes_task(arc_class_name, node_ids, k, batch_size, queue):
+    batch, remaining = node_ids[:batch_size], node_ids[batch_size:]
+    if remaining:
+        deferred.defer(_update_nodes_task, arc_class_name, remaining, k, batch_size, queue, _queue=queue)
+    update_index(_arc_class(arc_class_name), [ndb.Key(Node, i) for i in batch], k)
+
+
+def _arcs_changed_task(arc_class_name, origin_ids, k, batch_size, queue):
+    """
+    When arc u -> v changes, candidates of u change, as well as candidates of every origin of u
+    """
+    arc_class = _arc_class(arc_class_name)
+    origins = [ndb.Key(Node, i) for i in origin_ids]
+    affected = AdjacencySearch(*[(arc_class, ORIGINS, o) for o in origins])()
+    node_ids = set(origin_ids)
+    node_ids.update(key.id() for keys in affected.itervalues() for key in keys)
+    _update_nodes_task(arc_class_name, sorted(node_ids), k, batch_size, queue)
+
+
+def _rebuild_task(arc_class_name, k, batch_size, queue, cursor=None):
+    cursor = Cursor(urlsafe=cursor) if cursor else None
+    node_keys, cursor, more = Node.query().fetch_page(batch_size, start_cursor=cursor, keys_only=True)
+    if more and cursor:
+        deferred.defer(_rebuild_task, arc_class_name, k, batch_size, queue, cursor.urlsafe(), _queue=queue)
+    if node_keys:
+        update_index(_arc_class(arc_class_name), node_keys, k)
+
+
+class TwoHopIndex(ArcListener):
+    """
+    Listener keeping TwoHopCandidates of an Arc subclass up to date. Register it on arc class, e.g.:
+    Follow._listeners = (TwoHopIndex(k=20),)
+    Each task computes candidates for at most batch_size nodes. Bulk writes should be done inside a
+    gaegraph.model.batch_invalidation block, so all their created arcs schedule a single update
+    """
+
+    def __init__(self, k=10, batch_size=50, queue='default'):
+        self.k = k
+        self.batch_size = batch_size
+        self.queue = queue
+
+    def _schedule(self, arc_class, arcs):
+        origin_ids = sorted(set(arc.origin.id() for arc in arcs))
+        if origin_ids:
+            # inside transactions, task is only enqueued if the arcs write commits
+            deferred.defer(_arcs_changed_task, arc_class.__name__, origin_ids, self.k, self.batch_size, self.queue,
+                           _queue=self.queue, _transactional=ndb.in_transaction())
+
+    def arcs_created(self, arc_class, arcs):
+        self._schedule(arc_class, arcs)
+
+    def arcs_deleted(self, arc_class, arcs):
+        self._schedule(arc_class, arcs)
+
+    def rebuild_all(self, arc_class):
+        """
+        Schedule recomputation of candidates for all nodes, batch_size nodes per task
+        """
+        deferred.defer(_rebuild_task, arc_class.__name__, self.k, self.batch_size, self.queue, _queue=self.queue)
+
+
+class TwoHopCandidatesSearch(Command):
+    """
+    Command reading precomputed two hops candidates of a node with a single get.
+    Result is a list of (node key, score) tuples, best scores first
+    """
+    arc_class = None
+
+    def __init__(self, node_or_key_or_id):
+        super(TwoHopCandidatesSearch, self).__init__()
+        self.node_key = to_node_key(node_or_key_or_id)
+        self._future = None
+
+    def set_up(self):
+        self._future = TwoHopCandidates.key_for(self.arc_class, self.node_key).get_async()
+
+    def do_business(self):
+        index = self._future.get_result()
+        self.result = [(ndb.Key(Node, i), score) for i, score in index.candidates] if index else []
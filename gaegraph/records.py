@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight read mode: nodes are read as immutable NodeRecord tuples, built straight from datastore protobufs,
+without constructing ndb PolyModel entities.
+"""
+from __future__ import absolute_import, unicode_literals
+from collections import namedtuple
+
+from google.appengine.api import datastore_types
+from google.appengine.datastore import datastore_rpc
+from google.appengine.ext import ndb
+
+_BASE_FIELDS = ('id', 'class_name')
+_record_classes = {}
+_STRUCTURED_PROPERTIES = (ndb.StructuredProperty, ndb.LocalStructuredProperty)
+
+
+class NodeRecord(tuple):
+    """
+    Base class of records. Instances are namedtuples with id, class_name and the selected properties as fields
+    """
+    __slots__ = ()
+
+    @property
+    def key(self):
+        return ndb.Key(self.model_class()._get_kind(), self.id)
+
+    def model_class(self):
+        return ndb.Model._kind_map[self.class_name]
+
+    def to_dict(self, include=None, exclude=None):
+        dct = dict(zip(self._fields, self))
+        dct.pop('class_name')
+        dct['id'] = str(self.id)
+        if include:
+            return {k: v for k, v in dct.iteritems() if k in include}
+        if exclude:
+            return {k: v for k, v in dct.iteritems() if k not in exclude}
+        return dct
+
+    def with_values(self, **values):
+        """
+        Return a new record with values appended as extra fields, e.g. relations set by RelationFiller
+        """
+        fields = self._fields + tuple(k for k in values if k not in self._fields)
+        record = dict(zip(self._fields, self))
+        record.update(values)
+        return record_class(fields)(**record)
+
+
+def record_class(fields):
+    """
+    Return the NodeRecord subclass having fields, creating it only once for each fields tuple
+    """
+    fields = tuple(fields)
+    cls = _record_classes.get(fields)
+    if cls is None:
+        tuple_cls = namedtuple(str('NodeRecord'), fields)
+        cls = type(str('NodeRecord'), (tuple_cls, NodeRecord), {'__slots__': ()})
+        _record_classes[fields] = cls
+    return cls
+
+
+def _from_property_pb(prop, model_property=None):
+    """
+    Decode a property protobuf into the value its model property defines, e.g. dicts for JsonProperty and dates for
+    DateProperty. Values of properties unknown to the model are decoded as raw datastore values
+    """
+    if model_property is not None:
+        value = model_property._db_get_value(prop.value(), prop)
+        return None if value is None else model_property._call_from_base_type(value)
+    value = datastore_types.FromPropertyPb(prop)
+    if isinstance(value, datastore_types.Key):
+        return ndb.Key.from_old_key(value)
+    return value
+
+
+def _model_properties(class_name):
+    """
+    Return a dict of code names to ndb properties of the model registered as class_name, or an empty dict for unknown
+    models. PolyModel class property is left out
+    """
+    model_class = ndb.Model._kind_map.get(class_name)
+    if model_class is None:
+        return {}
+    return {p._code_name: p for p in model_class._properties.itervalues() if p._name != 'class'}
+
+
+def pb_to_record(pb, properties=None):
+    """
+    Build a record from an entity protobuf, decoding only the selected properties, informed by their code names.
+    If properties is None, all model properties are kept. Values are converted by their model properties, as on
+    entities, and missing repeated properties are set to [].
+    Structured properties have no single datastore value, so records selecting them are built from a full entity
+    """
+    element = pb.key().path().element_list()[-1]
+    key_id = element.id() if element.has_id() else element.name().decode('utf-8')
+    classes = [p.value().stringvalue().decode('utf-8') for p in pb.property_list() if p.name() == 'class']
+    class_name = classes[-1] if classes else element.type().decode('utf-8')
+    model_properties = _model_properties(class_name)
+    if model_properties and properties is None:
+        properties = sorted(model_properties)
+    if properties is None:
+        # unknown model: datastore names are kept as they are
+        names = None
+        values = {}
+    else:
+        selected = [model_properties[p] for p in properties if p in model_properties]
+        if any(isinstance(p, _STRUCTURED_PROPERTIES) for p in selected):
+            entity = ndb.ModelAdapter().pb_to_entity(pb)
+            return dict_to_record(key_id, class_name, {p: getattr(entity, p, None) for p in properties}, properties)
+        names = {p._name: (p._code_name, p) for p in selected}
+        names.update((p, (p, None)) for p in properties if p not in model_properties)
+        values = {p._code_name: [] for p in selected if p._repeated}
+    for prop in pb.property_list() + pb.raw_property_list():
+        name = prop.name()
+        if name == 'class':
+            continue
+        model_property = None
+        if names is not None:
+            name, model_property = names.get(name, (None, None))
+            if name is None:
+                continue
+        if prop.multiple():
+            values.setdefault(name, []).append(_from_property_pb(prop, model_property))
+        else:
+            values[name] = _from_property_pb(prop, model_property)
+    return dict_to_record(key_id, class_name, values, properties)
+
+
+def dict_to_record(key_id, class_name, dct, properties=None):
+    """
+    Build a record from a dict, e.g. one cached from Node.to_dict
+    """
+    if properties is None:
+        properties = sorted(k for k in dct if k not in _BASE_FIELDS)
+    fields = _BASE_FIELDS + tuple(properties)
+    return record_class(fields)(key_id, class_name, *[dct.get(p) for p in properties])
+
+
+class RecordsFuture(object):
+    def __init__(self, rpc, properties):
+        self._rpc = rpc
+        self._properties = properties
+        self._result = None
+
+    def get_result(self):
+        if self._result is None:
+            pbs = self._rpc.get_result() if self._rpc else []
+            self._result = [pb and pb_to_record(pb, self._properties) for pb in pbs]
+        return self._result
+
+
+def get_pbs_async(keys):
+    """
+    Fetch entities from datastore as protobufs, bypassing ndb entities and its caches.
+    Returns a rpc which result is a list with protobufs, or None for missing entities, in the same order of keys
+    """
+    connection = datastore_rpc.Connection(adapter=datastore_rpc.IdentityAdapter())
+    return connection.async_get(None, [k.reference() for k in keys])
+
+
+def get_records_async(keys, properties=None):
+    """
+    Fetch nodes from datastore as records, bypassing ndb entities and its caches.
+    Returns a future which result is a list with records, or None for missing nodes, in the same order of keys
+    """
+    if not keys:
+        return RecordsFuture(None, properties)
+    return RecordsFuture(get_pbs_async(keys), properties)
+
+
+def get_records(keys, properties=None):
+    return get_records_async(keys, properties).get_result()
+
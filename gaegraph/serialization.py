@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk serialization of nodes, computing which properties to serialize only once per node class
+"""
+from __future__ import absolute_import, unicode_literals
+from datetime import date, datetime, time
+import json
+
+from google.appengine.ext import ndb
+
+from gaegraph.model import dict_plan
+from gaegraph.records import NodeRecord
+
+_MISSING = object()
+
+
+class _RecordPlan(object):
+    def __init__(self, record_cls, include, exclude, relations):
+        self.fields = []
+        for index, name in enumerate(record_cls._fields):
+            if name in ('id', 'class_name') or name in relations:
+                continue
+            if include is not None and name not in include:
+                continue
+            if exclude is not None and name in exclude:
+                continue
+            self.fields.append((name, index))
+        self.with_id = 'id' in include if include else (exclude is None or 'id' not in exclude)
+
+    def to_dict(self, record):
+        dct = {name: record[index] for name, index in self.fields}
+        if self.with_id:
+            dct['id'] = str(record.id)
+        return dct
+
+
+def _relations_tree(relations):
+    tree = {}
+    for path in relations or ():
+        subtree = tree
+        for name in path.split('.'):
+            subtree = subtree.setdefault(name, {})
+    return tree
+
+
+class _Serializer(object):
+    def __init__(self, include, exclude, relations):
+        self._include = include
+        self._exclude = exclude
+        self._tree = _relations_tree(relations)
+        self._plans = {}
+
+    def _plan(self, node, tree):
+        cls = node.__class__
+        plan_key = (cls, id(tree))
+        plan = self._plans.get(plan_key)
+        if plan is None:
+            if isinstance(node, NodeRecord):
+                plan = _RecordPlan(cls, self._include, self._exclude, tree)
+            else:
+                plan = dict_plan(cls, self._include, self._exclude)
+            self._plans[plan_key] = plan
+        return plan
+
+    def serialize(self, nodes, tree=None):
+        tree = self._tree if tree is None else tree
+        return [self._serialize_value(n, tree) for n in nodes]
+
+    def _serialize_value(self, value, tree):
+        if value is None:
+            return None
+        if isinstance(value, (list, tuple)) and not isinstance(value, NodeRecord):
+            return self.serialize(value, tree)
+        dct = self._plan(value, tree).to_dict(value)
+        for name, subtree in tree.iteritems():
+            relation = getattr(value, name, _MISSING)
+            if relation is not _MISSING:
+                dct[name] = self._serialize_value(relation, subtree)
+        return dct
+
+
+def to_dicts(nodes, include=None, exclude=None, relations=None):
+    """
+    Serialize nodes, or records, with the same include/exclude semantics of Node.to_dict.
+    relations are names of attributes filled by RelationFiller, serialized recursively with the same spec.
+    Nested relations are informed with dots, e.g. 'author.avatar'. Relations not filled on a node are ignored.
+    """
+    return _Serializer(include, exclude, relations).serialize(nodes)
+
+
+def json_default(value):
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, ndb.Key):
+        return str(value.id())
+    raise TypeError('%r is not JSON serializable' % value)
+
+
+def to_json(nodes, include=None, exclude=None, relations=None):
+    """
+    Same as to_dicts, but returning a JSON string. Dates are serialized on ISO format and keys as its ids
+    """
+    return json.dumps(to_dicts(nodes, include, exclude, relations), default=json_default, separators=(',', ':'))
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+In memory graph snapshot for analytics.
+
+Arcs are loaded into compressed sparse row (CSR) arrays: node ids are kept sorted on an array, so a node index is found
+by binary search, and neighbors of node index i are neighbors[offsets[i]:offsets[i + 1]]. A reverse CSR is kept for
+origins lookups. NumPy is used if available, otherwise the standard array module.
+Snapshots can be saved to a file and opened with mmap, sharing memory among processes.
+"""
+from __future__ import absolute_import, unicode_literals
+from array import array
+from bisect import bisect_left
+from collections import deque
+import mmap
+import struct
+import sys
+
+from gaegraph.model import to_node_key
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b'GGCSR\x00\x00\x01'
+_HEADER = struct.Struct(b'<qq')
+_INT64 = struct.Struct(b'<q')
+_NATIVE_INT64 = array(b'l').itemsize == 8 and sys.byteorder == 'little'
+
+
+class SnapshotException(Exception):
+    pass
+
+
+def _to_array(values, use_numpy):
+    if use_numpy:
+        return numpy.array(values, dtype=numpy.int64)
+    if _NATIVE_INT64:
+        return array(b'l', values)
+    return list(values)
+
+
+def _to_bytes(values):
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        return values.astype('<i8').tostring()
+    if isinstance(values, array) and _NATIVE_INT64:
+        return values.tostring()
+    return b''.join(_INT64.pack(v) for v in values)
+
+
+def _use_numpy(use_numpy):
+    if use_numpy is None:
+        return numpy is not None
+    if use_numpy and numpy is None:
+        raise SnapshotException('NumPy is not available')
+    return use_numpy
+
+
+class _MappedArray(object):
+    """
+    Read only int64 sequence backed by a buffer, used to access mmaped files without copying them when NumPy is not
+    available
+    """
+
+    def __init__(self, buf, offset, length):
+        self._buf = buf
+        self._offset = offset
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(self._length))]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError('index out of range')
+        return _INT64.unpack_from(self._buf, self._offset + index * 8)[0]
+
+
+def _csr(edges, nodes_count):
+    """
+    Build offsets and neighbors from a sorted list of (origin index, destination index) edges
+    """
+    offsets = [0] * (nodes_count + 1)
+    for origin, _ in edges:
+        offsets[origin + 1] += 1
+    for i in xrange(nodes_count):
+        offsets[i + 1] += offsets[i]
+    return offsets, [destination for _, destination in edges]
+
+
+class GraphSnapshot(object):
+    def __init__(self, ids, offsets, neighbors, reverse_offsets, reverse_neighbors, buf=None):
+        self.ids = ids
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.reverse_offsets = reverse_offsets
+        self.reverse_neighbors = reverse_neighbors
+        self._buf = buf
+
+    @classmethod
+    def from_edges(cls, edges, use_numpy=None):
+        """
+        Build a snapshot from (origin id, destination id) pairs
+        """
+        use_numpy = _use_numpy(use_numpy)
+        edges = list(edges)
+        ids = sorted(set(i for edge in edges for i in edge))
+        indexes = {node_id: i for i, node_id in enumerate(ids)}
+        edges = sorted((indexes[o], indexes[d]) for o, d in edges)
+        offsets, neighbors = _csr(edges, len(ids))
+        reverse_offsets, reverse_neighbors = _csr(sorted((d, o) for o, d in edges), len(ids))
+        return cls(*[_to_array(a, use_numpy) for a in (ids, offsets, neighbors, reverse_offsets, reverse_neighbors)])
+
+    @classmethod
+    def load(cls, arc_classes, batch_size=1000, use_numpy=None):
+        """
+        Build a snapshot from all arcs of arc_classes, reading only origin and destination with projection queries.
+        Nodes must have integer ids
+        """
+        return cls.from_edges(iter_arc_edges(arc_classes, batch_size), use_numpy)
+
+    @classmethod
+    def open(cls, path, use_numpy=None):
+        """
+        Open a snapshot saved on path, mapping the file on memory instead of reading it
+        """
+        use_numpy = _use_numpy(use_numpy)
+        with open(path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if buf[:len(MAGIC)] != MAGIC:
+            buf.close()
+            raise SnapshotException('%s is not a graph snapshot' % path)
+        nodes_count, arcs_count = _HEADER.unpack_from(buf, len(MAGIC))
+        offset = len(MAGIC) + _HEADER.size
+        arrays = []
+        for length in (nodes_count, nodes_count + 1, arcs_count, nodes_count + 1, arcs_count):
+            if use_numpy:
+                arrays.append(numpy.frombuffer(buf, dtype='<i8', count=length, offset=offset))
+            else:
+                arrays.append(_MappedArray(buf, offset, length))
+            offset += length * 8
+        return cls(*arrays, buf=buf)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(_HEADER.pack(self.nodes_count, self.arcs_count))
+            for values in (self.ids, self.offsets, self.neighbors, self.reverse_offsets, self.reverse_neighbors):
+                f.write(_to_bytes(values))
+
+    def close(self):
+        if self._buf is not None:
+            self._buf.close()
+            self._buf = None
+
+    @property
+    def nodes_count(self):
+        return len(self.ids)
+
+    @property
+    def arcs_count(self):
+        return len(self.neighbors)
+
+    def index(self, node):
+        node_id = to_node_key(node).id()
+        i = bisect_left(self.ids, node_id)
+        if i == len(self.ids) or self.ids[i] != node_id:
+            raise KeyError('Node %s is not on snapshot' % node_id)
+        return i
+
+    def _neighbor_indexes(self, i, reverse=False):
+        offsets, neighbors = (self.reverse_offsets, self.reverse_neighbors) if reverse else (self.offsets,
+                                                                                            self.neighbors)
+        return neighbors[offsets[i]:offsets[i + 1]]
+
+    def destinations(self, node):
+        return [int(self.ids[i]) for i in self._neighbor_indexes(self.index(node))]
+
+    def origins(self, node):
+        return [int(self.ids[i]) for i in self._neighbor_indexes(self.index(node), True)]
+
+    def out_degree(self, node):
+        i = self.index(node)
+        return int(self.offsets[i + 1] - self.offsets[i])
+
+    def in_degree(self, node):
+        i = self.index(node)
+        return int(self.reverse_offsets[i + 1] - self.reverse_offsets[i])
+
+    def bfs(self, node, max_depth=None, reverse=False):
+        """
+        Breadth first search from node, following destinations, or origins if reverse is True.
+        Returns a dict mapping reached node ids to their depth
+        """
+        start = self.index(node)
+        depths = {start: 0}
+        queue = deque([start])
+        while queue:
+            i = queue.popleft()
+            depth = depths[i] + 1
+            if max_depth is not None and depth > max_depth:
+                continue
+            for j in self._neighbor_indexes(i, reverse):
+                j = int(j)
+                if j not in depths:
+                    depths[j] = depth
+                    queue.append(j)
+        return {int(self.ids[i]): d for i, d in depths.iteritems()}
+
+    def degree_stats(self, reverse=False):
+        offsets = self.reverse_offsets if reverse else self.offsets
+        degrees = [int(offsets[i + 1] - offsets[i]) for i in xrange(self.nodes_count)]
+        if not degrees:
+            return {'nodes': 0, 'arcs': 0, 'min': 0, 'max': 0, 'mean': 0.0}
+        return {'nodes': self.nodes_count, 'arcs': self.arcs_count, 'min': min(degrees), 'max': max(degrees),
+                'mean': float(self.arcs_count) / self.nodes_count}
+
+
+def iter_arc_edges(arc_classes, batch_size=1000):
+    """
+    Generator of (origin id, destination id) pairs of all arcs of arc_classes
+    """
+    for arc_class in arc_classes:
+        query = arc_class.query(projection=[arc_class.origin, arc_class.destination])
+        for arc in query.iter(batch_size=batch_size):
+            yield arc.origin.id(), arc.destination.id()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Offline export and import of graph data.
+
+Files start with a header followed by length prefixed entity protobufs, so they can be written and read in streaming,
+batch by batch, without holding the whole dataset in memory.
+"""
+from __future__ import absolute_import, unicode_literals
+from collections import deque
+import struct
+
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+
+from gaegraph.business_base import ORIGINS
+from gaegraph.model import Arc, batch_invalidation
+from gaegraph.records import get_pbs_async
+from gaegraph.warming import WarmCaches
+
+HEADER = b'GAEGRAPH\x01'
+_LENGTH = struct.Struct(b'>I')
+
+
+class TransferException(Exception):
+    pass
+
+
+def iter_entity_pbs(model_class, batch_size=500):
+    """
+    Generator of model_class entities as protobufs. Keys are fetched by cursor paged keys only queries and entities
+    with one batched get per page, while the next page is already being queried
+    """
+    query = model_class.query()
+    page_future = query.fetch_page_async(batch_size, keys_only=True)
+    while page_future:
+        keys, cursor, more = page_future.get_result()
+        page_future = query.fetch_page_async(batch_size, start_cursor=cursor, keys_only=True) if more else None
+        if keys:
+            for pb in get_pbs_async(keys).get_result():
+                if pb is not None:
+                    yield pb
+
+
+def export_graph(stream, model_classes, batch_size=500):
+    """
+    Write all entities of model_classes, Nodes and Arcs, to binary stream. Subclasses are exported along with its
+    parent class, so don't inform both.
+    Returns the number of exported entities
+    """
+    stream.write(HEADER)
+    count = 0
+    for model_class in model_classes:
+        for pb in iter_entity_pbs(model_class, batch_size):
+            data = pb.Encode()
+            stream.write(_LENGTH.pack(len(data)))
+            stream.write(data)
+            count += 1
+    return count
+
+
+def iter_exported_pbs(stream):
+    """
+    Generator of entity protobufs written on stream by export_graph
+    """
+    if stream.read(len(HEADER)) != HEADER:
+        raise TransferException('Stream is not a gaegraph export')
+    while True:
+        length = stream.read(_LENGTH.size)
+        if not length:
+            return
+        if len(length) < _LENGTH.size:
+            raise TransferException('Truncated gaegraph export')
+        length = _LENGTH.unpack(length)[0]
+        data = stream.read(length)
+        if len(data) < length:
+            raise TransferException('Truncated gaegraph export')
+        yield entity_pb.EntityProto(data)
+
+
+def import_graph(stream, batch_size=500, max_concurrent_batches=4, warm_caches=True):
+    """
+    Write entities exported by export_graph, preserving its keys. Batches are written with put_multi_async, keeping at
+    most max_concurrent_batches on flight. Integer ids of imported entities are reserved, so entities created later
+    with automatic ids don't overwrite them. Adjacency caches of imported arcs are invalidated once, at the end, and
+    rebuilt with WarmCaches if warm_caches is True. Imported arcs keep their creation, so they are not notified to arc
+    listeners, e.g. TwoHopIndex.rebuild_all must be called after importing.
+    Model classes of exported entities must be imported before calling this function.
+    Returns the number of imported entities
+    """
+    adapter = ndb.ModelAdapter()
+    pending = deque()
+    batch = []
+    count = 0
+    max_ids = {}  # (kind, parent key): (model class, max integer id)
+    arc_nodes = {}  # arc class: (origins, destinations)
+    with batch_invalidation():
+        for pb in iter_exported_pbs(stream):
+            entity = adapter.pb_to_entity(pb)
+            _track(entity, max_ids, arc_nodes)
+            batch.append(entity)
+            if len(batch) == batch_size:
+                count += _put_batch(batch, pending, max_concurrent_batches)
+                batch = []
+        if batch:
+            count += _put_batch(batch, pending, max_concurrent_batches)
+        while pending:
+            [f.get_result() for f in pending.popleft()]
+    futures = [model_class.allocate_ids_async(max=max_id, parent=parent)
+               for (_, parent), (model_class, max_id) in max_ids.iteritems()]
+    [f.get_result() for f in futures]
+    if warm_caches:
+        for arc_class, (origins, destinations) in arc_nodes.iteritems():
+            WarmCaches([arc_class], nodes=sorted(origins))()
+            WarmCaches([(arc_class, ORIGINS)], nodes=sorted(destinations))()
+    return count
+
+
+def _track(entity, max_ids, arc_nodes):
+    key = entity.key
+    if isinstance(key.id(), (int, long)):
+        group = (key.kind(), key.parent())
+        model_class, max_id = max_ids.get(group, (entity.__class__, 0))
+        max_ids[group] = (model_class, max(max_id, key.id()))
+    if isinstance(entity, Arc):
+        origins, destinations = arc_nodes.setdefault(entity.__class__, (set(), set()))
+        origins.add(entity.origin)
+        destinations.add(entity.destination)
+
+
+def _put_batch(batch, pending, max_concurrent_batches):
+    if len(pending) >= max_concurrent_batches:
+        [f.get_result() for f in pending.popleft()]
+    pending.append(ndb.put_multi_async(batch))
+    return len(batch)
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Cache warming for adjacency lists and nodes.
+
+WarmCaches fills the adjacency cache entries read by DestinationsSearch, OriginsSearch and AdjacencySearch with
+default ordering, so the first requests after a deploy or a cache flush don't all hit datastore at once. Adjacency
+lists missing on cache are computed with concurrent projection queries, which read only the neighbor key of each arc,
+and neighbor nodes can also be loaded into ndb memcache. Work is done in batches with a maximum query rate, so warming
+itself does not overload datastore. Projection queries need composite indexes including the projected property.
+"""
+from __future__ import absolute_import, unicode_literals
+import time
+
+from google.appengine.ext import ndb
+
+from gaebusiness.business import Command
+from gaegraph.business_base import AdjacencySearch, DESTINATIONS
+from gaegraph.model import to_node_key
+
+
+class _WarmingAdjacencySearch(AdjacencySearch):
+    _admission = False  # warmed lists are cached on their first miss
+
+
+def _sleep(seconds):
+    time.sleep(seconds)
+
+
+class WarmCaches(Command):
+    """
+    Command warming adjacency caches of nodes for arc_specs, whose items are arc classes, warmed on DESTINATIONS
+    direction, or (arc_class, direction) tuples. Nodes are informed as keys, ids or nodes, or as a query, e.g.
+    Node.query_by_creation_desc(), from which limit keys are fetched.
+    Each batch warms batch_size adjacency lists with one cache.get_multi, concurrent queries for misses and one
+    cache.set_multi, bypassing arc classes admission policy. Batches sleep when needed to keep up to
+    max_queries_per_second. If warm_nodes is True, nodes and their neighbors are loaded into ndb memcache with one
+    get_multi per batch.
+    Result is a dict with the number of nodes, the number of queries done for adjacency lists missing on cache and the
+    number of loaded nodes
+    """
+
+    def __init__(self, arc_specs, nodes=None, query=None, limit=1000, batch_size=50, max_queries_per_second=50,
+                 warm_nodes=False):
+        super(WarmCaches, self).__init__()
+        if (nodes is None) == (query is None):
+            raise Exception('inform either nodes or query')
+        self.arc_specs = [spec if isinstance(spec, tuple) else (spec, DESTINATIONS) for spec in arc_specs]
+        self.node_keys = None if nodes is None else [to_node_key(n) for n in nodes]
+        self.query = query
+        self.limit = limit
+        self.batch_size = batch_size
+        self.max_queries_per_second = max_queries_per_second
+        self.warm_nodes = warm_nodes
+
+    def do_business(self):
+        node_keys = self.node_keys
+        if node_keys is None:
+            node_keys = self.query.fetch(self.limit, keys_only=True)
+        specs = [(arc_class, direction, node_key) for node_key in node_keys for arc_class, direction in self.arc_specs]
+        self.result = {'nodes': len(node_keys), 'queries': 0, 'loaded_nodes': 0}
+        loaded = set()
+        start = time.time()
+        for i in xrange(0, len(specs), self.batch_size):
+            batch = specs[i:i + self.batch_size]
+            expected_elapsed = float(self.result['queries']) / self.max_queries_per_second
+            elapsed = time.time() - start
+            if elapsed < expected_elapsed:
+                _sleep(expected_elapsed - elapsed)
+            cmd = _WarmingAdjacencySearch(*batch)
+            adjacency = cmd()
+            self.result['queries'] += cmd._query_count()
+            if self.warm_nodes:
+                to_load = []
+                for spec in batch:
+                    for key in [spec[2]] + adjacency[spec]:
+                        if key not in loaded:
+                            loaded.add(key)
+                            to_load.append(key)
+                if to_load:
+                    # ndb writes entities to memcache when they are read from datastore
+                    ndb.get_multi(to_load, use_cache=False)
+                    self.result['loaded_nodes'] += len(to_load)
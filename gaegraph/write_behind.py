@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Write behind mode for arcs.
+
+Creations and deletions are queued on a pull queue, tagged by arc class, instead of being written on request. A worker
+calling apply_pending_arcs leases them and applies them in large batches, coalescing repeated operations on the same
+(origin, destination) pair. Meanwhile, operations are also kept on an origin's overlay cache entry, so searches
+informing with_pending=True see them before they are applied.
+
+The pull queue must be declared on queue.yaml:
+
+queue:
+- name: gaegraph-arcs
+  mode: pull
+"""
+from __future__ import absolute_import, unicode_literals
+from itertools import izip
+import json
+import time
+import uuid
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from gaebusiness.business import Command
+from gaegraph import cache
+from gaegraph.model import to_node_key, pending_arcs_cache_key, pending_sequence_key, batch_invalidation, \
+    invalidate_cache_keys, write_fences, arc_cache_keys, deletion_projection, projected_arcs, fetch_projection_async
+
+QUEUE_NAME = 'gaegraph-arcs'
+CREATE = 'c'
+DELETE = 'd'
+PENDING_TTL = 3600  # overlay entries expire if no worker applies them
+
+
+def _update_pending(cache_key, update):
+    """
+    Update overlay list with compare and set, so concurrent requests don't lose each other operations
+    """
+    cache.cas_update(cache_key, lambda pending: update(pending or []), time=PENDING_TTL)
+
+
+def apply_pending(node_keys, pending, position=None):
+    """
+    Return node_keys changed by pending (operation id, operation, destination key) tuples, on queuing order.
+    Created destinations are inserted on the index returned by position(node_keys, destination), at the end by default
+    """
+    node_keys = list(node_keys)
+    for _, operation, destination in pending:
+        if operation == CREATE:
+            if destination not in node_keys:
+                node_keys.insert(len(node_keys) if position is None else position(node_keys, destination),
+                                 destination)
+        else:
+            node_keys = [k for k in node_keys if k != destination]
+    return node_keys
+
+
+class _QueueArcOperation(Command):
+    arc_class = None
+    queue_name = QUEUE_NAME
+    _operation = None
+
+    def __init__(self, origin, destination):
+        super(_QueueArcOperation, self).__init__()
+        self.origin = to_node_key(origin)
+        self.destination = to_node_key(destination)
+        self.operation_id = uuid.uuid4().hex
+        self._rpc = None
+
+    def set_up(self):
+        # operations are ordered by a memcache counter, since instances clocks drift. It starts from current time in
+        # milliseconds, so counters recreated after eviction keep following older operations
+        now = int(time.time() * 1000)
+        sequence = cache.incr(pending_sequence_key(self.arc_class, self.origin, self.destination), initial_value=now)
+        payload = json.dumps({'id': self.operation_id, 'op': self._operation, 'seq': sequence or now,
+                              'origin': self.origin.urlsafe(), 'destination': self.destination.urlsafe()})
+        self._rpc = taskqueue.create_rpc()
+        task = taskqueue.Task(method='PULL', payload=payload, tag=self.arc_class.__name__)
+        taskqueue.Queue(self.queue_name).add_async(task, rpc=self._rpc)
+
+    def do_business(self):
+        self._rpc.get_result()
+        entry = (self.operation_id, self._operation, self.destination)
+        # If memcache fails, operation is only visible after being applied
+        _update_pending(pending_arcs_cache_key(self.arc_class, self.origin), lambda pending: pending + [entry])
+
+
+class QueueArcCreation(_QueueArcOperation):
+    """
+    Command queuing the creation of an arc_class arc from origin to destination
+    """
+    _operation = CREATE
+
+
+class QueueArcDeletion(_QueueArcOperation):
+    """
+    Command queuing the deletion of arc_class arcs from origin to destination
+    """
+    _operation = DELETE
+
+
+def _sequence(operation):
+    return operation.get('seq', operation.get('time'))  # operations queued by older versions only have client time
+
+
+def _coalesce(operations):
+    """
+    Reduce operations of each (origin, destination) pair, on queuing order, to at most one deletion, applied to
+    already existing arcs, and one creation. Creations followed by a deletion are cancelled and repeated creations
+    create only one arc. Creations are returned as (origin, destination, operation id) tuples, the id of their first
+    creation operation
+    """
+    by_pair = {}
+    for operation in sorted(operations, key=_sequence):
+        pair = (operation['origin'], operation['destination'])
+        delete, create = by_pair.get(pair, (False, None))
+        if operation['op'] == DELETE:
+            by_pair[pair] = (True, None)
+        else:
+            by_pair[pair] = (delete, create or operation['id'])
+    deletions = [p for p, (deleted, _) in by_pair.iteritems() if deleted]
+    creations = [p + (create_id,) for p, (_, create_id) in by_pair.iteritems() if create_id]
+    return deletions, creations
+
+
+def _created_arc(arc_class, origin, destination, operation_id):
+    """
+    Return arc created by operation_id. Its key derives from the operation id, so tasks leased again after their lease
+    expired rewrite the same arc instead of duplicating it
+    """
+    parent = origin if arc_class.consistent_destinations else None
+    return arc_class(origin, destination, id=operation_id, parent=parent)
+
+
+def apply_pending_arcs(arc_class, queue_name=QUEUE_NAME, lease_seconds=60, max_tasks=1000):
+    """
+    Lease up to max_tasks operations queued for arc_class and apply them: deletions with concurrent queries and one
+    delete_multi, creations with one put_multi. Adjacency caches are invalidated once. Applying the same tasks again
+    is idempotent.
+    Returns the number of applied operations, 0 meaning queue is empty for arc_class
+    """
+    queue = taskqueue.Queue(queue_name)
+    tasks = queue.lease_tasks_by_tag(lease_seconds, max_tasks, tag=arc_class.__name__)
+    if not tasks:
+        return 0
+    operations = [json.loads(t.payload) for t in tasks]
+    deletions, creations = _coalesce(operations)
+    to_key = lambda urlsafe: ndb.Key(urlsafe=urlsafe)
+
+    deletions = [(to_key(o), to_key(d)) for o, d in deletions]
+    query_futures = [fetch_projection_async(arc_class.query_by_origin_and_destination(o, d),
+                                            deletion_projection(arc_class, o, d)) for o, d in deletions]
+    with batch_invalidation():
+        deleted = [arc for (o, d), f in izip(deletions, query_futures)
+                   for arc in projected_arcs(arc_class, f.get_result(), o, d)]
+        if deleted:
+            ndb.delete_multi([arc.key for arc in deleted])
+            cache_keys = []
+            fence_keys = {}
+            for arc in deleted:
+                cache_keys.extend(arc_cache_keys(arc))
+                fence_keys.update(write_fences(arc_class, arc.origin, arc.destination))
+            invalidate_cache_keys(cache_keys, fence_keys)
+        ndb.put_multi([_created_arc(arc_class, to_key(o), to_key(d), op_id) for o, d, op_id in creations])
+    if deleted:
+        for listener in arc_class._listeners:
+            listener.arcs_deleted(arc_class, deleted)
+
+    applied_ids = {}
+    for operation in operations:
+        applied_ids.setdefault(operation['origin'], set()).add(operation['id'])
+    for origin, ids in applied_ids.iteritems():
+        # If memcache fails, overlay entries expire after PENDING_TTL anyway
+        _update_pending(pending_arcs_cache_key(arc_class, to_key(origin)),
+                        lambda pending: [p for p in pending if p[0] not in ids])
+    queue.delete_tasks(tasks)
+    return len(tasks)
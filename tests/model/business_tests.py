@@ -1,15 +1,25 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 
-from google.appengine.api import memcache
-from google.appengine.ext import ndb
+from datetime import datetime, timedelta
 
-from gaebusiness.business import CommandExecutionException, Command, CommandSequential
+import mock
+from google.appengine.api import datastore, datastore_errors, memcache
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb, testbed, deferred
+
+from gaebusiness.business import CommandExecutionException, Command, CommandSequential, CommandParallel
 from gaeforms.ndb.form import ModelForm
+from gaegraph import cache
 from gaegraph.business_base import NodeSearch, DestinationsSearch, OriginsSearch, SingleDestinationSearch, \
     SingleOriginSearch, UpdateNode, DeleteNode, DeleteArcs, ArcSearch, CreateArc, CreateSingleArc, HasArcCommand, \
-    CreateUniqueArc, CreateSingleOriginArc, CreateSingleDestinationArc, ModelSearchWithRelations
-from gaegraph.model import Node, Arc, destinations_cache_key, origins_cache_key, to_node_key
+    CreateUniqueArc, CreateSingleOriginArc, CreateSingleDestinationArc, ModelSearchWithRelations, AdjacencySearch, \
+    DESTINATIONS, ORIGINS, PathSearch, FanOutSearch, Relation, EMPTY_ADJACENCY, UpdateNodes, DeleteArcPairs, \
+    backfill_origin_shards
+from gaegraph.model import Node, Arc, destinations_cache_key, origins_cache_key, to_node_key, origins_sharded_key, \
+    origins_shard_cache_key, origin_shard, destinations_fence_key, origins_fence_key, creation_bucket, \
+    destinations_bucket_cache_key, origins_bucket_cache_key
+from gaegraph.records import NodeRecord
 from model.util import GAETestCase
 from mommygae import mommy
 
@@ -154,6 +164,217 @@ class ModelSearchWithRelationsTests(GAETestCase):
         self.assertEqual([], result[1].destinations)
         self.assertIsNone(result[1].single)
 
+    def test_overlapped_phases(self):
+        nodes = [mommy.save_one(ModelForSearch) for i in xrange(2)]
+        destination = mommy.save_one(Node)
+        CreateArcStub(nodes[0], destination)()
+
+        cmd = ModelSearchWithRelationsStub(page_size=2, relations=['destinations'])
+        cmd.set_up()
+        self.assertIsNone(cmd._planner)  # page keys are not known yet
+        cmd.do_business()
+        self.assertListEqual([[destination], []], [n.destinations for n in cmd.result])
+        self.assertListEqual(['nodes', 'page_keys', 'relations'], sorted(cmd.timings))
+        self.assertTrue(cmd.timings['page_keys'] <= cmd.timings['nodes'] <= cmd.timings['relations'])
+
+        # with cached page keys, relations are started along with nodes on set_up
+        nodes[1].key.delete()
+        memcache.delete(destinations_cache_key(Arc, nodes[1]))
+        cmd = ModelSearchWithRelationsStub(page_size=2, relations=['destinations'])
+        with mock.patch.object(ndb.Query, 'fetch_async', autospec=True,
+                               side_effect=ndb.Query.fetch_async) as fetch_async:
+            cmd.set_up()
+            self.assertEqual(1, fetch_async.call_count)  # destinations of deleted node
+            self.assertIsNotNone(cmd._planner)
+            cmd.do_business()
+        self.assertEqual(nodes[0], cmd.result[0])
+        self.assertListEqual([destination], cmd.result[0].destinations)
+        self.assertIsNone(cmd.result[1])
+
+
+class LazyRelationsTests(GAETestCase):
+    def setUp(self):
+        super(LazyRelationsTests, self).setUp()
+        self.nodes = [mommy.save_one(ModelForSearch) for i in xrange(3)]
+        self.destinations = [mommy.save_one(Node) for i in xrange(2)]
+        for d in self.destinations:
+            CreateArcStub(self.nodes[0], d)()
+        self.executions = []
+        executions = self.executions
+
+        class CountingDestinationsSearch(ArcDestinationsSearch):
+            def do_business(self):
+                executions.append(self.origin)
+                super(CountingDestinationsSearch, self).do_business()
+
+        self.relations = {'destinations': CountingDestinationsSearch}
+
+    def test_model_search_lazy_relations(self):
+        cmd = ModelSearchWithRelationsStub(relations=['destinations'], lazy_relations=True)
+        cmd._relations = self.relations
+        result = cmd()
+        self.assertListEqual([], self.executions)
+        self.assertListEqual(self.destinations, result[0].destinations)
+        # first access resolved relations for all siblings
+        self.assertEqual(3, len(self.executions))
+        self.assertListEqual([], result[1].destinations)
+        self.assertListEqual([], result[2].destinations)
+        self.assertEqual(3, len(self.executions))
+        self.assertRaises(AttributeError, lambda: result[0].single)
+
+    def test_node_search_lazy_relations(self):
+        class LazyNodeSearch(NodeSearch):
+            _relations = self.relations
+
+        node = LazyNodeSearch(self.nodes[0], relations=['destinations'], lazy_relations=True)()
+        self.assertListEqual([], self.executions)
+        self.assertListEqual(self.destinations, node.destinations)
+        self.assertListEqual(self.destinations, node.destinations)
+        self.assertEqual(1, len(self.executions))
+
+    def test_arc_search_lazy_relations(self):
+        class LazyDestinationsSearch(ArcDestinationsSearch):
+            _relations = self.relations
+
+        origin = mommy.save_one(Node)
+        CreateArcStub(origin, self.nodes[0])()
+        CreateArcStub(origin, self.nodes[1])()
+        result = LazyDestinationsSearch(origin, relations=['destinations'], lazy_relations=True)()
+        self.assertListEqual([], self.executions)
+        self.assertListEqual([], result[1].destinations)
+        self.assertEqual(2, len(self.executions))
+        self.assertListEqual(self.destinations, result[0].destinations)
+
+
+class CompactReadTests(GAETestCase):
+    def test_node_search(self):
+        node = mommy.save_one(ModelForSearch)
+        record = NodeSearchWithRelations(node, compact=True)()
+        self.assertIsInstance(record, NodeRecord)
+        self.assertEqual(node.key, record.key)
+        self.assertEqual(node.creation, record.creation)
+        self.assertIsNone(NodeSearch('404', compact=True)())
+
+        class StubNodeSearch(NodeSearch):
+            _model_class = NodeStub
+
+        self.assertRaises(CommandExecutionException, StubNodeSearch(node, compact=True))
+
+    def test_node_search_with_relations(self):
+        node = mommy.save_one(ModelForSearch)
+        destination = mommy.save_one(Node)
+        CreateArcStub(node, destination)()
+        record = NodeSearchWithRelations(node, relations=['destinations'], compact=True, properties=[])()
+        self.assertEqual(('id', 'class_name', 'destinations'), record._fields)
+        self.assertListEqual([destination], record.destinations)
+
+    def test_destinations_search(self):
+        origin = mommy.save_one(Node)
+        destinations = [mommy.save_one(Node) for i in xrange(3)]
+        for d in destinations:
+            CreateArcStub(origin, d)()
+        search = ArcDestinationsSearch(origin, compact=True, properties=['creation'], limit=2)
+        records = search()
+        self.assertListEqual([d.key for d in destinations[:2]], [r.key for r in records])
+        self.assertListEqual([d.creation for d in destinations[:2]], [r.creation for r in records])
+        records = ArcOriginsSearch(destinations[0], compact=True, relations=[ORIGIN_RELATION])()
+        self.assertListEqual([origin.key], [r.key for r in records])
+        self.assertListEqual([], records[0].origin_origins)
+
+    def test_model_search(self):
+        nodes = [mommy.save_one(ModelForSearch) for i in xrange(3)]
+        destination = mommy.save_one(Node)
+        CreateArcStub(nodes[0], destination)()
+        for i in xrange(2):  # second time page keys come from cache
+            records = ModelSearchWithRelationsStub(page_size=3, relations=['destinations'], compact=True,
+                                                   properties=[])()
+            self.assertListEqual([n.key for n in nodes], [r.key for r in records])
+            self.assertListEqual([[destination], [], []], [r.destinations for r in records])
+
+
+class AuthorArc(Arc):
+    pass
+
+
+class AvatarArc(Arc):
+    pass
+
+
+class TagArc(Arc):
+    pass
+
+
+POST_RELATIONS = {'author': Relation(AuthorArc, ORIGINS, single=True,
+                                     relations={'avatar': Relation(AvatarArc, single=True)}),
+                  'tags': Relation(TagArc),
+                  'destinations': ArcDestinationsSearch}
+
+
+class PostSearch(NodeSearch):
+    _relations = POST_RELATIONS
+
+
+class PostsSearch(ModelSearchWithRelations):
+    _relations = POST_RELATIONS
+
+    def __init__(self, **kwargs):
+        super(PostsSearch, self).__init__(ModelForSearch.query_by_creation(), use_cache=False, **kwargs)
+
+
+class RelationSpecTests(GAETestCase):
+    def setUp(self):
+        super(RelationSpecTests, self).setUp()
+        self.authors = [mommy.save_one(Node) for i in xrange(2)]
+        self.avatar = mommy.save_one(Node)
+        self.tags = [mommy.save_one(Node) for i in xrange(2)]
+        self.posts = [mommy.save_one(ModelForSearch) for i in xrange(3)]
+        AvatarArc(self.authors[0], self.avatar).put()
+        for post, author in zip(self.posts, [0, 1, 0]):
+            AuthorArc(self.authors[author], post).put()
+        TagArc(self.posts[0], self.tags[0]).put()
+        TagArc(self.posts[0], self.tags[1]).put()
+        Arc(self.posts[1], self.tags[0]).put()
+
+    def count_adjacency_searches(self):
+        return mock.patch.object(AdjacencySearch, 'set_up', autospec=True, side_effect=AdjacencySearch.set_up)
+
+    def test_node_search(self):
+        post = PostSearch(self.posts[0], relations=['author.avatar', 'tags', 'destinations'])()
+        self.assertEqual(self.authors[0], post.author)
+        self.assertEqual(self.avatar, post.author.avatar)
+        self.assertListEqual(self.tags, post.tags)
+        self.assertListEqual(self.tags, post.destinations)  # TagArc is an Arc
+        post = PostSearch(self.posts[1], relations=['author'])()
+        self.assertEqual(self.authors[1], post.author)
+        self.assertRaises(AttributeError, lambda: post.author.avatar)
+        self.assertRaises(AttributeError, lambda: post.tags)
+
+    def test_bulk_fetch_per_level(self):
+        with self.count_adjacency_searches() as adjacency_search:
+            posts = PostsSearch(relations=['author.avatar', 'tags'])()
+        # one search for authors and tags of all posts, other for avatars of all authors
+        self.assertEqual(2, adjacency_search.call_count)
+        self.assertListEqual([self.authors[0], self.authors[1], self.authors[0]], [p.author for p in posts])
+        self.assertListEqual([self.avatar, None, self.avatar], [p.author.avatar for p in posts])
+        self.assertListEqual([self.tags, [], []], [p.tags for p in posts])
+
+    def test_compact(self):
+        posts = PostsSearch(relations=['author.avatar', 'tags'], compact=True, properties=[])()
+        self.assertListEqual([p.key for p in self.posts], [p.key for p in posts])
+        self.assertIsInstance(posts[0].author, NodeRecord)
+        self.assertEqual(self.authors[0].key, posts[0].author.key)
+        self.assertEqual(self.avatar.key, posts[2].author.avatar.key)
+        self.assertIsNone(posts[1].author.avatar)
+        self.assertListEqual([t.key for t in self.tags], [t.key for t in posts[0].tags])
+
+    def test_lazy(self):
+        with self.count_adjacency_searches() as adjacency_search:
+            posts = PostsSearch(relations=['author.avatar', 'tags'], lazy_relations=True)()
+            self.assertEqual(0, adjacency_search.call_count)
+            self.assertEqual(self.avatar, posts[2].author.avatar)
+            self.assertListEqual([], posts[1].tags)
+            self.assertEqual(2, adjacency_search.call_count)
+
 
 class ArcSearchTests(GAETestCase):
     def test_destinations_search(self):
@@ -174,6 +395,20 @@ class ArcSearchTests(GAETestCase):
         Arc(origin=origin.key, destination=destinations[0].key).put()
         self.assertIsNone(memcache.get(destinations_cache_key(Arc, origin)))
 
+    def test_empty_search_cached(self):
+        leaf, destination = mommy.save_one(Node), mommy.save_one(Node)
+        self.assertListEqual([], ArcDestinationsSearch(leaf)())
+        self.assertEqual(EMPTY_ADJACENCY, memcache.get(destinations_cache_key(Arc, leaf)))
+        with mock.patch.object(ndb.Query, 'fetch_async') as fetch_async:
+            self.assertListEqual([], ArcDestinationsSearch(leaf)())
+            self.assertDictEqual({(Arc, DESTINATIONS, leaf.key): []}, AdjacencySearch((Arc, DESTINATIONS, leaf))())
+        self.assertFalse(fetch_async.called)
+
+        # first arc creation invalidates empty list
+        Arc(leaf, destination).put()
+        self.assertIsNone(memcache.get(destinations_cache_key(Arc, leaf)))
+        self.assertListEqual([destination], ArcDestinationsSearch(leaf)())
+
     def test_destinations_search_with_relations(self):
         origin = Node()
         destinations = [Node() for i in xrange(3)]
@@ -285,6 +520,646 @@ class ArcSearchTests(GAETestCase):
         self.assertListEqual(origin_origins, search.result.origin_origins)
 
 
+class WeightedArc(Arc):
+    weight = ndb.IntegerProperty(default=0)
+
+    @classmethod
+    def orderings(cls):
+        orderings = super(WeightedArc, cls).orderings()
+        orderings['weight'] = -cls.weight
+        return orderings
+
+
+class WeightedDestinationsSearch(DestinationsSearch):
+    arc_class = WeightedArc
+
+
+class WeightedOriginsSearch(OriginsSearch):
+    arc_class = WeightedArc
+
+
+class OrderedArcSearchTests(GAETestCase):
+    def setUp(self):
+        super(OrderedArcSearchTests, self).setUp()
+        self.origin = mommy.save_one(Node)
+        self.destinations = [mommy.save_one(Node) for i in xrange(4)]
+        for weight, d in zip([2, 4, 1, 3], self.destinations):
+            WeightedArc(self.origin, d, weight=weight).put()
+
+    def test_named_orderings(self):
+        self.assertListEqual(self.destinations, WeightedDestinationsSearch(self.origin)())
+        self.assertListEqual(self.destinations[::-1], WeightedDestinationsSearch(self.origin, order='creation_desc')())
+        by_weight = [self.destinations[i] for i in (1, 3, 0, 2)]
+        self.assertListEqual(by_weight, WeightedDestinationsSearch(self.origin, order='weight')())
+        self.assertListEqual([self.origin], WeightedOriginsSearch(self.destinations[0], order='weight')())
+
+        # each ordering has its own cache entry
+        cached = memcache.get(destinations_cache_key(WeightedArc, self.origin, 'weight'))
+        self.assertListEqual([d.key for d in by_weight], cached)
+        cached = memcache.get(destinations_cache_key(WeightedArc, self.origin))
+        self.assertListEqual([d.key for d in self.destinations], cached)
+
+    def test_invalidation_of_all_orderings(self):
+        WeightedDestinationsSearch(self.origin)()
+        WeightedDestinationsSearch(self.origin, order='weight')()
+        WeightedOriginsSearch(self.destinations[0], order='creation_desc')()
+        new_destination = mommy.save_one(Node)
+        WeightedArc(self.origin, new_destination, weight=5).put()
+        WeightedArc(self.destinations[1], self.destinations[0]).put()
+        self.assertIsNone(memcache.get(destinations_cache_key(WeightedArc, self.origin)))
+        self.assertIsNone(memcache.get(destinations_cache_key(WeightedArc, self.origin, 'weight')))
+        self.assertIsNone(memcache.get(origins_cache_key(WeightedArc, self.destinations[0], 'creation_desc')))
+        self.assertEqual(new_destination, WeightedDestinationsSearch(self.origin, order='weight')()[0])
+
+        DeleteArcsWeighted(self.origin, new_destination)()
+        self.assertIsNone(memcache.get(destinations_cache_key(WeightedArc, self.origin, 'weight')))
+
+    def test_top_k(self):
+        search = WeightedDestinationsSearch(self.origin, order='weight', limit=2)
+        self.assertListEqual([self.destinations[1], self.destinations[3]], search())
+        self.assertTrue(search.more)
+        search = WeightedDestinationsSearch(self.origin, order='weight', limit=2, offset=2)
+        self.assertListEqual([self.destinations[0], self.destinations[2]], search())
+        self.assertFalse(search.more)
+        # the complete ordering is cached even when only a page was requested
+        cached = memcache.get(destinations_cache_key(WeightedArc, self.origin, 'weight'))
+        self.assertEqual(4, len(cached))
+
+    def test_not_existing_ordering(self):
+        self.assertRaises(Exception, WeightedDestinationsSearch(self.origin, order='not existing'))
+
+
+class DeleteArcsWeighted(DeleteArcs):
+    arc_class = WeightedArc
+
+
+class StatusArc(Arc):
+    status = ndb.StringProperty(default='active')
+
+
+class StatusArcSearch(ArcSearch):
+    arc_class = StatusArc
+
+
+class StatusDestinationsSearch(DestinationsSearch):
+    arc_class = StatusArc
+
+
+class StatusOriginsSearch(OriginsSearch):
+    arc_class = StatusArc
+
+
+class FilteredArcSearchTests(GAETestCase):
+    def setUp(self):
+        super(FilteredArcSearchTests, self).setUp()
+        self.origin = mommy.save_one(Node)
+        self.destinations = [mommy.save_one(Node) for i in xrange(4)]
+        for status, d in zip(['active', 'blocked', 'active', 'blocked'], self.destinations):
+            StatusArc(self.origin, d, status=status).put()
+
+    def test_arc_search(self):
+        arcs = StatusArcSearch(self.origin, filters=[StatusArc.status == 'blocked'], keys_only=False)()
+        self.assertListEqual([self.destinations[1].key, self.destinations[3].key], [a.destination for a in arcs])
+
+    def test_filtered_nodes_search(self):
+        active = [StatusArc.status == 'active']
+        self.assertListEqual(self.destinations[::2], StatusDestinationsSearch(self.origin, filters=active)())
+        self.assertListEqual([self.origin], StatusOriginsSearch(self.destinations[0], filters=active)())
+        self.assertListEqual([], StatusOriginsSearch(self.destinations[1], filters=active)())
+        blocked = [StatusArc.status == 'blocked']
+        self.assertListEqual(self.destinations[1::2], StatusDestinationsSearch(self.origin, filters=blocked)())
+        # unfiltered list is still cached under its own key
+        self.assertListEqual(self.destinations, StatusDestinationsSearch(self.origin)())
+        self.assertEqual(4, len(memcache.get(destinations_cache_key(StatusArc, self.origin))))
+
+    def test_filtered_cache(self):
+        active = [StatusArc.status == 'active']
+        StatusDestinationsSearch(self.origin, filters=active)()
+        # Changing datastore bypassing hooks to prove cache is used
+        ndb.delete_multi(StatusArc.query().fetch(keys_only=True), use_cache=False)
+        self.assertListEqual(self.destinations[::2], StatusDestinationsSearch(self.origin, filters=active)())
+
+        # Any arc write invalidates filtered entries
+        new_destination = mommy.save_one(Node)
+        StatusArc(self.origin, new_destination).put()
+        self.assertListEqual([new_destination], StatusDestinationsSearch(self.origin, filters=active)())
+
+    def test_creation_range(self):
+        start = datetime.now()
+        recent = mommy.save_one(Node)
+        StatusArc(self.origin, recent).put()
+        self.assertListEqual([recent], StatusDestinationsSearch(self.origin, filters=[StatusArc.creation >= start])())
+
+
+class AdjacencySearchTests(GAETestCase):
+    def test_search(self):
+        origin, middle, destination = [mommy.save_one(Node) for i in xrange(3)]
+        CreateArcStub(origin, middle)()
+        CreateArcStub(middle, destination)()
+        ArcDestinationsSearch(origin)()  # filling cache
+        specs = [(Arc, DESTINATIONS, origin), (Arc, DESTINATIONS, middle), (Arc, ORIGINS, middle),
+                 (Arc, ORIGINS, origin)]
+        result = AdjacencySearch(*specs)()
+        self.assertDictEqual({(Arc, DESTINATIONS, origin.key): [middle.key],
+                              (Arc, DESTINATIONS, middle.key): [destination.key],
+                              (Arc, ORIGINS, middle.key): [origin.key],
+                              (Arc, ORIGINS, origin.key): []}, result)
+        # cache entries are shared with DestinationsSearch and OriginsSearch
+        self.assertListEqual([destination.key], memcache.get(destinations_cache_key(Arc, middle)))
+        self.assertListEqual([origin.key], memcache.get(origins_cache_key(Arc, middle)))
+        self.assertListEqual([origin], ArcOriginsSearch(middle)())
+
+
+class FollowArc(Arc):
+    origin_shards = 4
+    sharding_threshold = 5
+
+
+class CreateFollow(CreateArc):
+    arc_class = FollowArc
+
+
+class DeleteFollows(DeleteArcs):
+    arc_class = FollowArc
+
+
+class FollowersSearch(OriginsSearch):
+    arc_class = FollowArc
+
+
+class ShardedOriginsTests(GAETestCase):
+    def setUp(self):
+        super(ShardedOriginsTests, self).setUp()
+        self.celebrity = mommy.save_one(Node)
+        self.followers = [mommy.save_one(Node) for i in xrange(8)]
+
+    def test_promotion(self):
+        for follower in self.followers[:4]:
+            CreateFollow(follower, self.celebrity)()
+        self.assertListEqual(self.followers[:4], FollowersSearch(self.celebrity)())
+        self.assertIsNone(memcache.get(origins_sharded_key(FollowArc, self.celebrity)))
+
+        CreateFollow(self.followers[4], self.celebrity)()
+        self.assertListEqual(self.followers[:5], FollowersSearch(self.celebrity)())
+        self.assertTrue(memcache.get(origins_sharded_key(FollowArc, self.celebrity)))
+        self.assertIsNone(memcache.get(origins_cache_key(FollowArc, self.celebrity)))
+        shards = memcache.get_multi([origins_shard_cache_key(FollowArc, self.celebrity, s) for s in xrange(4)])
+        self.assertEqual(4, len(shards))
+        self.assertEqual(5, sum(len(entries) for entries in shards.itervalues()))
+
+    def test_writes_invalidate_only_origin_shard(self):
+        for follower in self.followers[:6]:
+            CreateFollow(follower, self.celebrity)()
+        FollowersSearch(self.celebrity)()  # promoting
+        shard = origin_shard(FollowArc, self.followers[6])
+        CreateFollow(self.followers[6], self.celebrity)()
+        shard_keys = [origins_shard_cache_key(FollowArc, self.celebrity, s) for s in xrange(4)]
+        cached = memcache.get_multi(shard_keys)
+        self.assertSetEqual(set(shard_keys) - {shard_keys[shard]}, set(cached.iterkeys()))
+
+        # merged shards keep creation ordering, for default and named orderings
+        self.assertListEqual(self.followers[:7], FollowersSearch(self.celebrity)())
+        self.assertListEqual(self.followers[:7], FollowersSearch(self.celebrity)())
+        self.assertListEqual(list(reversed(self.followers[:7])),
+                             FollowersSearch(self.celebrity, order='creation_desc')())
+        self.assertListEqual(self.followers[2:4], FollowersSearch(self.celebrity, limit=2, offset=2)())
+
+        DeleteFollows(self.followers[0], self.celebrity)()
+        self.assertListEqual(self.followers[1:7], FollowersSearch(self.celebrity)())
+
+    def test_evicted_shards_and_flag(self):
+        for follower in self.followers:
+            CreateFollow(follower, self.celebrity)()
+        FollowersSearch(self.celebrity)()  # promoting
+        memcache.delete(origins_shard_cache_key(FollowArc, self.celebrity, 0))
+        self.assertListEqual(self.followers, FollowersSearch(self.celebrity)())
+        memcache.flush_all()
+        self.assertListEqual(self.followers, FollowersSearch(self.celebrity)())
+        self.assertTrue(memcache.get(origins_sharded_key(FollowArc, self.celebrity)))
+
+    def test_demotion(self):
+        for follower in self.followers[:6]:
+            CreateFollow(follower, self.celebrity)()
+        FollowersSearch(self.celebrity)()  # promoting
+        DeleteFollows(self.followers[0], self.celebrity)()
+        DeleteFollows(self.followers[1], self.celebrity)()
+        self.assertListEqual(self.followers[2:6], FollowersSearch(self.celebrity)())
+        self.assertIsNone(memcache.get(origins_sharded_key(FollowArc, self.celebrity)))
+        self.assertListEqual(self.followers[2:6], FollowersSearch(self.celebrity)())
+        self.assertListEqual([f.key for f in self.followers[2:6]],
+                             memcache.get(origins_cache_key(FollowArc, self.celebrity)))
+
+    def test_adjacency_search(self):
+        for follower in self.followers:
+            CreateFollow(follower, self.celebrity)()
+        spec = (FollowArc, ORIGINS, self.celebrity.key)
+        followers_keys = [f.key for f in self.followers]
+        self.assertListEqual(followers_keys, AdjacencySearch(spec)()[spec])  # promoting
+        self.assertTrue(memcache.get(origins_sharded_key(FollowArc, self.celebrity)))
+        self.assertIsNone(memcache.get(origins_cache_key(FollowArc, self.celebrity)))
+
+        CreateFollow(self.followers[0], self.celebrity)()
+        with mock.patch.object(ndb.Query, 'fetch_async', autospec=True,
+                               side_effect=ndb.Query.fetch_async) as fetch_async:
+            self.assertListEqual(followers_keys + [self.followers[0].key], AdjacencySearch(spec)()[spec])
+        self.assertEqual(1, fetch_async.call_count)  # only the invalidated shard is queried
+        self.assertIsNone(memcache.get(origins_cache_key(FollowArc, self.celebrity)))
+
+    def test_sharding_disabled_by_default(self):
+        self.assertIsNone(Arc.sharding_threshold)
+        for follower in self.followers[:6]:
+            Arc(follower, self.celebrity).put()
+        for arc in Arc.query().fetch():
+            entity = datastore.Get(arc.key.to_old_key())
+            del entity['origin_shard']  # stored before origin_shard existed
+            datastore.Put(entity)
+        self.assertListEqual(self.followers[:6], ArcOriginsSearch(self.celebrity)())
+        CreateArcStub(self.followers[6], self.celebrity)()
+        self.assertListEqual(self.followers[:7], ArcOriginsSearch(self.celebrity)())
+        self.assertIsNone(memcache.get(origins_sharded_key(Arc, self.celebrity)))
+
+    def test_backfill_origin_shards(self):
+        for follower in self.followers:
+            CreateFollow(follower, self.celebrity)()
+        legacy = FollowArc.query().get()
+        entity = datastore.Get(legacy.key.to_old_key())
+        del entity['origin_shard']  # stored before origin_shard existed
+        datastore.Put(entity)
+        shard = origin_shard(FollowArc, legacy.origin)
+        self.assertNotIn(legacy.key, FollowArc.query(FollowArc.origin_shard == shard).fetch(keys_only=True))
+
+        backfill_origin_shards(FollowArc, batch_size=3)
+        taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        tasks = 0
+        while taskqueue_stub.get_filtered_tasks():
+            for task in taskqueue_stub.get_filtered_tasks():
+                taskqueue_stub.DeleteTask('default', task.name)
+                deferred.run(task.payload)
+                tasks += 1
+        self.assertEqual(3, tasks)
+        self.assertIn(legacy.key, FollowArc.query(FollowArc.origin_shard == shard).fetch(keys_only=True))
+
+
+class ExpiringFollowArc(Arc):
+    origin_shards = 2
+    sharding_threshold = 3
+    cache_ttl = 60
+    max_cached_length = 2
+
+
+class ExpiringFollowersSearch(OriginsSearch):
+    arc_class = ExpiringFollowArc
+
+
+class ShardCachePolicyTests(GAETestCase):
+    def test_ttl_and_max_length(self):
+        celebrity = mommy.save_one(Node)
+        followers = [mommy.save_one(Node) for i in xrange(5)]
+        ndb.put_multi([ExpiringFollowArc(f, celebrity) for f in followers])
+        shard_keys = [origins_shard_cache_key(ExpiringFollowArc, celebrity, s) for s in xrange(2)]
+        sizes = [len([f for f in followers if origin_shard(ExpiringFollowArc, f) == s]) for s in xrange(2)]
+        with mock.patch.object(cache, 'set_multi', wraps=cache.set_multi) as set_multi:
+            self.assertListEqual(followers, ExpiringFollowersSearch(celebrity)())  # promoting
+        self.assertEqual(60, set_multi.call_args[1]['time'])
+        self.assertTrue(memcache.get(origins_sharded_key(ExpiringFollowArc, celebrity)))
+        cached = memcache.get_multi(shard_keys)
+        self.assertSetEqual({k for k, size in zip(shard_keys, sizes) if size <= 2}, set(cached))
+
+        with mock.patch.object(cache, 'set_multi', wraps=cache.set_multi) as set_multi:
+            self.assertListEqual(followers, ExpiringFollowersSearch(celebrity)())
+        self.assertEqual(60, set_multi.call_args[1]['time'])
+        self.assertSetEqual({k for k, size in zip(shard_keys, sizes) if size <= 2}, set(memcache.get_multi(shard_keys)))
+
+
+class ConsistentArc(Arc):
+    consistent_destinations = True
+    stale_window = 5
+
+
+class GuardedArc(Arc):
+    stale_window = 5
+
+
+class CreateConsistentArc(CreateArc):
+    arc_class = ConsistentArc
+
+
+class ConsistentDestinationsSearch(DestinationsSearch):
+    arc_class = ConsistentArc
+
+
+class ConsistentOriginsSearch(OriginsSearch):
+    arc_class = ConsistentArc
+
+
+class CreateGuardedArc(CreateArc):
+    arc_class = GuardedArc
+
+
+class GuardedDestinationsSearch(DestinationsSearch):
+    arc_class = GuardedArc
+
+
+class ConsistencyTests(GAETestCase):
+    def setUp(self):
+        super(ConsistencyTests, self).setUp()
+        self.datastore_stub = self.testbed.get_stub(testbed.DATASTORE_SERVICE_NAME)
+        self.origin, self.destination = mommy.save_one(Node), mommy.save_one(Node)
+        # writes are never visible to global queries until policy changes
+        self.datastore_stub.SetConsistencyPolicy(datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=0))
+
+    def apply_writes(self):
+        self.datastore_stub.SetConsistencyPolicy(datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+        ndb.get_context().clear_cache()
+
+    def test_consistent_destinations(self):
+        arc = CreateConsistentArc(self.origin, self.destination)()
+        self.assertEqual(self.origin.key, arc.key.parent())
+        # origins are still read with global queries, so result is not cached while fenced
+        self.assertIsNotNone(memcache.get(origins_fence_key(ConsistentArc, self.destination)))
+        self.assertIsNone(memcache.get(destinations_fence_key(ConsistentArc, self.origin)))
+        self.assertListEqual([], ConsistentOriginsSearch(self.destination)())
+        self.assertIsNone(memcache.get(origins_cache_key(ConsistentArc, self.destination)))
+
+        self.assertListEqual([self.destination], ConsistentDestinationsSearch(self.origin)())
+        self.assertListEqual([self.destination.key],
+                             memcache.get(destinations_cache_key(ConsistentArc, self.origin)))
+        self.apply_writes()
+        self.assertListEqual([self.origin], ConsistentOriginsSearch(self.destination)())
+
+    def test_stale_results_are_not_cached(self):
+        CreateGuardedArc(self.origin, self.destination)()
+        self.assertListEqual([], GuardedDestinationsSearch(self.origin)())
+        self.assertIsNone(memcache.get(destinations_cache_key(GuardedArc, self.origin)))
+
+        self.apply_writes()
+        self.assertListEqual([self.destination], GuardedDestinationsSearch(self.origin)())
+        spec = (GuardedArc, DESTINATIONS, self.origin.key)
+        self.assertDictEqual({spec: [self.destination.key]}, AdjacencySearch(spec)())
+        self.assertIsNone(memcache.get(destinations_cache_key(GuardedArc, self.origin)))
+        memcache.delete(destinations_fence_key(GuardedArc, self.origin))  # stale window expired
+        self.assertListEqual([self.destination], GuardedDestinationsSearch(self.origin)())
+        self.assertListEqual([self.destination.key], memcache.get(destinations_cache_key(GuardedArc, self.origin)))
+
+
+class FanOutTests(GAETestCase):
+    def test_search(self):
+        user, friend, post, group = [mommy.save_one(Node) for i in xrange(4)]
+        CreateConsistentArc(user, friend)()
+        CreateConsistentArc(user, post)()
+        CreateGuardedArc(user, post)()
+        CreateFollow(group, user)()
+        ConsistentDestinationsSearch(user)()  # filling cache
+        result = FanOutSearch(user, [ConsistentArc, GuardedArc, (FollowArc, ORIGINS), StatusArc])()
+        self.assertDictEqual({ConsistentArc: [friend, post], GuardedArc: [post], FollowArc: [group], StatusArc: []},
+                             result)
+        self.assertListEqual([group.key], memcache.get(origins_cache_key(FollowArc, user)))
+
+        records = FanOutSearch(user.key.id(), [(FollowArc, ORIGINS)], compact=True, properties=['creation'])()
+        self.assertEqual(group.key, records[FollowArc][0].key)
+        self.assertIsInstance(records[FollowArc][0], NodeRecord)
+
+    def test_both_directions(self):
+        user, followed, follower, post = [mommy.save_one(Node) for i in xrange(4)]
+        CreateFollow(user, followed)()
+        CreateFollow(follower, user)()
+        CreateGuardedArc(user, post)()
+        result = FanOutSearch(user, [FollowArc, (FollowArc, ORIGINS), GuardedArc, (FollowArc, DESTINATIONS)])()
+        self.assertDictEqual({(FollowArc, DESTINATIONS): [followed], (FollowArc, ORIGINS): [follower],
+                              GuardedArc: [post]}, result)
+
+
+class ActivityArc(Arc):
+    creation_bucket_seconds = 3600
+
+
+class ActivitySearch(DestinationsSearch):
+    arc_class = ActivityArc
+
+
+class ActivityOriginsSearch(OriginsSearch):
+    arc_class = ActivityArc
+
+
+class DeleteActivities(DeleteArcs):
+    arc_class = ActivityArc
+
+
+class TimeWindowTests(GAETestCase):
+    def setUp(self):
+        super(TimeWindowTests, self).setUp()
+        self.now = datetime.utcnow()
+        self.origin = mommy.save_one(Node)
+        self.destinations = [mommy.save_one(Node) for i in xrange(5)]
+        self.creations = [self.now - timedelta(hours=h) for h in (30, 20, 5, 4.9, 0)]
+        for destination, creation in zip(self.destinations, self.creations):
+            ActivityArc(self.origin, destination, creation=creation).put()
+
+    def bucket_key(self, creation):
+        return destinations_bucket_cache_key(ActivityArc, self.origin, creation_bucket(ActivityArc, creation))
+
+    def test_window(self):
+        since = self.now - timedelta(hours=24)
+        self.assertListEqual(self.destinations[1:], ActivitySearch(self.origin, since=since)())
+        self.assertListEqual(list(reversed(self.destinations[1:])),
+                             ActivitySearch(self.origin, order='creation_desc', since=since)())
+        self.assertListEqual(self.destinations[1:3], ActivitySearch(self.origin, since=since, limit=2)())
+        self.assertListEqual(self.destinations[1:2],
+                             ActivitySearch(self.origin, since=since, until=self.now - timedelta(hours=10))())
+        self.assertListEqual([self.origin], ActivityOriginsSearch(self.destinations[2], since=since)())
+        self.assertListEqual([], ActivityOriginsSearch(self.destinations[0], since=since)())
+        self.assertIsNone(memcache.get(destinations_cache_key(ActivityArc, self.origin)))
+        self.assertRaises(Exception, ActivitySearch, self.origin, order='weight', since=since)
+
+    def test_buckets_reuse_and_invalidation(self):
+        since = self.now - timedelta(hours=24)
+        ActivitySearch(self.origin, since=since)()
+        # closed buckets are cached, empty ones too, but not the current one
+        self.assertListEqual([self.destinations[1].key], memcache.get(self.bucket_key(self.creations[1])))
+        self.assertListEqual([], memcache.get(self.bucket_key(self.now - timedelta(hours=10))))
+        self.assertIsNone(memcache.get(self.bucket_key(self.now)))
+        self.assertIsNone(memcache.get(self.bucket_key(self.creations[0])))
+
+        # a rolling window reads the bucket from cache
+        memcache.set(self.bucket_key(self.creations[1]), [self.destinations[0].key])
+        window = ActivitySearch(self.origin, since=since + timedelta(minutes=30))()
+        self.assertEqual(self.destinations[0], window[0])
+        memcache.delete(self.bucket_key(self.creations[1]))
+
+        origins_bucket_key = origins_bucket_cache_key(ActivityArc, self.destinations[2],
+                                                      creation_bucket(ActivityArc, self.creations[2]))
+        ActivityOriginsSearch(self.destinations[2], since=since)()
+        self.assertListEqual([self.origin.key], memcache.get(origins_bucket_key))
+        DeleteActivities(self.origin, self.destinations[2])()
+        self.assertIsNone(memcache.get(self.bucket_key(self.creations[2])))
+        self.assertIsNone(memcache.get(origins_bucket_key))
+        self.assertListEqual([self.destinations[1], self.destinations[3], self.destinations[4]],
+                             ActivitySearch(self.origin, since=self.now - timedelta(hours=21))())
+
+    def test_filtered_window(self):
+        since = self.now - timedelta(hours=24)
+        filters = [ActivityArc.destination.IN([d.key for d in self.destinations[:3]])]
+        self.assertListEqual(self.destinations[1:3], ActivitySearch(self.origin, since=since, filters=filters)())
+        self.assertIsNone(memcache.get(self.bucket_key(self.creations[1])))
+
+
+class PolicyArc(Arc):
+    cache_ttl = 60
+    max_cached_length = 2
+    cache_admission_misses = 2
+
+
+class PolicySearch(DestinationsSearch):
+    arc_class = PolicyArc
+
+
+class CachePolicyTests(GAETestCase):
+    def setUp(self):
+        super(CachePolicyTests, self).setUp()
+        self.origin, self.long_origin = mommy.save_one(Node), mommy.save_one(Node)
+        self.destinations = [mommy.save_one(Node) for i in xrange(3)]
+        ndb.put_multi([PolicyArc(self.origin, d) for d in self.destinations[:2]] +
+                      [PolicyArc(self.long_origin, d) for d in self.destinations])
+
+    def test_admission_and_ttl(self):
+        cache_key = destinations_cache_key(PolicyArc, self.origin)
+        self.assertListEqual(self.destinations[:2], PolicySearch(self.origin)())
+        self.assertIsNone(memcache.get(cache_key))
+        with mock.patch.object(cache, 'set_multi', wraps=cache.set_multi) as set_multi:
+            self.assertListEqual(self.destinations[:2], PolicySearch(self.origin)())
+        set_multi.assert_called_once_with({cache_key: [d.key for d in self.destinations[:2]]}, time=60)
+        self.assertListEqual([d.key for d in self.destinations[:2]], memcache.get(cache_key))
+
+        # AdjacencySearch follows the same policy
+        spec = (PolicyArc, ORIGINS, self.destinations[0])
+        AdjacencySearch(spec)()
+        self.assertIsNone(memcache.get(origins_cache_key(PolicyArc, self.destinations[0])))
+        AdjacencySearch(spec)()
+        self.assertListEqual([self.origin.key, self.long_origin.key],
+                             memcache.get(origins_cache_key(PolicyArc, self.destinations[0])))
+
+    def test_max_cached_length(self):
+        for _ in xrange(3):
+            self.assertListEqual(self.destinations, PolicySearch(self.long_origin)())
+        self.assertIsNone(memcache.get(destinations_cache_key(PolicyArc, self.long_origin)))
+
+
+class DanglingReferenceTests(GAETestCase):
+    def setUp(self):
+        super(DanglingReferenceTests, self).setUp()
+        self.taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+
+    def run_tasks(self):
+        tasks = self.taskqueue_stub.get_filtered_tasks()
+        self.taskqueue_stub.FlushQueue('default')
+        for task in tasks:
+            deferred.run(task.payload)
+        return len(tasks)
+
+    def test_repair_and_cleanup(self):
+        origin, deleted, kept = [mommy.save_one(Node) for i in xrange(3)]
+        ndb.put_multi([Arc(origin, deleted), Arc(origin, kept), Arc(deleted, kept)])
+        self.assertListEqual([deleted, kept], ArcDestinationsSearch(origin)())
+        deleted.key.delete()
+
+        self.assertListEqual([kept], ArcDestinationsSearch(origin)())
+        self.assertListEqual([kept.key], memcache.get(destinations_cache_key(Arc, origin)))
+        self.assertListEqual([kept.key], [r.key for r in ArcDestinationsSearch(origin, compact=True)()])
+        self.assertEqual(1, self.run_tasks())  # repaired list does not schedule cleanup again
+        self.assertListEqual([kept.key], [arc.destination for arc in Arc.find_destinations(origin).fetch()])
+        self.assertListEqual([kept], ArcDestinationsSearch(origin)())
+
+        self.assertListEqual([origin], ArcOriginsSearch(kept)())
+        self.assertEqual(1, self.run_tasks())
+        self.assertListEqual([origin.key], [arc.origin for arc in Arc.find_origins(kept).fetch()])
+
+    def test_invalidated_entry_is_not_repaired(self):
+        origin, deleted, kept = [mommy.save_one(Node) for i in xrange(3)]
+        ndb.put_multi([Arc(origin, deleted), Arc(origin, kept)])
+        cache_key = destinations_cache_key(Arc, origin)
+        ArcDestinationsSearch(origin)()
+        deleted.key.delete()
+        get_multi = ndb.get_multi
+
+        def invalidating_get_multi(*args, **kwargs):
+            cache.delete_multi([cache_key])  # arc written by a concurrent request
+            return get_multi(*args, **kwargs)
+
+        with mock.patch.object(ndb, 'get_multi', side_effect=invalidating_get_multi):
+            self.assertListEqual([kept], ArcDestinationsSearch(origin)())
+        self.assertIsNone(memcache.get(cache_key))
+
+    def test_cleanup_scheduled_once(self):
+        origin, deleted = mommy.save_one(Node), mommy.save_one(Node)
+        Arc(origin, deleted).put()
+        deleted.key.delete()
+        for i in xrange(3):
+            self.assertListEqual([], ArcDestinationsSearch(origin)())
+            memcache.delete(destinations_cache_key(Arc, origin))
+        self.assertEqual(1, self.run_tasks())
+        self.assertListEqual([], Arc.find_destinations(origin).fetch())
+
+    def test_deleted_first_neighbor_is_skipped_on_limited_searches(self):
+        origin = mommy.save_one(Node)
+        destinations = [mommy.save_one(Node) for i in xrange(4)]
+        ndb.put_multi([Arc(origin, d) for d in destinations])
+        destinations[0].key.delete()
+        destinations[1].key.delete()
+        self.assertEqual(destinations[2], SingleDestinationArcSearch(origin)())
+        self.assertEqual(destinations[2], SingleDestinationArcSearch(origin)())  # from cache
+        cmd = ArcDestinationsSearch(origin, limit=1)
+        self.assertListEqual([destinations[2]], cmd())
+        self.assertTrue(cmd.more)
+        cmd = ArcDestinationsSearch(origin, limit=3)
+        self.assertListEqual(destinations[2:], cmd())
+        self.assertFalse(cmd.more)
+        destinations[2].key.delete()
+        self.assertEqual(origin, SingleOriginArcSearch(destinations[3])())
+        self.assertEqual(destinations[3], SingleDestinationArcSearch(origin)())
+
+    def test_node_created_again(self):
+        origin, destination = mommy.save_one(Node), mommy.save_one(Node)
+        Arc(origin, destination).put()
+        destination.key.delete()
+        self.assertListEqual([], ArcDestinationsSearch(origin)())
+        destination.put()
+        self.run_tasks()
+        self.assertListEqual([destination], ArcDestinationsSearch(origin)())
+
+
+class PathSearchExample(PathSearch):
+    arc_class = Arc
+
+
+class PathSearchTests(GAETestCase):
+    def setUp(self):
+        super(PathSearchTests, self).setUp()
+        self.nodes = [mommy.save_one(Node) for i in xrange(7)]
+        n = self.nodes
+        # 0 -> 1 -> 2 -> 3 -> 4 and shortcut 0 -> 5 -> 3 and 6 isolated
+        for o, d in [(0, 1), (1, 2), (2, 3), (3, 4), (0, 5), (5, 3)]:
+            CreateArcStub(n[o], n[d])()
+
+    def test_shortest_path(self):
+        n = self.nodes
+        self.assertListEqual([n[0].key, n[5].key, n[3].key, n[4].key], PathSearchExample(n[0], n[4])())
+        self.assertListEqual([n[1].key, n[2].key], PathSearchExample(n[1], n[2])())
+        self.assertListEqual([n[2].key], PathSearchExample(n[2], n[2])())
+
+    def test_not_connected(self):
+        n = self.nodes
+        self.assertIsNone(PathSearchExample(n[4], n[0])())
+        self.assertIsNone(PathSearchExample(n[0], n[6])())
+
+    def test_limits(self):
+        n = self.nodes
+        self.assertIsNone(PathSearchExample(n[0], n[4], max_hops=2)())
+        self.assertEqual(4, len(PathSearchExample(n[0], n[4], max_hops=3)()))
+        cmd = PathSearchExample(n[0], n[4], max_visited=2)
+        self.assertIsNone(cmd())
+        self.assertGreater(cmd.visited, 2)
+
+
 class NodeStub(Node):
     name = ndb.StringProperty(required=True)
     age = ndb.IntegerProperty(required=True)
@@ -316,6 +1191,82 @@ class GaeBusinessCommandsShortcutsTests(GAETestCase):
         self.assertListEqual(node_keys, DeleteNode(*nodes).model_keys)
 
 
+class NodeSearchMemoTests(GAETestCase):
+    def test_shared_search(self):
+        node = mommy.save_one(NodeStub)
+        other = mommy.save_one(Node)
+        with mock.patch.object(ndb.Key, 'get_async', autospec=True, side_effect=ndb.Key.get_async) as get_async:
+            searches = CommandParallel(NodeSearch(node), NodeSearch(node.key.id()), NodeSearch(other))
+            searches()
+            self.assertEqual(2, get_async.call_count)
+            self.assertIs(searches[0].result, searches[1].result)
+            self.assertEqual(node, NodeSearch(node)())
+            # different arguments are searched on their own
+            NodeSearch(node, compact=True)()
+            self.assertEqual(2, get_async.call_count)
+
+    def test_memoized_errors(self):
+        class NodeStubSearch(NodeSearch):
+            _model_class = NodeStub
+
+        node = mommy.save_one(Node)
+        self.assertRaises(CommandExecutionException, NodeStubSearch(node))
+        cmd = NodeStubSearch(node)
+        self.assertRaises(CommandExecutionException, cmd)
+        self.assertIn('node_error', cmd.errors)
+
+    def test_invalidation(self):
+        node = mommy.save_one(NodeStub, name='old', age=1)
+        self.assertEqual('old', NodeSearch(node)().name)
+        self.assertEqual(1, NodeSearch(node, compact=True)().age)
+        UpdateNodeStub(node.key, name='new', age='2')()
+        self.assertEqual('new', NodeSearch(node)().name)
+        self.assertEqual(2, NodeSearch(node, compact=True)().age)
+        DeleteNode(node)()
+        self.assertIsNone(NodeSearch(node)())
+        self.assertIsNone(NodeSearch(node, compact=True)())
+
+    def test_arc_invalidation(self):
+        origin, destination = mommy.save_one(Node), mommy.save_one(Node)
+        self.assertListEqual([], NodeSearchWithRelations(origin, relations=['destinations'])().destinations)
+        self.assertIsNone(NodeSearchWithRelations(destination, relations=['single'])().single)
+        CreateArcStub(origin, destination)()
+        self.assertListEqual([destination], NodeSearchWithRelations(origin, relations=['destinations'])().destinations)
+        self.assertEqual(origin, NodeSearchWithRelations(destination, relations=['single'])().single)
+        DeleteArcsExample(origin, destination)()
+        self.assertListEqual([], NodeSearchWithRelations(origin, relations=['destinations'])().destinations)
+        self.assertIsNone(NodeSearchWithRelations(destination, relations=['single'])().single)
+
+
+class UpdateNodeStubs(UpdateNodes):
+    _model_form_class = NodeForm
+    put_batch_size = 2
+
+
+class UpdateNodesTests(GAETestCase):
+    def test_same_parameters(self):
+        nodes = [mommy.save_one(NodeStub, name='old', age=1) for i in xrange(3)]
+        NodeSearch(nodes[0])()
+        missing_key = ndb.Key(NodeStub, 1000)
+        cmd = UpdateNodeStubs([nodes[0], nodes[1].key, nodes[2].key.id(), missing_key], name='new', age='2')
+        with mock.patch.object(ndb, 'put_multi_async', wraps=ndb.put_multi_async) as put_multi_async:
+            cmd()
+        self.assertEqual(2, put_multi_async.call_count)
+        self.assertItemsEqual([n.key for n in nodes], [n.key for n in cmd.result])
+        self.assertListEqual([missing_key], cmd.node_errors.keys())
+        for node in ndb.get_multi([n.key for n in nodes], use_cache=False, use_memcache=False):
+            self.assertEqual(('new', 2), (node.name, node.age))
+        self.assertEqual(2, NodeSearch(nodes[0], compact=True)().age)
+
+    def test_per_node_parameters(self):
+        valid, invalid = [mommy.save_one(NodeStub, name='old', age=1) for i in xrange(2)]
+        cmd = UpdateNodeStubs({valid.key: {'name': 'valid', 'age': '3'}, invalid.key: {'name': 'invalid', 'age': 'x'}})
+        self.assertListEqual([valid], cmd())
+        self.assertListEqual(['age'], cmd.node_errors[invalid.key].keys())
+        self.assertEqual('valid', valid.key.get(use_cache=False, use_memcache=False).name)
+        self.assertEqual('old', invalid.key.get(use_cache=False, use_memcache=False).name)
+
+
 class SeachArcsTests(GAETestCase):
     def test_both_nodes_none_error(self):
         self.assertRaises(Exception, ArcSearch(Arc), )
@@ -403,6 +1354,92 @@ class DeleteArcTests(GAETestCase):
         self.assertListEqual([], destinations_search())
 
 
+class DeleteArcPairsExample(DeleteArcPairs):
+    arc_class = ActivityArc
+    delete_batch_size = 2
+
+
+class DeleteArcPairsTests(GAETestCase):
+    def test_delete_pairs(self):
+        origin, other = mommy.save_one(Node), mommy.save_one(Node)
+        destinations = [mommy.save_one(Node) for i in xrange(3)]
+        old_creation = datetime.utcnow() - timedelta(days=2)
+        ndb.put_multi([ActivityArc(origin, d) for d in destinations] + [ActivityArc(origin, destinations[0]),
+                                                                        ActivityArc(other, destinations[0])])
+        ActivityArc(origin, destinations[1], creation=old_creation).put()
+        since = old_creation - timedelta(hours=1)
+        self.assertEqual(5, len(ActivitySearch(origin, since=since)()))
+        self.assertEqual(3, len(ActivityOriginsSearch(destinations[0])()))
+        bucket_key = destinations_bucket_cache_key(ActivityArc, origin, creation_bucket(ActivityArc, old_creation))
+        self.assertIsNotNone(memcache.get(bucket_key))
+
+        pairs = [(origin, destinations[0]), (origin.key, destinations[1].key), (origin.key.id(), destinations[0]),
+                 (other, origin)]
+        with mock.patch.object(ndb, 'delete_multi_async', wraps=ndb.delete_multi_async) as delete_multi_async, \
+                mock.patch.object(cache, 'delete_multi', wraps=cache.delete_multi) as delete_multi:
+            deleted = DeleteArcPairsExample(pairs)()
+        self.assertEqual(4, len(deleted))
+        self.assertEqual(2, delete_multi_async.call_count)
+        self.assertEqual(1, delete_multi.call_count)
+        self.assertIsNone(memcache.get(bucket_key))
+        self.assertListEqual([destinations[2]], ActivitySearch(origin)())
+        self.assertListEqual([destinations[2]], ActivitySearch(origin, since=since)())
+        self.assertListEqual([other], ActivityOriginsSearch(destinations[0])())
+
+
+class PayloadArc(Arc):
+    payload = ndb.StringProperty(indexed=False)
+
+
+class PayloadSearch(DestinationsSearch):
+    arc_class = PayloadArc
+
+
+class DeletePayloadArcs(DeleteArcs):
+    arc_class = PayloadArc
+
+
+class ProjectionTests(GAETestCase):
+    def test_arcs_not_fetched(self):
+        origin = mommy.save_one(Node)
+        destinations = [mommy.save_one(Node) for i in xrange(2)]
+        ndb.put_multi([PayloadArc(origin, d, payload='x' * 100) for d in destinations])
+        with mock.patch.object(ndb.Query, 'fetch_async', autospec=True,
+                               side_effect=ndb.Query.fetch_async) as fetch_async:
+            self.assertListEqual(destinations, PayloadSearch(origin)())
+            self.assertDictEqual({(PayloadArc, ORIGINS, destinations[0].key): [origin.key]},
+                                 AdjacencySearch((PayloadArc, ORIGINS, destinations[0]))())
+            deleted = DeletePayloadArcs(origin)()
+        projections = [[p._name for p in call[1]['projection']] for call in fetch_async.call_args_list]
+        self.assertListEqual([['destination', 'creation'], ['origin', 'creation'], ['destination', 'creation']],
+                             projections)
+        self.assertListEqual([d.key for d in destinations], [arc.destination for arc in deleted])
+        self.assertTrue(all(arc.origin == origin.key and arc.payload is None for arc in deleted))
+        self.assertListEqual([], PayloadArc.query().fetch())
+        self.assertListEqual([], PayloadSearch(origin)())
+
+    def test_missing_index_fallback(self):
+        origin = mommy.save_one(Node)
+        destinations = [mommy.save_one(Node) for i in xrange(2)]
+        ndb.put_multi([PayloadArc(origin, d) for d in destinations])
+        fetch_async = ndb.Query.fetch_async
+
+        def index_building(query, *args, **kwargs):
+            if kwargs.get('projection'):
+                future = ndb.Future()
+                future.set_exception(datastore_errors.NeedIndexError('index building'))
+                return future
+            return fetch_async(query, *args, **kwargs)
+
+        with mock.patch.object(ndb.Query, 'fetch_async', autospec=True, side_effect=index_building):
+            self.assertListEqual(destinations, PayloadSearch(origin)())
+            self.assertDictEqual({(PayloadArc, ORIGINS, destinations[0].key): [origin.key]},
+                                 AdjacencySearch((PayloadArc, ORIGINS, destinations[0]))())
+            deleted = DeletePayloadArcs(origin)()
+            self.assertListEqual([d.key for d in destinations], [arc.destination for arc in deleted])
+        self.assertListEqual([], PayloadArc.query().fetch())
+
+
 class CreateArcExample(CreateArc):
     arc_class = Arc
 
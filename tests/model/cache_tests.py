@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import time
+
+import mock
+from google.appengine.api import memcache
+
+from gaegraph import cache
+from gaegraph.business_base import DestinationsSearch
+from gaegraph.model import Node, Arc, destinations_cache_key, origins_fence_key
+from model.util import GAETestCase
+from mommygae import mommy
+
+
+class CachedArc(Arc):
+    pass
+
+
+class CachedArcSearch(DestinationsSearch):
+    arc_class = CachedArc
+
+
+class FencedCachedArc(Arc):
+    stale_window = 30
+
+
+def failing(*args, **kwargs):
+    raise Exception('memcache is down')
+
+
+class CircuitBreakerTests(GAETestCase):
+    def setUp(self):
+        super(CircuitBreakerTests, self).setUp()
+        self.breaker = cache.breaker
+        self.defaults = (self.breaker.failure_threshold, self.breaker.cool_down, self.breaker.slow_call_seconds,
+                         self.breaker.max_queued_invalidations)
+        self.breaker.failure_threshold = 2
+        self.breaker.cool_down = 60
+        self.breaker.reset()
+        self.breaker.generation()  # reading generation before patching memcache
+        self.origin, self.destination = mommy.save_one(Node), mommy.save_one(Node)
+
+    def tearDown(self):
+        (self.breaker.failure_threshold, self.breaker.cool_down, self.breaker.slow_call_seconds,
+         self.breaker.max_queued_invalidations) = self.defaults
+        self.breaker.reset()
+        super(CircuitBreakerTests, self).tearDown()
+
+    def test_trip_and_bypass(self):
+        CachedArc(self.origin, self.destination).put()
+        with mock.patch.object(memcache, 'get_multi', side_effect=failing) as get_multi, \
+                mock.patch.object(memcache, 'set_multi', side_effect=failing):
+            self.assertListEqual([self.destination], CachedArcSearch(self.origin)())
+            metrics = cache.metrics()
+            self.assertEqual(cache.OPEN, metrics['state'])
+            self.assertEqual(1, metrics['trips'])
+            self.assertEqual(2, metrics['failures'])
+
+            # memcache is not called anymore, searches go straight to datastore and results are not cached
+            self.assertListEqual([self.destination], CachedArcSearch(self.origin)())
+            self.assertEqual(1, get_multi.call_count)
+        self.assertIsNone(memcache.get(destinations_cache_key(CachedArc, self.origin)))
+        metrics = cache.metrics()
+        self.assertGreater(metrics['bypassed_calls'], 0)
+        self.assertGreater(metrics['degraded_seconds'], 0)
+
+    def test_slow_calls(self):
+        self.breaker.slow_call_seconds = 0.001
+
+        def slow_get(*args, **kwargs):
+            time.sleep(0.005)
+            return None
+
+        with mock.patch.object(memcache, 'get', side_effect=slow_get):
+            cache.get('a')
+            cache.get('a')
+        metrics = cache.metrics()
+        self.assertEqual(2, metrics['slow_calls'])
+        self.assertEqual(0, metrics['failures'])
+        self.assertEqual(cache.OPEN, metrics['state'])
+
+    def test_invalidations_replayed_on_recovery(self):
+        CachedArcSearch(self.origin)()
+        CachedArc(self.origin, self.destination).put()
+        cache_key = destinations_cache_key(CachedArc, self.origin)
+        memcache.set(cache_key, [])  # stale entry written by another instance
+        with mock.patch.object(memcache, 'delete_multi', side_effect=failing):
+            CachedArc(self.origin, self.destination).put()
+            CachedArc(self.origin, self.destination).put()
+        self.assertEqual(cache.OPEN, cache.metrics()['state'])
+        self.assertGreater(cache.metrics()['queued_invalidations'], 0)
+        self.assertIsNotNone(memcache.get(cache_key))
+
+        self.breaker.cool_down = 0
+        cache.get('any')  # trial call succeeds, closing circuit
+        metrics = cache.metrics()
+        self.assertEqual(cache.CLOSED, metrics['state'])
+        self.assertEqual(0, metrics['queued_invalidations'])
+        self.assertGreater(metrics['replayed_invalidations'], 0)
+        self.assertIsNone(memcache.get(cache_key))
+
+    def test_failed_return_values(self):
+        with mock.patch.object(memcache, 'set_multi', return_value=['a']):
+            self.assertFalse(cache.set_multi({'a': 1}))
+        with mock.patch.object(memcache, 'set', return_value=False):
+            self.assertFalse(cache.set_value('a', 1))
+        metrics = cache.metrics()
+        self.assertEqual(2, metrics['failures'])
+        self.assertEqual(cache.OPEN, metrics['state'])
+
+        self.breaker.reset()
+        with mock.patch.object(memcache, 'delete_multi', return_value=False):
+            cache.delete_multi(['a'])
+        self.assertEqual(1, cache.metrics()['failures'])
+        self.assertEqual(1, cache.metrics()['queued_invalidations'])
+
+    def test_fences_queued_while_open(self):
+        fence_key = origins_fence_key(FencedCachedArc, self.destination)
+        with mock.patch.object(memcache, 'delete_multi', side_effect=failing), \
+                mock.patch.object(memcache, 'set_multi', side_effect=failing):
+            FencedCachedArc(self.origin, self.destination).put()
+            FencedCachedArc(self.origin, self.destination).put()
+        self.assertEqual(cache.OPEN, cache.metrics()['state'])
+        self.assertIsNone(memcache.get(fence_key))
+        self.assertGreater(cache.metrics()['queued_fences'], 0)
+
+        self.breaker.cool_down = 0
+        cache.get('any')  # trial call succeeds, closing circuit
+        self.assertEqual(0, cache.metrics()['queued_fences'])
+        self.assertGreater(cache.metrics()['replayed_fences'], 0)
+        self.assertTrue(memcache.get(fence_key))
+
+    def test_failed_trial_opens_again(self):
+        self.breaker.cool_down = 0
+        with mock.patch.object(memcache, 'get', side_effect=failing) as get:
+            cache.get('a')
+            cache.get('a')
+            cache.get('a')  # trial
+            self.assertEqual(3, get.call_count)
+        self.assertEqual(1, cache.metrics()['trips'])
+        self.assertNotEqual(cache.CLOSED, cache.metrics()['state'])
+
+    def test_generation_bump_on_queue_overflow(self):
+        self.breaker.max_queued_invalidations = 1
+        cache.set_value('a', 1)
+        with mock.patch.object(memcache, 'delete_multi', side_effect=failing):
+            cache.delete_multi(['a'])
+            cache.delete_multi(['b'])
+        self.assertEqual(cache.OPEN, cache.metrics()['state'])
+        self.assertIsNone(cache.get('a'))  # breaker is open, so it is bypassed
+        self.assertEqual(1, memcache.get('a'))
+        self.breaker.cool_down = 0
+        cache.set_value('b', 2)  # trial closes the circuit and bumps generation
+        self.assertEqual(1, cache.metrics()['generation_bumps'])
+        self.assertIsNone(cache.get('a'))
+        cache.set_value('a', 3)
+        self.assertEqual(3, cache.get('a'))
+        self.assertEqual(1, memcache.get('a'))
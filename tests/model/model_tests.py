@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 import unittest
+from datetime import datetime
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 from gaegraph import model
-from gaegraph.model import Node, Arc, destinations_cache_key
+from gaegraph.model import Node, Arc, destinations_cache_key, origins_cache_key, destinations_cache_keys, \
+    filters_signature, batch_invalidation
 from model.util import GAETestCase
 from mommygae import mommy
 
@@ -51,6 +54,11 @@ class ModelTests(GAETestCase):
         dct = node.to_dict(include=['attr'])
         self.assertDictEqual({'attr': 'foo'}, dct)
 
+    def test_to_dict_does_not_change_exclude(self):
+        exclude = ['creation']
+        Node(id=1).to_dict(exclude=exclude)
+        self.assertListEqual(['creation'], exclude)
+
     def test_to_dict_of_not_saved_node(self):
         node = Node()
         self.assertItemsEqual(['creation'], node.to_dict().keys())
@@ -95,3 +103,48 @@ class ArcTests(GAETestCase):
 
         self.assertEqual("SubArc1", destinations_cache_key(SubArc, node))
 
+
+    def test_ordering_cache_keys(self):
+        node = Node(id=1)
+        self.assertEqual("Arc1:creation_desc", destinations_cache_key(Arc, node, 'creation_desc'))
+        self.assertEqual("oArc1:creation_desc", origins_cache_key(Arc, node, 'creation_desc'))
+        self.assertListEqual(["Arc1", "Arc1:creation", "Arc1:creation_desc", "Arc1:g"],
+                             destinations_cache_keys(Arc, node))
+
+    def test_order_for(self):
+        self.assertIs(Arc.creation, Arc.order_for())
+        self.assertIs(Arc.creation, Arc.order_for('creation'))
+        self.assertRaises(Exception, Arc.order_for, 'not existing')
+
+    def test_neighbors_with_ordering(self):
+        root = Node(id=1)
+        neighbors = [Node(id=i) for i in xrange(2, 5)]
+        ndb.put_multi(neighbors + [root])
+        for n in neighbors:
+            Arc(origin=root.key, destination=n.key).put()
+        searched_arcs = Arc.find_destinations(root, 'creation_desc').fetch(10)
+        neighbors_keys = [n.key for n in reversed(neighbors)]
+        self.assertListEqual(neighbors_keys, [a.destination for a in searched_arcs])
+        searched_arcs = Arc.find_origins(neighbors[0], 'creation_desc').fetch(10)
+        self.assertListEqual([root.key], [a.origin for a in searched_arcs])
+
+    def test_filters_signature(self):
+        class SignatureStatusArc(Arc):
+            status = ndb.StringProperty()
+
+        active = SignatureStatusArc.status == 'active'
+        recent = SignatureStatusArc.creation >= datetime(2014, 1, 1)
+        self.assertEqual(filters_signature([active, recent]), filters_signature([recent, active]))
+        self.assertEqual(filters_signature([active, recent]), filters_signature([ndb.AND(recent, active)]))
+        self.assertNotEqual(filters_signature([active]), filters_signature([SignatureStatusArc.status == 'blocked']))
+
+    def test_batch_invalidation(self):
+        origin, destination = Node(id=1), Node(id=2)
+        cache_key = destinations_cache_key(Arc, origin)
+        memcache.set(cache_key, [destination.key])
+        with batch_invalidation() as collected:
+            Arc(origin, destination).put()
+            Arc(origin, destination).put()
+            self.assertIsNotNone(memcache.get(cache_key))
+            self.assertIn(cache_key, collected)
+        self.assertIsNone(memcache.get(cache_key))
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+from google.appengine.ext import deferred, testbed, ndb
+
+from gaegraph.business_base import CreateArc, DeleteArcs
+from gaegraph.model import Node, Arc, batch_invalidation
+from gaegraph.recommendation import TwoHopIndex, TwoHopCandidatesSearch, TwoHopCandidates
+from model.util import GAETestCase
+
+
+class Knows(Arc):
+    pass
+
+
+class NotIndexedArc(Arc):
+    pass
+
+
+Knows._listeners = (TwoHopIndex(k=2, batch_size=2),)
+
+
+class CreateKnows(CreateArc):
+    arc_class = Knows
+
+
+class DeleteKnows(DeleteArcs):
+    arc_class = Knows
+
+
+class KnowsCandidatesSearch(TwoHopCandidatesSearch):
+    arc_class = Knows
+
+
+class TwoHopIndexTests(GAETestCase):
+    def setUp(self):
+        super(TwoHopIndexTests, self).setUp()
+        self.taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        self.nodes = [Node(id=i) for i in xrange(1, 8)]
+        ndb.put_multi(self.nodes)
+
+    def run_tasks(self):
+        executed = 0
+        tasks = self.taskqueue_stub.get_filtered_tasks()
+        while tasks:
+            self.taskqueue_stub.FlushQueue('default')
+            for task in tasks:
+                deferred.run(task.payload)
+                executed += 1
+            tasks = self.taskqueue_stub.get_filtered_tasks()
+        return executed
+
+    def candidates(self, node_id):
+        return [(key.id(), score) for key, score in KnowsCandidatesSearch(node_id)()]
+
+    def create(self, origin, destination):
+        CreateKnows(origin, destination)()
+
+    def test_incremental_updates(self):
+        # 1 knows 2 and 3, which know 4; 3 also knows 5 and 6
+        for o, d in [(1, 2), (1, 3), (2, 4), (3, 4), (3, 5), (3, 6)]:
+            self.create(o, d)
+        self.run_tasks()
+        self.assertListEqual([(4, 2), (5, 1)], self.candidates(1))
+        self.assertListEqual([], self.candidates(2))
+
+        # 7 -> 1 makes 2 and 3 candidates of 7
+        self.create(7, 1)
+        self.run_tasks()
+        self.assertListEqual([(2, 1), (3, 1)], self.candidates(7))
+
+        # 1 -> 4 removes 4 from 1 candidates and adds it to 7
+        self.create(1, 4)
+        self.run_tasks()
+        self.assertListEqual([(5, 1), (6, 1)], self.candidates(1))
+
+        DeleteKnows(3)()
+        self.run_tasks()
+        self.assertListEqual([], self.candidates(1))
+
+    def test_bounded_tasks_and_rebuild_all(self):
+        for o in xrange(2, 7):
+            Knows(o, 1).put()
+        Knows(1, 7).put()
+        self.taskqueue_stub.FlushQueue('default')
+        # 1 and all its origins are affected, batch_size=2 splits the 6 nodes work in 3 tasks
+        Knows(1, 6).put()
+        self.assertEqual(3, self.run_tasks())
+        self.assertListEqual([(6, 1), (7, 1)], self.candidates(2))
+        self.assertListEqual([(7, 1)], self.candidates(6))
+
+        ndb.delete_multi(TwoHopCandidates.query().fetch(keys_only=True))
+        self.assertListEqual([], self.candidates(2))
+        Knows._listeners[0].rebuild_all(Knows)
+        self.assertEqual(4, self.run_tasks())  # 7 nodes, 2 per task
+        self.assertListEqual([(6, 1), (7, 1)], self.candidates(5))
+
+    def test_not_indexed_arc(self):
+        NotIndexedArc(1, 2).put()
+        self.assertEqual(0, self.run_tasks())
+
+    def test_one_task_per_batch(self):
+        with batch_invalidation():
+            ndb.put_multi([Knows(1, d) for d in xrange(2, 7)])
+            with batch_invalidation():
+                Knows(2, 7).put()
+            self.assertEqual(0, len(self.taskqueue_stub.get_filtered_tasks()))
+        self.assertEqual(1, len(self.taskqueue_stub.get_filtered_tasks()))
+        self.run_tasks()
+        self.assertListEqual([(7, 1)], self.candidates(1))
+
+    def test_updates_not_notified(self):
+        arc = Knows(1, 2)
+        arc.put()
+        self.taskqueue_stub.FlushQueue('default')
+        arc.put()
+        arc.key.get(use_cache=False, use_memcache=False).put()
+        self.assertEqual(0, self.run_tasks())
+
+    def test_failed_transaction_not_notified(self):
+        def write():
+            Knows(1, 2, parent=ndb.Key(Node, 1)).put()
+            raise ndb.Rollback()
+
+        ndb.transaction(write)
+        self.assertEqual(0, self.run_tasks())
+        ndb.transaction(lambda: Knows(1, 3, parent=ndb.Key(Node, 1)).put())
+        self.assertEqual(1, self.run_tasks())
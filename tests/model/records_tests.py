@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import datetime
+
+from google.appengine.ext import ndb
+
+from gaegraph.model import Node, to_node_key
+from gaegraph.records import get_records, dict_to_record, NodeRecord
+from model.util import GAETestCase
+
+
+class RecordNode(Node):
+    name = ndb.StringProperty()
+    tags = ndb.StringProperty(repeated=True)
+    friend = ndb.KeyProperty(Node)
+
+
+class Address(ndb.Model):
+    city = ndb.StringProperty()
+
+
+class NamedRecordNode(Node):
+    nick = ndb.StringProperty('n')
+    address = ndb.StructuredProperty(Address)
+
+
+class TypedRecordNode(Node):
+    data = ndb.JsonProperty()
+    day = ndb.DateProperty()
+    hour = ndb.TimeProperty()
+    blob = ndb.BlobProperty(compressed=True)
+    text = ndb.TextProperty(compressed=True)
+    pickled = ndb.PickleProperty()
+    local = ndb.LocalStructuredProperty(Address)
+    counts = ndb.IntegerProperty(repeated=True)
+
+
+class RecordsTests(GAETestCase):
+    def test_get_records(self):
+        friend = Node()
+        friend.put()
+        node = RecordNode(name='foo', tags=['a', 'b'], friend=friend.key)
+        node.put()
+        record, missing = get_records([node.key, ndb.Key(Node, 404)])
+        self.assertIsNone(missing)
+        self.assertIsInstance(record, NodeRecord)
+        self.assertEqual(node.key.id(), record.id)
+        self.assertEqual('RecordNode', record.class_name)
+        self.assertEqual('foo', record.name)
+        self.assertListEqual(['a', 'b'], record.tags)
+        self.assertEqual(friend.key, record.friend)
+        self.assertEqual(node.creation, record.creation)
+        self.assertEqual(node.key, record.key)
+        self.assertEqual(node.key, to_node_key(record))
+        self.assertIs(RecordNode, record.model_class())
+        self.assertRaises(AttributeError, setattr, record, 'name', 'bar')
+
+    def test_selected_properties(self):
+        node = RecordNode(name='foo', tags=['a'])
+        node.put()
+        record = get_records([node.key], ['name', 'friend'])[0]
+        self.assertEqual(('id', 'class_name', 'name', 'friend'), record._fields)
+        self.assertEqual('foo', record.name)
+        self.assertIsNone(record.friend)
+        self.assertListEqual([], get_records([]))
+
+    def test_properties_by_code_name(self):
+        node = NamedRecordNode(nick='foo', address=Address(city='Natal'))
+        node.put()
+        record = get_records([node.key], ['nick'])[0]
+        self.assertEqual(('id', 'class_name', 'nick'), record._fields)
+        self.assertEqual('foo', record.nick)
+
+    def test_structured_property(self):
+        node = NamedRecordNode(nick='foo', address=Address(city='Natal'))
+        node.put()
+        record = get_records([node.key], ['nick', 'address'])[0]
+        self.assertEqual('foo', record.nick)
+        self.assertEqual('Natal', record.address.city)
+        record = get_records([node.key])[0]
+        self.assertEqual(('id', 'class_name', 'address', 'creation', 'nick'), record._fields)
+        self.assertEqual('Natal', record.address.city)
+
+    def test_empty_repeated_property(self):
+        node = RecordNode(name='foo')
+        node.put()
+        self.assertListEqual([], get_records([node.key], ['tags'])[0].tags)
+        self.assertListEqual([], get_records([node.key])[0].tags)
+
+    def test_values_converted_as_on_entities(self):
+        node = TypedRecordNode(data={'a': 1}, day=datetime.date(2020, 1, 2), hour=datetime.time(3, 4), blob=b'xyz',
+                               text='texto', pickled={'b': [1, 2]}, local=Address(city='Natal'), counts=[1, 2])
+        node.put()
+        properties = ['data', 'day', 'hour', 'blob', 'text', 'pickled', 'local', 'counts']
+        entity = node.key.get(use_cache=False, use_memcache=False)
+        for selected in [properties, properties[:-2]]:
+            record = get_records([node.key], selected)[0]
+            for name in selected:
+                self.assertEqual(getattr(entity, name), getattr(record, name))
+
+    def test_to_dict(self):
+        node = RecordNode(name='foo', tags=['a'])
+        node.put()
+        record = get_records([node.key], ['name', 'tags'])[0]
+        self.assertDictEqual(node.to_dict(include=['id', 'name', 'tags']), record.to_dict())
+        self.assertDictEqual({'name': 'foo'}, record.to_dict(include=['name']))
+        self.assertDictEqual({'id': str(node.key.id()), 'tags': ['a']}, record.to_dict(exclude=['name']))
+
+    def test_dict_to_record_and_with_values(self):
+        record = dict_to_record(1, 'RecordNode', {'name': 'foo', 'id': '1'})
+        self.assertEqual(('id', 'class_name', 'name'), record._fields)
+        self.assertIs(type(record), type(dict_to_record(2, 'RecordNode', {'name': 'bar'})))
+        extended = record.with_values(destinations=[])
+        self.assertEqual(('id', 'class_name', 'name', 'destinations'), extended._fields)
+        self.assertEqual('foo', extended.name)
+        self.assertListEqual([], extended.destinations)
+        self.assertRaises(AttributeError, setattr, record, 'other', 1)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+from datetime import datetime
+import json
+
+from google.appengine.ext import ndb
+
+from gaegraph.model import Node
+from gaegraph.records import get_records
+from gaegraph.serialization import to_dicts, to_json
+from model.util import GAETestCase
+
+
+class SerializableNode(Node):
+    name = ndb.StringProperty()
+    friend = ndb.KeyProperty(Node)
+
+
+class SerializationTests(GAETestCase):
+    def setUp(self):
+        super(SerializationTests, self).setUp()
+        self.nodes = [SerializableNode(name='n%s' % i) for i in xrange(3)]
+        ndb.put_multi(self.nodes)
+
+    def test_to_dicts(self):
+        self.assertListEqual([n.to_dict() for n in self.nodes], to_dicts(self.nodes))
+        for spec in [{'include': ['id', 'name']}, {'include': ['name', 'class_']}, {'exclude': ['id', 'creation']}]:
+            self.assertListEqual([n.to_dict(**spec) for n in self.nodes], to_dicts(self.nodes, **spec))
+
+    def test_mixed_classes(self):
+        node = Node()
+        node.put()
+        dcts = to_dicts([self.nodes[0], node], exclude=['creation'])
+        self.assertListEqual([{'id': str(self.nodes[0].key.id()), 'name': 'n0', 'friend': None},
+                              {'id': str(node.key.id())}], dcts)
+
+    def test_relations(self):
+        root, child, grandchild = self.nodes
+        root.children = [child]
+        root.parent = None
+        child.children = [grandchild]
+        dct = to_dicts([root], include=['name'], relations=['children.children', 'parent', 'not_filled'])[0]
+        self.assertDictEqual({'name': 'n0', 'parent': None,
+                              'children': [{'name': 'n1', 'children': [{'name': 'n2'}]}]}, dct)
+
+    def test_records(self):
+        records = get_records([n.key for n in self.nodes], ['name'])
+        records[0] = records[0].with_values(children=[records[1]])
+        dcts = to_dicts(records, exclude=['id'], relations=['children'])
+        self.assertListEqual([{'name': 'n0', 'children': [{'name': 'n1'}]}, {'name': 'n1'}, {'name': 'n2'}], dcts)
+
+    def test_to_json(self):
+        node = self.nodes[0]
+        node.friend = self.nodes[1].key
+        node.creation = datetime(2014, 1, 2, 3, 4, 5)
+        dct = json.loads(to_json([node]))[0]
+        self.assertDictEqual({'id': str(node.key.id()), 'name': 'n0', 'friend': str(self.nodes[1].key.id()),
+                              'creation': '2014-01-02T03:04:05'}, dct)
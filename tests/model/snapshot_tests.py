@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import os
+import shutil
+import tempfile
+
+from google.appengine.ext import ndb
+
+from gaegraph import snapshot
+from gaegraph.model import Node, Arc
+from gaegraph.snapshot import GraphSnapshot, SnapshotException
+from model.util import GAETestCase
+
+EDGES = [(1, 2), (1, 3), (2, 3), (3, 4), (5, 1), (1, 2)]
+
+
+class SnapshotArc(Arc):
+    pass
+
+
+class OtherSnapshotArc(Arc):
+    pass
+
+
+class GraphSnapshotTests(GAETestCase):
+    def setUp(self):
+        super(GraphSnapshotTests, self).setUp()
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+        super(GraphSnapshotTests, self).tearDown()
+
+    def use_numpy_options(self):
+        return [False, True] if snapshot.numpy is not None else [False]
+
+    def assert_snapshot(self, graph):
+        self.assertEqual(5, graph.nodes_count)
+        self.assertEqual(6, graph.arcs_count)
+        self.assertListEqual([2, 2, 3], graph.destinations(1))
+        self.assertListEqual([1, 1], graph.origins(2))
+        self.assertListEqual([], graph.destinations(4))
+        self.assertEqual(3, graph.out_degree(ndb.Key(Node, 1)))
+        self.assertEqual(2, graph.in_degree('3'))
+        self.assertRaises(KeyError, graph.destinations, 6)
+        self.assertDictEqual({1: 0, 2: 1, 3: 1, 4: 2}, graph.bfs(1))
+        self.assertDictEqual({1: 0, 2: 1, 3: 1}, graph.bfs(1, max_depth=1))
+        self.assertDictEqual({1: 0, 5: 1}, graph.bfs(1, reverse=True))
+        self.assertDictEqual({'nodes': 5, 'arcs': 6, 'min': 0, 'max': 3, 'mean': 1.2}, graph.degree_stats())
+        self.assertEqual(0, graph.degree_stats(reverse=True)['min'])
+
+    def test_from_edges(self):
+        for use_numpy in self.use_numpy_options():
+            self.assert_snapshot(GraphSnapshot.from_edges(EDGES, use_numpy))
+
+    def test_save_and_open(self):
+        path = os.path.join(self.temp_dir, 'graph.csr')
+        for save_numpy in self.use_numpy_options():
+            GraphSnapshot.from_edges(EDGES, save_numpy).save(path)
+            for open_numpy in self.use_numpy_options():
+                graph = GraphSnapshot.open(path, open_numpy)
+                self.assert_snapshot(graph)
+                graph.close()
+
+    def test_open_invalid_file(self):
+        path = os.path.join(self.temp_dir, 'invalid')
+        with open(path, 'wb') as f:
+            f.write(b'invalid file')
+        self.assertRaises(SnapshotException, GraphSnapshot.open, path)
+
+    def test_load(self):
+        nodes = [Node(id=i) for i in xrange(1, 6)]
+        ndb.put_multi(nodes)
+        ndb.put_multi([SnapshotArc(o, d) for o, d in EDGES])
+        OtherSnapshotArc(4, 5).put()
+        self.assert_snapshot(GraphSnapshot.load([SnapshotArc], batch_size=2))
+        graph = GraphSnapshot.load([SnapshotArc, OtherSnapshotArc])
+        self.assertListEqual([5], graph.destinations(4))
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+from io import BytesIO
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from gaegraph.business_base import DestinationsSearch
+from gaegraph.model import Node, Arc, destinations_cache_key, origins_cache_key
+from gaegraph.transfer import export_graph, import_graph, TransferException
+from model.util import GAETestCase
+
+
+class TransferNode(Node):
+    name = ndb.StringProperty()
+
+
+class TransferArc(Arc):
+    pass
+
+
+class TransferDestinationsSearch(DestinationsSearch):
+    arc_class = TransferArc
+
+
+class TransferTests(GAETestCase):
+    def test_export_and_import(self):
+        nodes = [TransferNode(name='n%s' % i) for i in xrange(5)]
+        ndb.put_multi(nodes)
+        root = nodes[0]
+        arcs = [TransferArc(root, n) for n in nodes[1:]]
+        ndb.put_multi(arcs)
+        stream = BytesIO()
+        self.assertEqual(9, export_graph(stream, [TransferNode, TransferArc], batch_size=2))
+
+        # destinations are cached before datastore is cleaned
+        self.assertListEqual(nodes[1:], TransferDestinationsSearch(root)())
+        ndb.delete_multi([e.key for e in nodes + arcs])
+        memcache.set(destinations_cache_key(TransferArc, root), [nodes[1].key])
+
+        stream.seek(0)
+        self.assertEqual(9, import_graph(stream, batch_size=2, max_concurrent_batches=2))
+        # caches are rebuilt with imported arcs
+        self.assertListEqual([n.key for n in nodes[1:]], memcache.get(destinations_cache_key(TransferArc, root)))
+        self.assertListEqual([root.key], memcache.get(origins_cache_key(TransferArc, nodes[1])))
+        ndb.get_context().clear_cache()
+        self.assertListEqual(nodes, ndb.get_multi([n.key for n in nodes]))
+        self.assertListEqual(arcs, ndb.get_multi([a.key for a in arcs]))
+        self.assertListEqual(nodes[1:], TransferDestinationsSearch(root)())
+
+    def test_imported_ids_reserved(self):
+        nodes = [TransferNode(name='n%s' % i) for i in xrange(5)]
+        ndb.put_multi(nodes)
+        arc = TransferArc(nodes[0], nodes[1])
+        arc.put()
+        stream = BytesIO()
+        export_graph(stream, [TransferNode, TransferArc])
+
+        # importing on an empty datastore
+        self.tearDown()
+        self.setUp()
+        stream.seek(0)
+        import_graph(stream)
+        self.assertGreater(TransferNode(name='new').put().id(), max(n.key.id() for n in nodes))
+        self.assertGreater(TransferArc(nodes[0], nodes[1]).put().id(), arc.key.id())
+
+    def test_import_without_warming(self):
+        node = TransferNode(name='n')
+        node.put()
+        TransferArc(node, node).put()
+        stream = BytesIO()
+        export_graph(stream, [TransferNode, TransferArc])
+        memcache.flush_all()
+        stream.seek(0)
+        self.assertEqual(2, import_graph(stream, warm_caches=False))
+        self.assertIsNone(memcache.get(destinations_cache_key(TransferArc, node)))
+
+    def test_invalid_stream(self):
+        self.assertRaises(TransferException, import_graph, BytesIO(b'invalid'))
+        stream = BytesIO()
+        export_graph(stream, [TransferNode])
+        self.assertEqual(0, import_graph(BytesIO(stream.getvalue())))
+        TransferNode(name='foo').put()
+        stream = BytesIO()
+        export_graph(stream, [TransferNode])
+        self.assertRaises(TransferException, import_graph, BytesIO(stream.getvalue()[:-1]))
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+import mock
+
+from gaegraph import cache, warming
+from gaegraph.business_base import ORIGINS, EMPTY_ADJACENCY
+from gaegraph.model import Node, Arc, destinations_cache_key, origins_cache_key, origins_sharded_key
+from gaegraph.warming import WarmCaches
+from model.util import GAETestCase
+from mommygae import mommy
+
+
+class WarmedArc(Arc):
+    pass
+
+
+class ShardedWarmedArc(Arc):
+    origin_shards = 2
+    sharding_threshold = 2
+
+
+class WarmCachesTests(GAETestCase):
+    def setUp(self):
+        super(WarmCachesTests, self).setUp()
+        self.nodes = [mommy.save_one(Node) for _ in xrange(4)]
+        a, b, c, d = self.nodes
+        ndb.put_multi([WarmedArc(a, b), WarmedArc(a, c), WarmedArc(b, c)])
+        memcache.flush_all()
+
+    def test_warm_nodes_adjacency(self):
+        a, b, c, d = self.nodes
+        result = WarmCaches([WarmedArc, (WarmedArc, ORIGINS)], nodes=[a, b.key, d.key.id()], batch_size=2)()
+        self.assertDictEqual({'nodes': 3, 'queries': 6, 'loaded_nodes': 0}, result)
+        self.assertListEqual([b.key, c.key], cache.get(destinations_cache_key(WarmedArc, a.key)))
+        self.assertListEqual([c.key], cache.get(destinations_cache_key(WarmedArc, b.key)))
+        self.assertListEqual([a.key], cache.get(origins_cache_key(WarmedArc, b.key)))
+        self.assertEqual(EMPTY_ADJACENCY, cache.get(destinations_cache_key(WarmedArc, d.key)))
+
+        # cached lists are not queried again
+        result = WarmCaches([WarmedArc], nodes=[a, b, c])()
+        self.assertEqual(1, result['queries'])
+
+    def test_warm_from_query(self):
+        a, b, c, d = self.nodes
+        result = WarmCaches([WarmedArc], query=Node.query_by_creation(), limit=2, warm_nodes=True)()
+        self.assertDictEqual({'nodes': 2, 'queries': 2, 'loaded_nodes': 3}, result)
+        self.assertListEqual([b.key, c.key], cache.get(destinations_cache_key(WarmedArc, a.key)))
+        self.assertIsNone(cache.get(destinations_cache_key(WarmedArc, c.key)))
+        ndb_cache_key = ndb.Context._memcache_prefix + c.key.urlsafe()
+        self.assertIsNotNone(memcache.get(ndb_cache_key))
+        self.assertIsNone(memcache.get(ndb.Context._memcache_prefix + d.key.urlsafe()))
+
+    def test_sharded_origins(self):
+        a, b, c, d = self.nodes
+        ndb.put_multi([ShardedWarmedArc(a, c), ShardedWarmedArc(b, c)])
+        result = WarmCaches([(ShardedWarmedArc, ORIGINS)], nodes=[c])()
+        self.assertEqual(1, result['queries'])
+        self.assertTrue(cache.get(origins_sharded_key(ShardedWarmedArc, c.key)))
+        self.assertIsNone(cache.get(origins_cache_key(ShardedWarmedArc, c.key)))
+
+    def test_rate_limit(self):
+        with mock.patch.object(warming, '_sleep') as sleep:
+            result = WarmCaches([WarmedArc], nodes=self.nodes, batch_size=1, max_queries_per_second=1)()
+        self.assertEqual(4, result['queries'])
+        self.assertEqual(3, sleep.call_count)
+        self.assertTrue(all(0 < call[0][0] <= 3 for call in sleep.call_args_list))
+
+    def test_nodes_or_query(self):
+        self.assertRaises(Exception, WarmCaches, [WarmedArc])
+        self.assertRaises(Exception, WarmCaches, [WarmedArc], nodes=self.nodes, query=Node.query())
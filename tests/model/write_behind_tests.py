@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import json
+import os
+import shutil
+import tempfile
+
+import mock
+
+from google.appengine.api import memcache, taskqueue
+from google.appengine.ext import ndb
+
+from gaegraph.business_base import DestinationsSearch
+from gaegraph.model import Node, Arc, pending_arcs_cache_key
+from gaegraph.write_behind import QueueArcCreation, QueueArcDeletion, apply_pending_arcs, QUEUE_NAME
+from model.util import GAETestCase
+from mommygae import mommy
+
+QUEUE_YAML = """
+queue:
+- name: gaegraph-arcs
+  mode: pull
+"""
+
+
+class Likes(Arc):
+    pass
+
+
+class QueueLike(QueueArcCreation):
+    arc_class = Likes
+
+
+class QueueUnlike(QueueArcDeletion):
+    arc_class = Likes
+
+
+class LikesSearch(DestinationsSearch):
+    arc_class = Likes
+
+
+class RatedLikes(Arc):
+    rating = ndb.IntegerProperty(default=5)
+
+    @classmethod
+    def orderings(cls):
+        orderings = super(RatedLikes, cls).orderings()
+        orderings['rating'] = -cls.rating
+        return orderings
+
+
+class QueueRatedLike(QueueArcCreation):
+    arc_class = RatedLikes
+
+
+class RatedLikesSearch(DestinationsSearch):
+    arc_class = RatedLikes
+
+
+class WriteBehindTests(GAETestCase):
+    def setUp(self):
+        super(WriteBehindTests, self).setUp()
+        self.root_path = tempfile.mkdtemp()
+        with open(os.path.join(self.root_path, 'queue.yaml'), 'w') as f:
+            f.write(QUEUE_YAML)
+        self.testbed.init_taskqueue_stub(root_path=self.root_path)
+        self.user = mommy.save_one(Node)
+        self.posts = [mommy.save_one(Node) for i in xrange(4)]
+
+    def tearDown(self):
+        shutil.rmtree(self.root_path)
+        super(WriteBehindTests, self).tearDown()
+
+    def test_read_your_writes(self):
+        Likes(self.user, self.posts[0]).put()
+        self.assertListEqual([self.posts[0]], LikesSearch(self.user)())  # caching
+        QueueLike(self.user, self.posts[1])()
+        QueueLike(self.user, self.posts[2])()
+        QueueUnlike(self.user, self.posts[0])()
+        self.assertListEqual([self.posts[0]], LikesSearch(self.user)())
+        self.assertListEqual(self.posts[1:3], LikesSearch(self.user, with_pending=True)())
+        self.assertListEqual(self.posts[1:3], LikesSearch(self.user, with_pending=True)())
+        self.assertEqual(0, Likes.query(Likes.destination.IN([p.key for p in self.posts[1:3]])).count())
+
+    def test_apply_coalescing_operations(self):
+        Likes(self.user, self.posts[0]).put()
+        self.assertListEqual([self.posts[0]], LikesSearch(self.user)())  # caching
+        QueueLike(self.user, self.posts[1])()
+        QueueLike(self.user, self.posts[1])()  # duplicated
+        QueueLike(self.user, self.posts[2])()
+        QueueUnlike(self.user, self.posts[2])()  # cancels creation
+        QueueUnlike(self.user, self.posts[0])()
+        QueueUnlike(self.user, self.posts[3])()
+        QueueLike(self.user, self.posts[3])()  # deletion followed by creation
+
+        self.assertEqual(7, apply_pending_arcs(Likes))
+        self.assertEqual(0, apply_pending_arcs(Likes))
+        self.assertListEqual([], memcache.get(pending_arcs_cache_key(Likes, self.user)))
+        self.assertEqual(2, Likes.query().count())
+        self.assertItemsEqual([self.posts[1], self.posts[3]], LikesSearch(self.user)())
+        self.assertItemsEqual([self.posts[1], self.posts[3]], LikesSearch(self.user, with_pending=True)())
+
+    def test_operations_queued_after_lease_stay_pending(self):
+        QueueLike(self.user, self.posts[0])()
+        self.assertEqual(1, apply_pending_arcs(Likes, max_tasks=1))
+        QueueLike(self.user, self.posts[1])()
+        self.assertListEqual([self.posts[0]], LikesSearch(self.user)())
+        self.assertListEqual(self.posts[:2], LikesSearch(self.user, with_pending=True)())
+
+    def test_pending_creations_follow_ordering(self):
+        Likes(self.user, self.posts[0]).put()
+        self.assertListEqual([self.posts[0]], LikesSearch(self.user, order='creation_desc')())  # caching
+        QueueLike(self.user, self.posts[1])()
+        QueueLike(self.user, self.posts[2])()
+        self.assertListEqual([self.posts[2], self.posts[1], self.posts[0]],
+                             LikesSearch(self.user, order='creation_desc', with_pending=True)())
+        self.assertListEqual(self.posts[:3], LikesSearch(self.user, with_pending=True)())
+
+    def test_pending_creations_follow_custom_ordering(self):
+        RatedLikes(self.user, self.posts[0], rating=9).put()
+        RatedLikes(self.user, self.posts[1], rating=1).put()
+        self.assertListEqual(self.posts[:2], RatedLikesSearch(self.user, order='rating')())  # caching
+        QueueRatedLike(self.user, self.posts[2])()
+        self.assertListEqual([self.posts[0], self.posts[2], self.posts[1]],
+                             RatedLikesSearch(self.user, order='rating', with_pending=True)())
+
+    def test_operations_ordered_by_sequence(self):
+        QueueUnlike(self.user, self.posts[0])()
+        QueueLike(self.user, self.posts[0])()
+        tasks = taskqueue.Queue(QUEUE_NAME).lease_tasks(60, 10)
+        sequences = [json.loads(t.payload)['seq'] for t in tasks]
+        self.assertEqual(sequences[0] + 1, sequences[1])
+        # deletion enqueued first, even with a later client clock, is applied before creation
+        taskqueue.Queue(QUEUE_NAME).delete_tasks(tasks)
+        payloads = [json.loads(t.payload) for t in tasks]
+        payloads[0]['time'], payloads[1]['time'] = 2000000000.0, 1000000000.0
+        for payload in payloads:
+            taskqueue.Queue(QUEUE_NAME).add(taskqueue.Task(method='PULL', payload=json.dumps(payload), tag='Likes'))
+        self.assertEqual(2, apply_pending_arcs(Likes))
+        self.assertListEqual([self.posts[0]], LikesSearch(self.user)())
+
+    def test_leased_again_creates_arcs_once(self):
+        QueueLike(self.user, self.posts[0])()
+        QueueUnlike(self.user, self.posts[1])()
+        QueueLike(self.user, self.posts[1])()
+        with mock.patch.object(taskqueue.Queue, 'delete_tasks'):  # lease expires before tasks are deleted
+            self.assertEqual(3, apply_pending_arcs(Likes, lease_seconds=0))
+        self.assertEqual(3, apply_pending_arcs(Likes))
+        self.assertEqual(2, Likes.query().count())
+        self.assertItemsEqual(self.posts[:2], LikesSearch(self.user)())